@@ -2,31 +2,225 @@
 Title:   allsky_events.py
 Author:  Peter Quigley
 Date:    2022/11/02
-Purpose: Generate a list of unique events on a specific date and their magnitudes
+Purpose: Generate the lists of unique events for any number of nights and
+         their magnitudes, plus a combined catalog over a range of dates
 
-Usage: *Must be used on Peter's personal computer, or pathing changed
-Improvements: Make more general
+Usage: python3 allsky_events.py DATA_DIR [START_DATE] [END_DATE]
+       Nights are DATA_DIR/YYYYMMDD/evmagsYYYYMMDD.log, or the
+       DATA_DIR/evmagsYYYYMMDD.log written by detect.py. Each night gets its
+       UniqueEventsYYYYMMDD.log beside its log, and the range gets
+       DATA_DIR/UniqueEvents{START}-{END}.log sorted brightest first.
 """
 
+import os,sys
+import re
 import numpy as np
+from itertools import islice
+
+
+## One row per event line. The ID is characters 12:18 (hhmmss) of the full
+## event ID and the magnitude is column 10; its text is kept as well so the
+## outputs are written exactly as they were read.
+EVENT_DTYPE = np.dtype([("night","i4"), ("id","S6"), ("mag","f8"), ("magstr","S6")])
+
+LOG_PATTERN = re.compile(r"evmags(\d{8})\.log$")
 
 
 ###########################
-## 
+## Log Parsing
 ###########################
 
-evdate = input("Event date (YYYYMMDD): ")
-#evpath = f"../../FLIR-Data/{evdate}/evmags{evdate}.log"
-evpath = f"data/{evdate}/evmags{evdate}.log"
+def readEventLog(log_path, night=None, chunk_lines=65536):
+    """
+    Stream an evmags log in chunks of typed columns.
+
+        Parameters:
+            log_path (str): Path to the evmags log
+            night (int): YYYYMMDD of the night. Defaults to the date in
+                         the log's filename.
+            chunk_lines (int): Lines parsed at a time
+
+        Yields:
+            events (arr): EVENT_DTYPE array of the next chunk of events
+    """
+
+    if night is None:
+        match = LOG_PATTERN.search(os.path.basename(log_path))
+        if match is None:
+            raise ValueError(f"{log_path} needs to be named evmagsYYYYMMDD.log")
+        night = int(match.group(1))
+
+    with open(log_path) as f:
+        while True:
+            lines = list(islice(f, chunk_lines))
+            if not lines:
+                break
+
+            cols = np.loadtxt(lines, dtype=[("id","S32"),("mag","S16")], usecols=(0,10),
+                              comments="#", ndmin=1)
+            if len(cols) == 0:
+                continue
+
+            ## Slice the hhmmss out of every ID at once through a byte view
+            ids = np.ascontiguousarray(cols["id"]).view(np.uint8).reshape(len(cols), -1)[:,12:18]
+
+            events = np.empty(len(cols), dtype=EVENT_DTYPE)
+            events["night"]  = night
+            events["id"]     = np.ascontiguousarray(ids).view("S6").ravel()
+            events["mag"]    = cols["mag"].astype(np.float64)
+            events["magstr"] = cols["mag"]
+            yield events
+
+
+def uniqueEvents(chunks, seen=None):
+    """
+    Keep the first of every event, by night and ID, from a stream of
+    chunks. Each chunk is deduplicated with np.unique, then checked against
+    a hash set of every key seen so far.
 
-evlist = np.loadtxt(evpath,dtype=object)[:,[0,10]]
-evlist[:,0] = [ev[12:18] for ev in evlist[:,0]]
+        Parameters:
+            chunks (iterable): EVENT_DTYPE arrays, eg. from readEventLog
+            seen (set): Keys already seen, shared to deduplicate across
+                        calls. Updated in place.
+
+        Returns:
+            events (arr): EVENT_DTYPE array in the order first seen
+    """
+
+    if seen is None:
+        seen = set()
+
+    kept = []
+    for events in chunks:
+        # Key of night and hhmmss as one integer
+        keys = events["night"].astype(np.int64)*1000000 + events["id"].astype(np.int64)
+        keys, first = np.unique(keys, return_index=True)
+
+        new = np.fromiter((key not in seen for key in keys.tolist()), dtype=bool, count=len(keys))
+        seen.update(keys[new].tolist())
+        kept.append(events[np.sort(first[new])])
+
+    if not kept:
+        return np.zeros(0, dtype=EVENT_DTYPE)
+    return np.concatenate(kept)
+
+
+def brightestFirst(events):
+    """
+    Sort events by magnitude, brightest (lowest magnitude) first.
+    """
+
+    return events[np.argsort(events["mag"], kind="stable")]
+
+
+###########################
+## Nights and Catalogs
+###########################
+
+def findEventLogs(data_dir, start=None, end=None):
+    """
+    Find the evmags logs of the nights in a data directory, laid out as
+    DATA_DIR/YYYYMMDD/evmagsYYYYMMDD.log, or beside the night directory as
+    DATA_DIR/evmagsYYYYMMDD.log.
+
+        Parameters:
+            data_dir (str): Directory of night directories
+            start, end (str/int): First and last YYYYMMDD to include.
+                                  None for no limit.
+
+        Returns:
+            logs (list): (night, log_path) pairs in date order
+    """
+
+    if not os.path.isdir(data_dir):
+        raise NotADirectoryError(f"{data_dir} is not a valid directory")
+
+    logs = []
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            if not (entry.is_dir() and re.fullmatch(r"\d{8}", entry.name)):
+                continue
+            night = int(entry.name)
+            if (start is not None and night < int(start)) or (end is not None and night > int(end)):
+                continue
+
+            for log_path in (os.path.join(entry.path, f"evmags{entry.name}.log"),
+                             os.path.join(data_dir, f"evmags{entry.name}.log")):
+                if os.path.isfile(log_path):
+                    logs.append((night, log_path))
+                    break
+
+    return sorted(logs)
+
+
+def writeUniqueEvents(events, save_path, with_night=False):
+    """
+    Write events as comma separated "hhmmss,mag" lines (or
+    "YYYYMMDD,hhmmss,mag" with the night), brightest first.
+    """
+
+    events = brightestFirst(events)
+    cols   = [events["id"], events["magstr"]]
+    if with_night:
+        cols.insert(0, events["night"].astype("S8"))
+
+    np.savetxt(save_path, np.column_stack(cols).astype(str), fmt="%s", delimiter=",")
+
+
+def processEventLogs(data_dir, start=None, end=None, catalog_path=None):
+    """
+    Write the UniqueEventsYYYYMMDD.log of every night in a range of dates,
+    and a combined catalog of all their unique events.
+
+        Parameters:
+            data_dir (str): Directory of night directories
+            start, end (str/int): First and last YYYYMMDD to include
+            catalog_path (str): Path of the combined catalog. Defaults to
+                                DATA_DIR/UniqueEvents{first}-{last}.log.
+                                False to not write one.
+
+        Returns:
+            catalog (arr): EVENT_DTYPE array of every unique event,
+                           brightest first
+    """
+
+    logs = findEventLogs(data_dir, start, end)
+    if not logs:
+        print(f"No evmags logs found in {data_dir}")
+        return np.zeros(0, dtype=EVENT_DTYPE)
+
+    ## Each night is deduplicated and written on its own
+    nights = []
+    for night, log_path in logs:
+        events = uniqueEvents(readEventLog(log_path, night))
+        writeUniqueEvents(events, os.path.join(os.path.dirname(log_path),
+                                               f"UniqueEvents{night}.log"))
+        nights.append(events)
+        print(f"{night}: {len(events)} unique events")
+
+    ## Nights are deduplicated by night and ID, so they just need joining
+    catalog = brightestFirst(np.concatenate(nights))
+    if catalog_path is None:
+        catalog_path = os.path.join(data_dir, f"UniqueEvents{logs[0][0]}-{logs[-1][0]}.log")
+    if catalog_path:
+        writeUniqueEvents(catalog, catalog_path, with_night=True)
+        print(f"Wrote {len(catalog)} events from {len(logs)} nights to {catalog_path}")
+
+    return catalog
+
+
+###########################
+## Main
+###########################
 
-unique_ev = evlist[np.unique(evlist[:,0],return_index=True)[1]]
-unique_ev = unique_ev[unique_ev[:,1].argsort()]
+if __name__ == "__main__":
 
-#np.savetxt(f"../../FLIR-Data/{evdate}/UniqueEvents{evdate}.log",
-np.savetxt(f"data/{evdate}/UniqueEvents{evdate}.log",
-           unique_ev[::-1],fmt="%.6s",
-           delimiter=",")
+    if len(sys.argv) == 1:
+        print("Usage: python3 allsky_events.py DATA_DIR [START_DATE] [END_DATE]")
+        sys.exit()
+    elif not os.path.isdir(sys.argv[1]):
+        sys.exit(f"{sys.argv[1]} is not a directory")
 
+    start = sys.argv[2] if len(sys.argv) > 2 else None
+    end   = sys.argv[3] if len(sys.argv) > 3 else start
+    processEventLogs(sys.argv[1], start, end)
@@ -15,9 +15,14 @@ $Description$
 import os,sys
 import png
 import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
 
+## Custom Script Imports
+import instrument
+from frameindex import buildFrameIndex
+from bitconverter import unpack12
+from calibration import subtractBias, asBias
+
 
 ##############################
 ## Get Time Between Frames
@@ -25,15 +30,17 @@ from pathlib import Path
 
 def convNameToTime(fname):
     """
-    Converts
+    Converts a "hh_mm_ss_fff" .raw or .png filename into seconds since
+    midnight. See frameindex.parseFrameTimes for whole directories, whose
+    times count on past 24h after midnight (convert with
+    frameindex.nightTime).
     
     """
     
-    ## Sanitize and strip inputs
-    if fname.lower().endswith(".png"):
-        obs_time = fname.lower().strip(".png").split("_")
-    elif fname.lower().endswith(".raw"):
-        obs_time = fname.lower().strip(".raw").split("_")
+    ## Sanitize and strip inputs (the suffix, not its characters)
+    fname = os.path.basename(fname)
+    if fname.lower().endswith((".png",".raw")):
+        obs_time = fname[:-4].split("_")
     else:
         raise NotImplementedError("Only .raw and .png filenames are currently supported")
 
@@ -54,20 +61,17 @@ def trueFrameRate(frame_dir, plot=False):
     if not os.path.isdir(frame_dir):
         raise NotADirectoryError(f"{frame_dir} is not a valid directory")
     
-    ## Iterate through the directory and convert names to obs_times (in sec)
-    t = []
-    for fname in os.listdir(frame_dir):
-        try:
-            t.append(convNameToTime(fname))
-        except NotImplementedError:
-            pass
+    ## Get the sorted obs_times (in sec) from the directory's frame index
+    arr_t = buildFrameIndex(frame_dir)["time"]
+    if len(arr_t) == 0:
+        arr_t = buildFrameIndex(frame_dir,suffix=".png")["time"]
     
-    ## Convert t to a numpy array find the difference between frames
-    arr_t = np.array(sorted(t))
+    ## Find the difference between frames
     dt    = arr_t[1:]-arr_t[:-1]
     
     ## Plot time between frames if true
     if plot == True:
+        import matplotlib.pyplot as plt
         plt.plot(arr_t[:-1],dt)
         plt.title(f"Time Between Frames for Observations on {frame_dir}")
         plt.xlabel("Observed Time (s)")
@@ -82,22 +86,76 @@ def trueFrameRate(frame_dir, plot=False):
 ## 8-bit/16-bit RAW to PNG Converter
 ##############################
 
-def readRAW(img_path,bitdepth=16):
+## Orientations which undo the camera's mounting: quarter turns
+## counterclockwise, or flips. All are views on the last two axes.
+ORIENTATIONS = (None, "rot90", "rot180", "rot270", "flipud", "fliplr")
+
+def orientImage(img_data, orientation=None):
     """
-    
+    Reorient an image (or a stack of images) without copying it.
+
+        Parameters:
+            img_data (arr): 2D image or (N, height, width) stack
+            orientation (str): One of ORIENTATIONS. None leaves it as is.
+
+        Returns:
+            img_data (arr): View of the image, reoriented. rot90 and rot270
+                            swap the width and height.
     """
-    
-    ## Identify and use the correct image bitdepth to load in the image
-    if bitdepth == 16:
-        img_data = np.fromfile(img_path,dtype=np.uint16)
-    elif bitdepth == 8:
-        img_data = np.fromfile(img_path,dtype=np.uint8)
+
+    if orientation is None:
+        return img_data
+    elif orientation in ("rot90","rot180","rot270"):
+        return np.rot90(img_data, int(orientation[3:])//90, axes=(-2,-1))
+    elif orientation == "flipud":
+        return img_data[...,::-1,:]
+    elif orientation == "fliplr":
+        return img_data[...,:,::-1]
     else:
-        raise NotImplementedError("Only 8-bit and 16-bit images are currently supported")
+        raise ValueError(f"Orientation must be one of {ORIENTATIONS}")
+
+
+def readRAW(img_path,bitdepth=16,layout="msb",orientation=None):
+    """
+    Read a single 1024x768 .raw frame.
+    
+        Parameters:
+            img_path (str): Filepath to the .raw image. Frames of a night
+                            which has been archived are read from the
+                            archive (see archive.py).
+            bitdepth (int): 8, 16 or 12 for packed 12-bit frames
+            layout (str): Packing layout of 12-bit frames (see bitconverter)
+            orientation (str): Reorient the frame (see orientImage)
+            
+        Returns:
+            img_data (arr): (768,1024) image. 12-bit frames are unpacked
+                            to uint16.
+    """
     
     ## Load in the image
     X_DIM    = 1024
     Y_DIM    = 768
+    
+    ## Identify and use the correct image bitdepth to load in the image
+    with instrument.stage("analyzeframes.readRAW", frames=1) as st:
+        try:
+            if bitdepth == 16:
+                img_data = np.fromfile(img_path,dtype=np.uint16)
+            elif bitdepth in (8,12):
+                img_data = np.fromfile(img_path,dtype=np.uint8)
+            else:
+                raise NotImplementedError("Only 8-bit, 12-bit packed and 16-bit images are currently supported")
+        except FileNotFoundError:
+            from archive import archivedFrame
+            return orientImage(archivedFrame(img_path), orientation)
+        st.add(read=img_data.nbytes)
+
+    if bitdepth == 12:
+        try:
+            img_data = unpack12(img_data,shape=(Y_DIM,X_DIM),layout=layout)[0]
+        except ValueError:
+            raise ValueError(f"{img_path} is not a packed 12-bit {X_DIM}x{Y_DIM} frame")
+        return orientImage(img_data, orientation)
 
     ## Reshape 1D bit array into proper 1024x768 pixel shape
     try:
@@ -105,54 +163,405 @@ def readRAW(img_path,bitdepth=16):
     except:
         raise ValueError(f"Invalid image shape {img_data.shape}")
         
-    return img_data
+    return orientImage(img_data, orientation)
     
     
     
 
+##############################
+## Lazy Memory-Mapped Frame Stack
+##############################
+
+class FrameStack:
+    """
+    Lazily indexed stack of 16-bit 1024x768 frames. Frames are never read
+    up-front: each access opens a read-only np.memmap view of the backing
+    .raw file (or of one concatenated file of back-to-back frames), so only
+    the frames and rows actually touched are paged in. Archived nights are
+    decoded a chunk of frames at a time instead.
+
+        Parameters:
+            source (str/Path): Directory of .raw files, a .rawz archive (or
+                               a night directory replaced by its archive),
+                               or a single file of concatenated frames
+            num_frames (int): How many frames to use. -1 if all
+            bias (arr/str): Master bias/dark frame, or a calibration
+                            directory to build one from (see calibration).
+                            Subtracted from each frame as it is read,
+                            clipping at zero.
+            times (arr): Observation times (s) of the frames in a
+                         concatenated file. Ignored for directories.
+            bitdepth (int): 16, or 12 for packed 12-bit frames which are
+                            unpacked as they are read. Archives are always
+                            decoded to 16-bit.
+            layout (str): Packing layout of 12-bit frames (see bitconverter)
+
+        Indexing:
+            stack[i]             -> (768,1024) frame i
+            stack[i:j]           -> FrameStack of frames i to j
+            stack[i, r0:r1]      -> rows r0:r1 of frame i
+            stack[i:j, r0:r1]    -> (j-i, r1-r0, 1024) array, only those
+                                    rows are read from each frame
+    """
+
+    X_DIM = 1024
+    Y_DIM = 768
+
+    def __init__(self, source, num_frames=-1, bias=None, times=None,
+                 bitdepth=16, layout="msb"):
+
+        from archive import findArchive, ArchiveReader
+
+        ## Sanitize inputs
+        if bitdepth not in (12,16):
+            raise NotImplementedError("Only 12-bit packed and 16-bit frames are currently supported")
+        source = str(source)
+        self.source   = source
+        self.bias     = asBias(bias, bitdepth, layout)
+        self.bitdepth = bitdepth
+        self.layout   = layout
+        self.dtype    = np.dtype(np.uint16)
+        self._archive = None
+        frame_bytes   = self.X_DIM*self.Y_DIM*bitdepth//8
+        archive_path  = findArchive(source)
+
+        ## Directory of individual .raw files, ordered by observation time
+        if os.path.isdir(source):
+            index = buildFrameIndex(source)
+            if num_frames != -1:
+                index = index[:num_frames]
+
+            self.paths  = index["path"]
+            self.times  = index["time"]
+            self._index = np.arange(len(self.paths))
+            self._concat = None
+
+        ## Archived night, already in time order
+        elif archive_path is not None:
+            self._archive = ArchiveReader(archive_path)
+            total = len(self._archive) if num_frames == -1 else min(len(self._archive),num_frames)
+
+            self.bitdepth = 16
+            self.paths    = None
+            self.times    = self._archive.times[:total]
+            self._index   = np.arange(total)
+            self._concat  = None
+
+        ## Single file of concatenated frames
+        elif os.path.isfile(source):
+            total = os.path.getsize(source)//frame_bytes
+            if num_frames != -1:
+                total = min(total,num_frames)
+
+            self.paths   = None
+            self.times   = None if times is None else np.asarray(times,dtype=np.float64)[:total]
+            self._index  = np.arange(total)
+            storage      = self._storage()
+            self._concat = np.memmap(source, dtype=storage["dtype"], mode=storage["mode"],
+                                     shape=(total,)+storage["shape"])
+
+        else:
+            raise FileNotFoundError(f"{source} is not a directory or file")
+
+
+    @classmethod
+    def _subset(cls, parent, index):
+        """
+        Create a new FrameStack sharing the parent's backing files but only
+        containing the frames at the given positions in the parent.
+        """
+
+        sub = cls.__new__(cls)
+        sub.__dict__.update(parent.__dict__)
+        sub._index = parent._index[index]
+        if parent.times is not None:
+            sub.times = parent.times[index]
+
+        return sub
+
+
+    @property
+    def shape(self):
+        return (len(self._index),self.Y_DIM,self.X_DIM)
+
+
+    @property
+    def ndim(self):
+        return 3
+
+
+    def __len__(self):
+        return len(self._index)
+
+
+    def _storage(self):
+        """
+        memmap arguments for how a single frame is stored on disk. Packed
+        frames are mapped copy-on-write so they can be handed to the
+        unpacking kernels without a copy.
+        """
+
+        if self.bitdepth == 12:
+            return dict(dtype=np.uint8, mode="c", shape=(self.Y_DIM,self.X_DIM*3//2))
+        return dict(dtype=self.dtype, mode="r", shape=(self.Y_DIM,self.X_DIM))
+
+
+    def _frame(self, i):
+        """
+        Return a read-only memmap view of the i-th frame of this stack as it
+        is stored on disk.
+        """
+
+        if self._concat is not None:
+            return self._concat[self._index[i]]
+        if self._archive is not None:
+            return self._archive.frame(self._index[i])
+
+        return np.memmap(self.paths[self._index[i]], **self._storage())
+
+
+    def _read(self, i, rows=slice(None), cols=slice(None), out=None):
+        """
+        Page in the requested region of the i-th frame and subtract the bias,
+        into out if given. The bias is applied to the region as it is copied
+        out of the mapping, so calibration costs no extra reads.
+        """
+
+        ## Mapped frames are paged in as they're copied out, so the copy is
+        ## timed along with the read
+        with instrument.stage("analyzeframes.FrameStack.read", frames=1) as st:
+
+            ## Packed frames only unpack the requested rows
+            if self.bitdepth == 12:
+                packed = self._frame(i)[rows]
+                st.add(read=packed.nbytes)
+                region = unpack12(np.ascontiguousarray(packed),
+                                  shape=(packed.size//(self.X_DIM*3//2),self.X_DIM),
+                                  layout=self.layout)
+                region = region.reshape(packed.shape[:-1] + (self.X_DIM,))[...,cols]
+            else:
+                region = self._frame(i)[rows,cols]
+                st.add(read=region.nbytes)
+
+            if self.bias is None:
+                if out is None:
+                    return region
+                out[...] = region
+                return out
+
+            bias = self.bias
+            if bias.ndim == 2 and bias.shape != (1,1):
+                bias = bias[rows,cols]
+
+            ## Saturating subtract: clip the frame up to the bias, then subtract
+            ## in place (the clip also makes the writable copy of a mapped frame)
+            out = np.maximum(region, bias, out=out, casting="unsafe",
+                             dtype=None if out is not None else self.dtype)
+            np.subtract(out, bias, out=out, casting="unsafe")
+            return out
+
+
+    def __getitem__(self, key):
+
+        ## Split frame selection from the pixel region
+        if isinstance(key, tuple):
+            frame_key, region = key[0], key[1:]
+        else:
+            frame_key, region = key, ()
+        rows = region[0] if len(region) > 0 else slice(None)
+        cols = region[1] if len(region) > 1 else slice(None)
+
+        ## Single frame
+        if isinstance(frame_key, (int,np.integer)):
+            if frame_key < 0:
+                frame_key += len(self)
+            if not 0 <= frame_key < len(self):
+                raise IndexError(f"Frame {frame_key} out of range for {len(self)} frames")
+            return self._read(frame_key, rows, cols)
+
+        ## Multiple frames: either another lazy stack or the requested region
+        sub = FrameStack._subset(self, np.arange(len(self))[frame_key])
+        if not region:
+            return sub
+
+        return np.stack([sub._read(i, rows, cols) for i in range(len(sub))])
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._read(i)
+
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:, :, :]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+    def readRows(self, r0, r1, out=None):
+        """
+        Read rows r0:r1 of every frame in the stack into a single array.
+
+            Parameters:
+                r0 (int): First row to read
+                r1 (int): Row to stop reading at
+                out (arr): Optional (N, r1-r0, 1024) buffer to fill
+
+            Returns:
+                out (arr): The requested rows of every frame
+        """
+
+        if out is None:
+            out = np.empty((len(self),r1-r0,self.X_DIM),dtype=self.dtype)
+
+        ## Archives decode their chunks on a thread pool
+        if self._archive is not None:
+            self._archive.readRows(self._index, r0, r1, out=out)
+            if self.bias is not None:
+                bias = self.bias
+                if bias.ndim == 2 and bias.shape != (1,1):
+                    bias = bias[r0:r1]
+                subtractBias(out, bias)
+            return out
+
+        for i in range(len(self)):
+            self._read(i, slice(r0,r1), out=out[i])
+
+        return out
+
+
+    def between(self, t_start, t_end):
+        """
+        Select frames observed between two times.
+
+            Parameters:
+                t_start (float): Start time in seconds since the start of
+                                 the night, so frames after midnight are past
+                                 24h (see frameindex.nightTime)
+                t_end (float): End time in seconds, inclusive
+
+            Returns:
+                sub (FrameStack): Lazy stack of the frames in the window
+        """
+
+        if self.times is None:
+            raise ValueError(f"No frame times are known for {self.source}")
+
+        ## Frames are ordered in time, so binary search the window
+        start = np.searchsorted(self.times, t_start, side="left")
+        end   = np.searchsorted(self.times, t_end, side="right")
+
+        return self[start:end]
+
+
+def _asFrameStack(frames, num_frames=-1, bias=None):
+    """
+    Accept either a frame directory or an existing FrameStack. A bias is
+    applied to a stack without one; a stack with its own bias raises.
+    """
+
+    from archive import findArchive
+
+    if isinstance(frames, FrameStack):
+        if bias is not None:
+            if frames.bias is not None:
+                raise ValueError("Frames are already bias subtracted; pass the bias to only one of them")
+            frames = FrameStack._subset(frames, slice(None))
+            frames.bias = asBias(bias, frames.bitdepth, frames.layout)
+        return frames if num_frames == -1 else frames[:num_frames]
+
+    ## Sanitize inputs
+    if not os.path.isdir(frames) and findArchive(frames) is None:
+        raise NotADirectoryError(f"{frames} is not a valid directory")
+
+    return FrameStack(frames, num_frames, bias)
+
+
 ##############################
 ## Import Frames & Medstack
 ##############################
 
-def importFramesRAW(frame_dir,num_frames=-1,bias=np.zeros((1,1),dtype=np.uint16)):
+def importFramesRAW(frame_dir,num_frames=-1,bias=None,
+                    lazy=False,bitdepth=16,layout="msb"):
     """
     Reads in frames from .rcd files starting at a specific frame
     
         Parameters:
             frame_dir (str/Path): path to image directory to read in
             num_frames (int): How many frames to read in. -1 if all
-            bias (arr): 2D array of fluxes from bias image
+            bias (arr/str): Master bias/dark frame, or a calibration
+                            directory to build one from (see calibration).
+                            Subtracted as frames are read, clipping at zero.
+            lazy (bool): Return a memory-mapped FrameStack instead of
+                         reading every frame into memory
+            bitdepth (int): 16, or 12 for packed 12-bit frames
+            layout (str): Packing layout of 12-bit frames (see bitconverter)
             
         Returns:
             img_array (arr): Image data
             img_times (arr): Header times of these images
     """
     
+    from archive import findArchive
+
     ## Sanitize inputs
-    if not os.path.isdir(frame_dir):
+    archived = not os.path.isdir(frame_dir) and findArchive(frame_dir) is not None
+    if not os.path.isdir(frame_dir) and not archived:
         raise NotADirectoryError(f"{frame_dir} is not a valid directory")
 
+    ## Defer all reading to the memory-mapped stack
+    if lazy:
+        return FrameStack(frame_dir,num_frames,bias,bitdepth=bitdepth,layout=layout)
+
+    ## Archives are decoded a chunk at a time, straight into the array
+    if archived:
+        stack   = FrameStack(frame_dir,num_frames,bias)
+        img_arr = stack.readRows(0, stack.Y_DIM)
+        return img_arr[0] if len(stack) == 1 else img_arr
+
     ## Define pixel dimensions of the rectangular image and depth of the memory array
     X_DIM   = 1024
     Y_DIM   = 768
+    bias    = asBias(bias, bitdepth, layout)
+    index   = buildFrameIndex(frame_dir)
     if num_frames == -1:
-        num_frames = len(os.listdir(frame_dir))
+        num_frames = len(index)
     img_arr = np.zeros((num_frames,Y_DIM,X_DIM),dtype=np.uint16) 
 
-    ## Loop which iteratively reads in the files and processes them
+    ## Loop which iteratively reads in the files (in time order) and processes them
     frame = 0
-    for fname in os.listdir(frame_dir):
-        # Check if we exceed the requested frames
-        if frame >= num_frames:
-            break
-        
-        if fname.lower().endswith(".raw"):
-            # Load in the image data substitute into the array
-            fpath = os.path.join(frame_dir,fname)
-            img_arr[frame] = np.subtract(readRAW(fpath), bias, dtype=np.uint16)
-        
+    if bitdepth == 16:
+        for fpath in index["path"][:num_frames]:
+            # Read the image data straight into the array and calibrate it
+            # while it's still in cache
+            with open(fpath,"rb") as f:
+                if f.readinto(img_arr[frame]) != img_arr[frame].nbytes:
+                    raise ValueError(f"{fpath} is not a 16-bit {X_DIM}x{Y_DIM} frame")
+            if bias is not None:
+                subtractBias(img_arr[frame], bias)
+            
             # Add 1 to the current frame
             frame += 1
+
+    ## Packed frames are read in batches and unpacked straight into the array
+    elif bitdepth == 12:
+        BATCH  = 64
+        packed = np.empty((min(BATCH,num_frames),Y_DIM*X_DIM*3//2),dtype=np.uint8)
+        paths  = index["path"][:num_frames]
+        for start in range(0, len(paths), BATCH):
+            batch = paths[start:start+BATCH]
+            for k, fpath in enumerate(batch):
+                with open(fpath,"rb") as f:
+                    if f.readinto(packed[k]) != packed.shape[1]:
+                        raise ValueError(f"{fpath} is not a packed 12-bit {X_DIM}x{Y_DIM} frame")
+
+            frames = img_arr[start:start+len(batch)]
+            unpack12(packed[:len(batch)], out=frames, layout=layout)
+            if bias is not None:
+                subtractBias(frames, bias)
+            frame += len(batch)
+
+    else:
+        raise NotImplementedError("Only 12-bit packed and 16-bit frames are currently supported")
         
     
     ## Check if only one frame was called: if so, ndim=3 -> ndim=2
@@ -169,47 +578,357 @@ def importFramesRAW(frame_dir,num_frames=-1,bias=np.zeros((1,1),dtype=np.uint16)
 
         
         
+def _stageTiles(frames, tile_rows, max_bytes):
+    """
+    Copy an archived stack into an unnamed scratch file laid out tile by
+    tile. Archives decode whole chunks of frames, so reading them a tile at
+    a time would decode every chunk once per tile; staging decodes each
+    chunk once, a batch of whole frames at a time.
+
+        Parameters:
+            frames (FrameStack): Archived stack of frames
+            tile_rows (int): Rows in every tile
+            max_bytes (int/float): Memory budget for a batch of whole frames
+
+        Returns:
+            staged (memmap): (num_tiles, N, tile_rows, 1024) frame rows. The
+                             last tile may be padded.
+    """
+
+    import tempfile
+
+    num_tiles   = -(-frames.Y_DIM//tile_rows)
+    frame_bytes = frames.Y_DIM*frames.X_DIM*frames.dtype.itemsize
+    batch       = int(max(1, max_bytes//frame_bytes))
+
+    staged = np.memmap(tempfile.TemporaryFile(), dtype=frames.dtype, mode="w+",
+                       shape=(num_tiles,len(frames),tile_rows,frames.X_DIM))
+    for f0 in range(0, len(frames), batch):
+        f1    = min(f0+batch, len(frames))
+        block = frames[f0:f1].readRows(0, frames.Y_DIM)
+        for t in range(num_tiles):
+            r0, r1 = t*tile_rows, min((t+1)*tile_rows, frames.Y_DIM)
+            staged[t,f0:f1,:r1-r0] = block[:,r0:r1]
+
+    return staged
+
+
+def _iterTiles(frames, max_bytes=None):
+    """
+    Walk a stack of frames in row tiles, so that at most max_bytes of frame
+    data are held in memory at once. The tile buffer is reused between
+    tiles, so callers may modify each tile in place. Frame files are mapped,
+    so each tile only pages in its own rows; archived stacks are staged
+    (see _stageTiles) so their chunks are only decoded once.
+
+        Parameters:
+            frames (FrameStack): Stack of frames to walk
+            max_bytes (int/float): Memory budget for a tile of frame data.
+                                   None reads the whole stack as one tile.
+
+        Yields:
+            r0, r1 (int): Row range of the tile
+            tile (arr): (N, r1-r0, 1024) rows of every frame
+    """
+
+    ## Work out how many rows of every frame fit in the memory budget
+    row_bytes = len(frames)*frames.X_DIM*frames.dtype.itemsize
+    if max_bytes is None:
+        tile_rows = frames.Y_DIM
+    else:
+        tile_rows = int(max(1, min(frames.Y_DIM, max_bytes//max(row_bytes,1))))
+
+    staged = None
+    if frames._archive is not None and tile_rows < frames.Y_DIM:
+        staged = _stageTiles(frames, tile_rows, max_bytes)
+
+    tile_buf = np.empty((len(frames),tile_rows,frames.X_DIM),dtype=frames.dtype)
+    for t, r0 in enumerate(range(0, frames.Y_DIM, tile_rows)):
+        r1 = min(r0+tile_rows, frames.Y_DIM)
+        if staged is None:
+            yield r0, r1, frames.readRows(r0, r1, out=tile_buf[:,:r1-r0])
+        else:
+            tile_buf[:,:r1-r0] = staged[t,:,:r1-r0]
+            yield r0, r1, tile_buf[:,:r1-r0]
+
+
+def tiledPercentile(frames, percentile=50, max_bytes=None):
+    """
+    Percentile combine a stack of frames by walking it in row tiles, so that
+    at most max_bytes of frame data are held in memory at once. Each pixel's
+    percentile only depends on its own column through the stack, so the
+    result is identical to reducing the whole stack in one go.
+
+        Parameters:
+            frames (FrameStack): Stack of frames to combine
+            percentile (float): Percentile to take. 50 is the median.
+            max_bytes (int/float): Memory budget for a tile of frame data.
+                                   None reads the whole stack as one tile.
+
+        Returns:
+            combined_img (arr): Percentile combined image as uint16
+    """
+
+    combined_img = np.empty((frames.Y_DIM,frames.X_DIM),dtype=np.uint16)
+
+    ## The tile buffer is reused, so the reduction may partition it in place
+    for r0, r1, tile in _iterTiles(frames, max_bytes):
+        with instrument.stage("analyzeframes.median", read=tile.nbytes):
+            if percentile == 50:
+                combined_img[r0:r1] = np.median(tile, axis=0, overwrite_input=True)
+            else:
+                combined_img[r0:r1] = np.percentile(tile, percentile, axis=0,
+                                                    overwrite_input=True)
+
+    return combined_img
+
+
+##############################
+## Single-Pass Multi-Statistic Stacking
+##############################
+
+STACK_STATS = ("mean","max","min","std","saturated","median")
+
+class RunningStack:
+    """
+    Streaming reducer which accumulates several statistics of a stack of
+    frames while seeing each frame only once.
+
+        Parameters:
+            stats (iterable): Statistics to accumulate. Any of "mean", "max",
+                              "min", "std" and "saturated". "median" needs
+                              the whole stack and is handled by combineImages.
+            saturation (int): Pixel value at or above which a pixel is
+                              counted as saturated
+
+        Usage:
+            running = RunningStack(("mean","std"))
+            for frame in frames:
+                running.update(frame)
+            images = running.result()
+    """
+
+    def __init__(self, stats=("mean","max"), saturation=np.iinfo(np.uint16).max):
+
+        ## Sanitize inputs
+        self.stats = tuple(stats)
+        for stat in self.stats:
+            if stat not in STACK_STATS or stat == "median":
+                raise NotImplementedError(f"{stat} is not a streamable statistic")
+
+        self.saturation = saturation
+        self.count      = 0
+
+
+    def _start(self, frame):
+        """
+        Allocate the accumulators from the shape of the first frame.
+        """
+
+        if "mean" in self.stats:
+            self._sum = np.zeros(frame.shape, dtype=np.uint64)
+        if "max" in self.stats:
+            self._max = np.array(frame, dtype=np.uint16)
+        if "min" in self.stats:
+            self._min = np.array(frame, dtype=np.uint16)
+        if "std" in self.stats:
+            self._mean  = np.zeros(frame.shape, dtype=np.float64)
+            self._m2    = np.zeros(frame.shape, dtype=np.float64)
+            self._delta = np.empty(frame.shape, dtype=np.float64)
+        if "saturated" in self.stats:
+            self._saturated = np.zeros(frame.shape, dtype=np.uint32)
+
+
+    def update(self, frame):
+        """
+        Add one frame to every accumulator.
+        """
+
+        if self.count == 0:
+            self._start(frame)
+        self.count += 1
+
+        with instrument.stage("analyzeframes.RunningStack.update", frames=1):
+            self._accumulate(frame)
+
+
+    def _accumulate(self, frame):
+        if "mean" in self.stats:
+            np.add(self._sum, frame, out=self._sum)
+        if "max" in self.stats:
+            np.maximum(self._max, frame, out=self._max)
+        if "min" in self.stats:
+            np.minimum(self._min, frame, out=self._min)
+        if "std" in self.stats:
+            # Welford's update: delta against the old and new running mean
+            np.subtract(frame, self._mean, out=self._delta)
+            self._mean += self._delta/self.count
+            self._delta *= frame - self._mean
+            self._m2 += self._delta
+        if "saturated" in self.stats:
+            self._saturated += (frame >= self.saturation)
+
+
+    def result(self):
+        """
+        Return the accumulated statistics.
+
+            Returns:
+                images (dict): Image for each requested statistic. mean, max
+                               and min are uint16, std is float64 and
+                               saturated is a per-pixel uint32 count.
+        """
+
+        if self.count == 0:
+            raise ValueError("No frames have been added to the stack")
+
+        images = {}
+        if "mean" in self.stats:
+            images["mean"] = (self._sum/self.count).astype(np.uint16)
+        if "max" in self.stats:
+            images["max"] = self._max.copy()
+        if "min" in self.stats:
+            images["min"] = self._min.copy()
+        if "std" in self.stats:
+            images["std"] = np.sqrt(self._m2/self.count)
+        if "saturated" in self.stats:
+            images["saturated"] = self._saturated.copy()
+
+        return images
+
+
+def writePNG16(img, save_path):
+    """
+    Save an image as a 16-bit greyscale png, clipping it to the uint16 range.
+
+        Parameters:
+            img (arr): 2D image
+            save_path (str): Filename to save the image as
+    """
+
+    if not str(save_path).lower().endswith(".png"):
+        raise NotImplementedError("Only .png filenames are permitted")
+
+    if img.dtype != np.uint16:
+        img = np.clip(np.rint(img), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+    with instrument.stage("analyzeframes.writePNG16", frames=1) as st,\
+         open(save_path,"wb") as f:
+        writer = png.Writer(width=img.shape[1],
+                            height=img.shape[0],
+                            bitdepth=16,
+                            greyscale=True)
+        writer.write(f,img)
+        st.add(written=f.tell())
+
+
+def combineImages(frame_dir,
+                  stats=("median","mean","max"),
+                  save_path=None,
+                  num_frames=-1,
+                  bias=None,
+                  saturation=np.iinfo(np.uint16).max,
+                  max_bytes=None):
+    """
+    Combine a stack of frames into several statistics images in a single
+    pass over the frames. Without "median" every frame is streamed through a
+    RunningStack once. With "median" the stack is walked in row tiles and
+    the other statistics are accumulated from the same tiles.
+
+        Parameters:
+            frame_dir (str/Path): Directory of images to be stacked, or a
+                                  FrameStack
+            stats (iterable): Any of "mean", "max", "min", "std",
+                              "saturated" and "median"
+            save_path (str/dict): Filename template containing "{stat}" (eg.
+                                  "20221102_{stat}.png") or a dict of
+                                  filenames per statistic. None to not save.
+            num_frames (int): Number of images to combine
+            bias (arr/str): Master bias/dark frame, or a calibration directory
+            saturation (int): Pixel value counted as saturated
+            max_bytes (int/float): Memory budget for the median tiles
+
+        Returns:
+            images (dict): Combined image for each requested statistic
+    """
+
+    ## Sanitize inputs and lazily index the stack of .raw images
+    stats = tuple(stats)
+    for stat in stats:
+        if stat not in STACK_STATS:
+            raise NotImplementedError(f"{stat} is not one of {STACK_STATS}")
+    streamed = tuple(stat for stat in stats if stat != "median")
+    RAW_imgs = _asFrameStack(frame_dir,num_frames,bias)
+
+    ## Stream every frame once when no median is required
+    if "median" not in stats:
+        running = RunningStack(streamed,saturation)
+        for frame in RAW_imgs:
+            running.update(frame)
+        images = running.result()
+
+    ## Otherwise accumulate everything from the median's row tiles
+    else:
+        images = {"median": np.empty((RAW_imgs.Y_DIM,RAW_imgs.X_DIM),dtype=np.uint16)}
+        for r0, r1, tile in _iterTiles(RAW_imgs, max_bytes):
+            if streamed:
+                running = RunningStack(streamed,saturation)
+                for frame in tile:
+                    running.update(frame)
+                for stat, tile_img in running.result().items():
+                    if stat not in images:
+                        images[stat] = np.empty((RAW_imgs.Y_DIM,RAW_imgs.X_DIM),
+                                                dtype=tile_img.dtype)
+                    images[stat][r0:r1] = tile_img
+
+            with instrument.stage("analyzeframes.median", read=tile.nbytes):
+                images["median"][r0:r1] = np.median(tile, axis=0, overwrite_input=True)
+
+    ## Save the images as pngs if requested
+    if save_path != None:
+        for stat in stats:
+            if isinstance(save_path, dict):
+                if stat in save_path:
+                    writePNG16(images[stat], save_path[stat])
+            else:
+                writePNG16(images[stat], str(save_path).format(stat=stat))
+
+    return {stat: images[stat] for stat in stats}
+
+
 def stackImages(frame_dir,
                 save_path=None,
                 num_frames=-1,
-                bias=None):
+                bias=None,
+                percentile=50,
+                max_bytes=None):
     """
     Make median combined image of first numImages in a directory
     
         Parameters:
-            frame_dir (str/Path): Directory of images to be stacked
+            frame_dir (str/Path): Directory of images to be stacked, or a
+                                  FrameStack
             save_path (str): Filename to save stacked image as
             num_frames (int): Number of images to combine
-            bias (arr): 2D flux array from the bias image
+            bias (arr/str): Master bias/dark frame, or a calibration directory
+            percentile (float): Percentile to combine with. 50 is the median.
+            max_bytes (int/float): Memory budget for the frame data, eg. 2e9.
+                                   The stack is combined in row tiles that
+                                   fit the budget. None for no limit.
             
         Returns:
             median_img (arr): Median combined, bias-subtracted image
     """
 
-    ## Sanitize inputs
-    if not os.path.isdir(frame_dir):
-        raise NotADirectoryError(f"{frame_dir} is not a valid directory")
+    ## Sanitize inputs and lazily index the stack of .raw images
+    RAW_imgs = _asFrameStack(frame_dir,num_frames,bias)
     
-    ## Read in stack of .raw images and median combine them
-    if bias == None:
-        RAW_imgs = importFramesRAW(frame_dir,num_frames)
-        median_img = np.median(RAW_imgs, axis=0).astype(np.uint16)
-    else:
-        RAW_imgs = importFramesRAW(frame_dir,num_frames,bias)
-        median_img = np.median(RAW_imgs, axis=0).astype(np.uint16)
+    ## Median combine the stack of .raw images, a tile of rows at a time
+    median_img = tiledPercentile(RAW_imgs,percentile,max_bytes)
         
     ## Save the image as a png if requested
     if save_path != None:
-        if save_path.lower().endswith(".png"):
-            with open(save_path,"wb") as f:
-                    writer = png.Writer(width=median_img.shape[1], 
-                                        height=median_img.shape[0],
-                                        bitdepth=16,
-                                        greyscale=True)
-                    writer.write(f,median_img)
-        else:
-            raise NotImplementedError("Only .png filenames are permitted")
-        
+        writePNG16(median_img,save_path)
     
     return median_img
 
@@ -219,44 +938,23 @@ def meanedImages(frame_dir,
                 num_frames=-1,
                 bias=None):
     """
-    Make mean combined image of first numImages in a directory
+    Make mean combined image of first numImages in a directory. See
+    combineImages to get several statistics from one pass.
     
         Parameters:
-            frame_dir (str/Path): Directory of images to be stacked
+            frame_dir (str/Path): Directory of images to be stacked, or a
+                                  FrameStack
             save_path (str): Filename to save stacked image as
             num_frames (int): Number of images to combine
-            bias (arr): 2D flux array from the bias image
+            bias (arr/str): Master bias/dark frame, or a calibration directory
             
         Returns:
-            median_img (arr): Median combined, bias-subtracted image
+            mean_img (arr): Mean combined, bias-subtracted image
     """
 
-    ## Sanitize inputs
-    if not os.path.isdir(frame_dir):
-        raise NotADirectoryError(f"{frame_dir} is not a valid directory")
-    
-    ## Read in stack of .raw images and median combine them
-    if bias == None:
-        RAW_imgs = importFramesRAW(frame_dir,num_frames)
-        median_img = np.mean(RAW_imgs, axis=0).astype(np.uint16)
-    else:
-        RAW_imgs = importFramesRAW(frame_dir,num_frames,bias)
-        median_img = np.mean(RAW_imgs, axis=0).astype(np.uint16)
-        
-    ## Save the image as a png if requested
-    if save_path != None:
-        if save_path.lower().endswith(".png"):
-            with open(save_path,"wb") as f:
-                    writer = png.Writer(width=median_img.shape[1], 
-                                        height=median_img.shape[0],
-                                        bitdepth=16,
-                                        greyscale=True)
-                    writer.write(f,median_img)
-        else:
-            raise NotImplementedError("Only .png filenames are permitted")
-        
-    
-    return median_img
+    return combineImages(frame_dir,("mean",),
+                         None if save_path == None else {"mean": save_path},
+                         num_frames,bias)["mean"]
 
 
 def maxedImages(frame_dir,
@@ -264,42 +962,20 @@ def maxedImages(frame_dir,
                 num_frames=-1,
                 bias=None):
     """
-    Make max-combined image of first numImages in a directory
+    Make max-combined image of first numImages in a directory. See
+    combineImages to get several statistics from one pass.
     
         Parameters:
-            frame_dir (str/Path): Directory of images to be stacked
+            frame_dir (str/Path): Directory of images to be stacked, or a
+                                  FrameStack
             save_path (str): Filename to save stacked image as
             num_frames (int): Number of images to combine
-            bias (arr): 2D flux array from the bias image
+            bias (arr/str): Master bias/dark frame, or a calibration directory
             
         Returns:
-            median_img (arr): Median combined, bias-subtracted image
+            max_img (arr): Max combined, bias-subtracted image
     """
 
-    ## Sanitize inputs
-    if not os.path.isdir(frame_dir):
-        raise NotADirectoryError(f"{frame_dir} is not a valid directory")
-    
-    ## Read in stack of .raw images and median combine them
-    if bias == None:
-        RAW_imgs = importFramesRAW(frame_dir,num_frames)
-        median_img = np.max(RAW_imgs, axis=0).astype(np.uint16)
-    else:
-        RAW_imgs = importFramesRAW(frame_dir,num_frames,bias)
-        median_img = np.max(RAW_imgs, axis=0).astype(np.uint16)
-        
-    ## Save the image as a png if requested
-    if save_path != None:
-        if save_path.lower().endswith(".png"):
-            with open(save_path,"wb") as f:
-                    writer = png.Writer(width=median_img.shape[1], 
-                                        height=median_img.shape[0],
-                                        bitdepth=16,
-                                        greyscale=True)
-                    writer.write(f,median_img)
-        else:
-            raise NotImplementedError("Only .png filenames are permitted")
-        
-    
-    return median_img
-    
\ No newline at end of file
+    return combineImages(frame_dir,("max",),
+                         None if save_path == None else {"max": save_path},
+                         num_frames,bias)["max"]
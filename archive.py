@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   archive.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 20:04:37 2026
+Updated:    Sat Oct 17 20:04:37 2026
+
+Usage: python3 archive.py NIGHT_DIR [ARCHIVE] [WORKERS]   (archive a night)
+       python3 archive.py ARCHIVE OUTPUT_DIR [WORKERS]    (extract .raw files)
+Description: losslessly compressed archives of a night's frames (.rawz), in
+             independently compressed chunks of frames with an index at the
+             end for random access. Chunks are encoded and decoded on a
+             thread pool.
+"""
+
+# Module Imports
+import os,sys
+import zlib
+import struct
+import threading
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+## Custom Script Imports
+import instrument
+
+
+##############################
+## File Layout
+##############################
+
+## A .rawz file is
+##   header | chunk 0 | chunk 1 | ... | frame table | chunk table | trailer
+## Each chunk is a run of consecutive frames, filtered and compressed on its
+## own, so any frame can be decoded by reading just its chunk. The trailer
+## at the end of the file points at the tables.
+ARCHIVE_SUFFIX = ".rawz"
+ARCHIVE_MAGIC  = b"FLIRRAWZ"
+INDEX_MAGIC    = b"RAWZINDX"
+VERSION        = 1
+
+## magic, version, width, height, codec, chunk frames, night (YYYYMMDD)
+HEADER  = struct.Struct("<8sHHHHH8s")
+## frame table offset, chunk table offset, frames, chunks, magic
+TRAILER = struct.Struct("<QQII8s")
+
+## One row per frame: time in seconds since the start of the night (see
+## buildFrameIndex) and the original filename. The name field is as wide as
+## the longest name, which readers get from the size of the frame table.
+def frameDtype(name_len):
+    return np.dtype([("time","<f8"), ("name",f"S{max(name_len,1)}")])
+## One row per chunk: where it is, which frames it holds, and its filter
+CHUNK_DTYPE = np.dtype([("offset","<u8"), ("length","<u8"), ("first","<u4"),
+                        ("count","<u4"), ("filter","u1")])
+
+## Codecs, with zstandard used when it's installed
+CODECS = {"zlib": 0, "zstd": 1}
+
+## Chunk filters
+##   delta  : the first frame is differenced along its rows, later frames
+##            against the frame before, then zigzag encoded so small steps
+##            either way are small numbers, and split into low and high
+##            byte planes (the high plane is nearly all zeros)
+##   pack12 : frames packed to 12 bits (see bitconverter). Used instead of
+##            delta for frames too noisy to difference well.
+FILTERS = {"delta": 0, "pack12": 1}
+
+
+def _defaultCodec():
+    try:
+        import zstandard
+        return "zstd"
+    except ImportError:
+        return "zlib"
+
+
+def _compressor(codec, level):
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress
+    return lambda data: zlib.compress(data, level)
+
+
+def _decompressor(codec):
+    if codec == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading this archive needs the zstandard module")
+        return lambda data, size: zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    return lambda data, size: zlib.decompress(data, bufsize=size)
+
+
+##############################
+## Chunk Filters
+##############################
+
+def _deltaEncode(frames):
+    """
+    Filter a (N, height, width) uint16 chunk for compression.
+    """
+
+    delta = np.empty_like(frames)
+    delta[0,:,0]  = frames[0,:,0]
+    np.subtract(frames[0,:,1:], frames[0,:,:-1], out=delta[0,:,1:])
+    np.subtract(frames[1:], frames[:-1], out=delta[1:])
+
+    # Zigzag: 0, -1, 1, -2, ... -> 0, 1, 2, 3, ...
+    signed = delta.view(np.int16)
+    zigzag = (signed << 1) ^ (signed >> 15)
+
+    return zigzag.view(np.uint8).reshape(-1,2).T.copy()
+
+
+def _deltaDecode(planes, shape):
+    """
+    Undo _deltaEncode. uint16 sums wrap around just as the differences did.
+    """
+
+    zigzag = np.empty(shape, dtype=np.uint16)
+    zigzag.view(np.uint8).reshape(-1,2).T[...] = planes.reshape(2,-1)
+
+    delta  = (zigzag >> 1) ^ -(zigzag & 1)
+    np.cumsum(delta[0], axis=1, dtype=np.uint16, out=delta[0])
+    np.cumsum(delta, axis=0, dtype=np.uint16, out=delta)
+
+    return delta
+
+
+def encodeChunk(frames, compress, filter="auto"):
+    """
+    Filter and compress a chunk of frames.
+
+        Parameters:
+            frames (arr): (N, height, width) uint16 frames
+            compress (func): Compressor of the archive's codec
+            filter (str): One of FILTERS, or "auto" to also try 12-bit
+                          packing when delta encoding doesn't get below the
+                          packed size
+
+        Returns:
+            filter_id (int): Filter used
+            data (bytes): Compressed chunk
+    """
+
+    from bitconverter import pack12
+
+    frames = np.ascontiguousarray(frames, dtype=np.uint16)
+    with instrument.stage("archive.encode", frames=len(frames), read=frames.nbytes) as st:
+        if filter in ("auto","delta"):
+            best = (FILTERS["delta"], compress(_deltaEncode(frames)))
+        if filter in ("auto","pack12") and (filter == "pack12" or len(best[1]) > frames.nbytes*3//4):
+            if frames.max() < 4096:
+                packed = (FILTERS["pack12"], compress(pack12(frames)))
+                if filter == "pack12" or len(packed[1]) < len(best[1]):
+                    best = packed
+            elif filter == "pack12":
+                raise ValueError("Frames with values above 4095 can't be packed to 12 bits")
+        st.add(written=len(best[1]))
+
+    return best
+
+
+def decodeChunk(data, filter_id, shape, decompress):
+    """
+    Decompress and unfilter a chunk of frames.
+
+        Parameters:
+            data (bytes): Compressed chunk
+            filter_id (int): Filter it was encoded with
+            shape (tuple): (N, height, width) of the chunk
+            decompress (func): Decompressor of the archive's codec
+
+        Returns:
+            frames (arr): (N, height, width) uint16 frames
+    """
+
+    from bitconverter import unpack12
+
+    pixels = int(np.prod(shape))
+    with instrument.stage("archive.decode", frames=shape[0], read=len(data),
+                          written=pixels*2):
+        if filter_id == FILTERS["delta"]:
+            raw = decompress(data, pixels*2)
+            return _deltaDecode(np.frombuffer(raw, dtype=np.uint8), shape)
+        elif filter_id == FILTERS["pack12"]:
+            # The unpacking kernels need a writable buffer
+            raw = bytearray(decompress(data, pixels*3//2))
+            return unpack12(np.frombuffer(raw, dtype=np.uint8), shape=shape[1:])
+        raise ValueError(f"Unknown chunk filter {filter_id}")
+
+
+##############################
+## Writing Archives
+##############################
+
+class ArchiveWriter:
+    """
+    Write frames into a .rawz archive. Full chunks are compressed on a
+    thread pool while later frames are added, and written in order. The
+    archive is written to a temporary file and moved into place on close.
+
+        Parameters:
+            save_path (str): Path of the archive
+            night (str): YYYYMMDD of the night
+            codec (str): "zlib" or "zstd". None uses zstd if it's installed.
+            level (int): Compression level. None for the codec's fast level.
+            chunk_frames (int): Frames per chunk. Larger chunks compress a
+                                little better; smaller ones decode less for
+                                a single frame.
+            filter (str): Chunk filter (see encodeChunk)
+            workers (int): Encoding threads. None uses every core.
+            shape (tuple): (height, width) of the frames
+    """
+
+    def __init__(self, save_path, night, codec=None, level=None, chunk_frames=16,
+                 filter="auto", workers=None, shape=(768,1024)):
+
+        self.save_path    = str(save_path)
+        self.night        = night
+        self.codec        = codec or _defaultCodec()
+        self.chunk_frames = chunk_frames
+        self.filter       = filter
+        self.shape        = tuple(shape)
+        if self.codec not in CODECS:
+            raise NotImplementedError(f"Only {tuple(CODECS)} codecs are supported")
+        self._compress = _compressor(self.codec, level if level is not None else
+                                     (3 if self.codec == "zstd" else 1))
+
+        self._tmp_path = f"{self.save_path}.{os.getpid()}.tmp"
+        self._f        = open(self._tmp_path, "wb")
+        self._f.write(HEADER.pack(ARCHIVE_MAGIC, VERSION, self.shape[1], self.shape[0],
+                                  CODECS[self.codec], chunk_frames, night.encode()))
+
+        # Chunks may be packed on the pool's threads
+        from bitconverter import compileKernels
+        compileKernels()
+        self._workers = workers or os.cpu_count()
+        self._pool    = ThreadPoolExecutor(self._workers)
+        self._pending = deque()
+        self._buffer  = np.empty((chunk_frames,) + self.shape, dtype=np.uint16)
+        self._count   = 0
+        self.frames   = []
+        self.chunks   = []
+
+
+    def write(self, frame, time, name=""):
+        """
+        Add the next frame.
+
+            Parameters:
+                frame (arr): (height, width) frame
+                time (float): Seconds since the start of the night
+                name (str): Original filename, eg. hh_mm_ss_fff.raw
+        """
+
+        self._buffer[self._count] = frame
+        self.frames.append((time, name.encode()))
+        self._count += 1
+        if self._count == self.chunk_frames:
+            self._submit()
+
+
+    def _submit(self):
+        chunk = self._buffer[:self._count].copy()
+        self._pending.append((len(self.frames) - self._count, self._count,
+                              self._pool.submit(encodeChunk, chunk, self._compress, self.filter)))
+        self._count = 0
+
+        # Bound the chunks in flight, writing out finished ones in order
+        while len(self._pending) > 2*self._workers or\
+              (self._pending and self._pending[0][2].done()):
+            self._flushOne()
+
+
+    def _flushOne(self):
+        first, count, future = self._pending.popleft()
+        filter_id, data = future.result()
+        self.chunks.append((self._f.tell(), len(data), first, count, filter_id))
+        self._f.write(data)
+
+
+    def close(self):
+        """
+        Write the last chunk and the index, and move the archive into place.
+        """
+
+        if self._f is None:
+            return
+        if self._count:
+            self._submit()
+        while self._pending:
+            self._flushOne()
+        self._pool.shutdown()
+
+        name_len = max((len(name) for _, name in self.frames), default=1)
+        frames   = np.array(self.frames, dtype=frameDtype(name_len))
+        chunks = np.array(self.chunks, dtype=CHUNK_DTYPE)
+        frame_offset = self._f.tell()
+        self._f.write(frames.tobytes())
+        chunk_offset = self._f.tell()
+        self._f.write(chunks.tobytes())
+        self._f.write(TRAILER.pack(frame_offset, chunk_offset, len(frames), len(chunks),
+                                   INDEX_MAGIC))
+        self._f.close()
+        self._f = None
+        os.replace(self._tmp_path, self.save_path)
+
+
+    def abort(self):
+        if self._f is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._f.close()
+            self._f = None
+            os.remove(self._tmp_path)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def archiveNight(night_dir, save_path=None, bitdepth=16, layout="msb",
+                 workers=None, **writer_args):
+    """
+    Compress a night directory of .raw frames into a single archive.
+
+        Parameters:
+            night_dir (str): Night directory. Assumes the first 8 characters
+                             are YYYYMMDD.
+            save_path (str): Path of the archive. Defaults to the night
+                             directory with a .rawz extension beside it.
+            bitdepth (int): 16, or 12 for packed 12-bit frames
+            layout (str): Packing layout of 12-bit frames
+            workers (int): Encoding threads. None uses every core.
+            **writer_args: Passed on to ArchiveWriter (codec, level,
+                           chunk_frames, filter)
+
+        Returns:
+            save_path (str): Path of the archive
+    """
+
+    from analyzeframes import FrameStack
+
+    ## Sanitize inputs
+    night_dir = os.path.normpath(str(night_dir))
+    night     = os.path.basename(night_dir)[:8]
+    if not (len(night) == 8 and night.isdigit()):
+        raise ValueError(f"{night_dir} needs to have YYYYMMDD as the first 8 characters")
+    save_path = save_path or archivePath(night_dir)
+
+    stack = FrameStack(night_dir, bitdepth=bitdepth, layout=layout)
+    names = [os.path.basename(path) for path in stack.paths]
+    with ArchiveWriter(save_path, night, workers=workers, **writer_args) as writer:
+        for i, frame in enumerate(stack):
+            writer.write(frame, stack.times[i], names[i])
+
+    return save_path
+
+
+##############################
+## Reading Archives
+##############################
+
+class ArchiveReader:
+    """
+    Random access to the frames of a .rawz archive. Decoded chunks are kept
+    in a small cache, so reading consecutive frames decodes each chunk once.
+    Decoded frames are read-only.
+
+        Parameters:
+            archive_path (str): Path of the archive
+            cache_chunks (int): Decoded chunks to keep
+            workers (int): Decoding threads for multi-chunk reads. None uses
+                           every core.
+    """
+
+    def __init__(self, archive_path, cache_chunks=4, workers=None):
+
+        self.path = str(archive_path)
+        self._fd  = os.open(self.path, os.O_RDONLY)
+        try:
+            size = os.fstat(self._fd).st_size
+            magic, version, width, height, codec, chunk_frames, night =\
+                HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+            frame_offset, chunk_offset, num_frames, num_chunks, index_magic =\
+                TRAILER.unpack(os.pread(self._fd, TRAILER.size, size - TRAILER.size))
+            if magic != ARCHIVE_MAGIC or index_magic != INDEX_MAGIC:
+                raise ValueError(f"{self.path} is not a complete {ARCHIVE_SUFFIX} archive")
+            if version > VERSION:
+                raise ValueError(f"{self.path} is a newer version ({version}) of the format")
+        except (struct.error, OSError):
+            os.close(self._fd)
+            raise ValueError(f"{self.path} is not a {ARCHIVE_SUFFIX} archive")
+
+        self.shape  = (height, width)
+        self.night  = night.decode()
+        self.codec  = {num: name for name, num in CODECS.items()}[codec]
+        frame_dtype = frameDtype((chunk_offset - frame_offset)//max(num_frames,1) - 8)
+        self.frames = np.frombuffer(os.pread(self._fd, num_frames*frame_dtype.itemsize,
+                                             frame_offset), dtype=frame_dtype)
+        self.chunks = np.frombuffer(os.pread(self._fd, num_chunks*CHUNK_DTYPE.itemsize,
+                                             chunk_offset), dtype=CHUNK_DTYPE)
+        self.times  = self.frames["time"]
+        self.names  = np.char.decode(self.frames["name"])
+
+        ## Chunk of every frame, and where it sits in the chunk
+        self._chunk_of = np.repeat(np.arange(num_chunks), self.chunks["count"])
+        self._offset   = np.arange(num_frames) - self.chunks["first"][self._chunk_of]
+
+        # Chunks may be unpacked on a thread pool
+        if np.any(self.chunks["filter"] == FILTERS["pack12"]):
+            from bitconverter import compileKernels
+            compileKernels()
+
+        self._decompress   = _decompressor(self.codec)
+        self._cache        = OrderedDict()
+        self._cache_chunks = cache_chunks
+        self._lock         = threading.Lock()
+        self._workers      = workers or os.cpu_count()
+
+
+    def __len__(self):
+        return len(self.frames)
+
+
+    def chunk(self, c):
+        """
+        Decoded (N, height, width) frames of chunk c.
+        """
+
+        with self._lock:
+            if c in self._cache:
+                self._cache.move_to_end(c)
+                return self._cache[c]
+
+        offset, length, first, count, filter_id = self.chunks[c].tolist()
+        data   = os.pread(self._fd, length, offset)
+        frames = decodeChunk(data, filter_id, (count,) + self.shape, self._decompress)
+        frames.flags.writeable = False
+
+        with self._lock:
+            self._cache[c] = frames
+            while len(self._cache) > self._cache_chunks:
+                self._cache.popitem(last=False)
+
+        return frames
+
+
+    def frame(self, i):
+        """
+        Read-only (height, width) frame i.
+        """
+
+        if i < 0:
+            i += len(self)
+        return self.chunk(self._chunk_of[i])[self._offset[i]]
+
+
+    def index(self, name):
+        """
+        Position of a frame from its original filename.
+        """
+
+        found = np.flatnonzero(self.names == name)
+        if len(found) == 0:
+            raise FileNotFoundError(f"{name} is not in {self.path}")
+        return int(found[0])
+
+
+    def readRows(self, indices, r0=0, r1=None, out=None):
+        """
+        Rows r0:r1 of several frames, decoding their chunks on a thread pool.
+
+            Parameters:
+                indices (arr): Positions of the frames
+                r0, r1 (int): Rows to read. Defaults to every row.
+                out (arr): Optional (len(indices), r1-r0, width) buffer
+
+            Returns:
+                out (arr): The rows of every frame
+        """
+
+        indices = np.asarray(indices, dtype=np.int64)
+        r1      = self.shape[0] if r1 is None else r1
+        if out is None:
+            out = np.empty((len(indices), r1-r0, self.shape[1]), dtype=np.uint16)
+
+        ## Each chunk is decoded once, by whichever thread takes it
+        wanted = self._chunk_of[indices]
+        def fill(c):
+            frames = self.chunk(c)
+            mask   = wanted == c
+            out[mask] = frames[self._offset[indices[mask]], r0:r1]
+
+        chunks = np.unique(wanted)
+        if len(chunks) == 1 or self._workers == 1:
+            for c in chunks:
+                fill(c)
+        else:
+            with ThreadPoolExecutor(min(self._workers, len(chunks))) as pool:
+                list(pool.map(fill, chunks))
+
+        return out
+
+
+    def __iter__(self):
+        """
+        Frames in order, decoding a few chunks ahead on a thread pool.
+        """
+
+        with ThreadPoolExecutor(self._workers) as pool:
+            ahead = deque()
+            for c in range(len(self.chunks)):
+                ahead.append(pool.submit(self.chunk, c))
+                if len(ahead) > self._workers:
+                    yield from ahead.popleft().result()
+            while ahead:
+                yield from ahead.popleft().result()
+
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def archivePath(night_dir):
+    """
+    Archive a night directory is compressed to, beside the directory.
+    """
+
+    return os.path.normpath(str(night_dir)) + ARCHIVE_SUFFIX
+
+
+def findArchive(source):
+    """
+    The archive holding a source, if there is one: either the archive
+    itself, or a night directory which has been replaced by its archive.
+    """
+
+    source = str(source)
+    if source.lower().endswith(ARCHIVE_SUFFIX) and os.path.isfile(source):
+        return source
+    if not os.path.isdir(source) and os.path.isfile(archivePath(source)):
+        return archivePath(source)
+
+    return None
+
+
+@lru_cache(maxsize=8)
+def _openArchive(archive_path, mtime_ns):
+    return ArchiveReader(archive_path)
+
+
+def archivedFrame(img_path):
+    """
+    Read NIGHT_DIR/hh_mm_ss_fff.raw out of NIGHT_DIR.rawz, for frames whose
+    night has been archived.
+
+        Parameters:
+            img_path (str): Path the .raw frame had
+
+        Returns:
+            img_data (arr): (768,1024) uint16 frame
+
+        Raises:
+            FileNotFoundError: If there's no such archived frame either
+    """
+
+    archive_path = archivePath(os.path.dirname(os.path.abspath(str(img_path))))
+    if not os.path.isfile(archive_path):
+        raise FileNotFoundError(f"{img_path} does not exist")
+
+    reader = _openArchive(archive_path, os.stat(archive_path).st_mtime_ns)
+    return np.array(reader.frame(reader.index(os.path.basename(str(img_path)))))
+
+
+def extractArchive(archive_path, output_dir, bitdepth=16, layout="msb", workers=None):
+    """
+    Write an archive's frames back out as .raw files.
+
+        Parameters:
+            archive_path (str): Path of the archive
+            output_dir (str): Directory for the frames
+            bitdepth (int): 16, or 12 to write packed 12-bit frames
+            layout (str): Packing layout of 12-bit frames
+            workers (int): Decoding threads. None uses every core.
+
+        Returns:
+            num_frames (int): Number of frames written
+    """
+
+    from bitconverter import pack12
+
+    os.makedirs(output_dir, exist_ok=True)
+    with ArchiveReader(archive_path, workers=workers) as reader:
+        for name, frame in zip(reader.names, reader):
+            data = frame if bitdepth == 16 else pack12(np.ascontiguousarray(frame), layout=layout)
+            data.tofile(os.path.join(output_dir, name))
+
+    return len(reader)
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 1:
+        print("Usage: python3 archive.py NIGHT_DIR [ARCHIVE] [WORKERS]\n"
+              "       python3 archive.py ARCHIVE OUTPUT_DIR [WORKERS]")
+        sys.exit()
+
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    ## Extract an archive
+    if os.path.isfile(sys.argv[1]):
+        if len(sys.argv) < 3:
+            sys.exit("An output directory is needed to extract an archive")
+        num_frames = extractArchive(sys.argv[1], sys.argv[2], workers=workers)
+        print(f"Extracted {num_frames} frames to {sys.argv[2]}")
+
+    ## Archive a night
+    elif os.path.isdir(sys.argv[1]):
+        save_path = archiveNight(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None,
+                                 workers=workers)
+        raw_bytes = sum(entry.stat().st_size for entry in os.scandir(sys.argv[1])
+                        if entry.name.lower().endswith(".raw"))
+        print(f"Wrote {save_path}: {os.path.getsize(save_path)/1e6:.1f} MB from "
+              f"{raw_bytes/1e6:.1f} MB of frames")
+
+    else:
+        sys.exit(f"{sys.argv[1]} is not a directory or archive")
@@ -12,95 +12,536 @@ $Description$
 """
 
 import sys,os
-import cv2 #TODO: opencv has a conflict which causes png to write a blank file
 #import png
+import json
+import time
+import hashlib
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
+from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+## Custom Script Imports
+import instrument
 
 
 ##############################
 ## Function to Mask Image
 ##############################
 
+def _apertureKey(shape, center, radius):
+    # Hashable, canonical arguments for the caches, so a list or array center
+    # works and equal apertures share an entry
+    shape = tuple(int(n) for n in tuple(shape)[-2:])
+    if center is not None:
+        center = tuple(float(c) for c in center)
+    if radius is not None:
+        radius = float(radius)
+    return shape, center, radius
+
+
+@lru_cache(maxsize=32)
+def _apertureMask(shape, center, radius):
+
+    ## Default to the largest circle centred on the image
+    if center is None:
+        center = (shape[1]//2, shape[0]//2)
+    if radius is None:
+        radius = min(shape)//2
+
+    ## Fill the circle using the squared distance of every pixel
+    yy, xx = np.ogrid[:shape[0],:shape[1]]
+    mask   = (xx - center[0])**2 + (yy - center[1])**2 <= radius**2
+    mask.flags.writeable = False
+
+    return mask
+
+
+@lru_cache(maxsize=32)
+def _apertureIndices(shape, center, radius):
+
+    indices = np.flatnonzero(_apertureMask(shape, center, radius))
+    indices.flags.writeable = False
+
+    return indices
+
+
+def apertureMask(shape, center=None, radius=None):
+    """
+    Boolean mask of a circular aperture, built once per (shape, center,
+    radius) and cached. Meant for FLIR Blackfly aperture.
+
+        Parameters:
+            shape (tuple): (height, width) of the image
+            center (tuple): (x, y) pixel center of the aperture. Defaults to
+                            the image center.
+            radius (float): Radius of the aperture in pixels. Defaults to
+                            half the smaller image dimension.
+
+        Returns:
+            mask (arr): Read-only boolean array, True inside the aperture
+    """
+
+    return _apertureMask(*_apertureKey(shape, center, radius))
+
+
+def apertureIndices(shape, center=None, radius=None):
+    """
+    Flat pixel indices inside a circular aperture, so later statistics can
+    skip the dead corners entirely, eg. frames.reshape(N,-1)[:,indices].
+
+        Parameters:
+            shape, center, radius: See apertureMask
+
+        Returns:
+            indices (arr): Read-only flat indices of the in-aperture pixels
+    """
+
+    return _apertureIndices(*_apertureKey(shape, center, radius))
+
+
+def applyMask(images, center=None, radius=None, inplace=True):
+    """
+    Zero everything outside the circular aperture of an image or of a whole
+    stack of images at once.
+
+        Parameters:
+            images (arr): 2D image or (N, height, width) stack
+            center, radius: See apertureMask
+            inplace (bool): Mask images in place, otherwise on a copy
+
+        Returns:
+            images (arr): The masked image(s)
+    """
+
+    mask = apertureMask(images.shape[-2:], center, radius)
+    with instrument.stage("astrometry.applyMask", frames=images.size//mask.size,
+                          read=images.nbytes):
+        if not inplace:
+            images = images.copy()
+
+        ## The 2D mask broadcasts over every image in the stack
+        np.multiply(images, mask, out=images, casting="unsafe")
+
+    return images
+
+
 def circularMask(img_path, save_path=None):
     """
     Add a circular mask to the image. Meant for FLIR Blackfly aperture.
     
         Parameters:
-            img_path (str): Path to the image
+            img_path (str): Path to the image, either a png or a .raw frame
             save_path (str): Path for the output solution header
 
         Returns:
-            None
+            masked_img (arr): The masked 16-bit image
     """
     
-    ## Load in the image
-    image = cv2.imread(img_path,0).astype(np.uint16)
-    
-    ## Create the circular mask (assumes 16-bit image)
-    mask = np.zeros(image.shape, dtype=np.uint16)
-    mask = cv2.circle(mask, 
-                      (image.shape[1]//2,image.shape[0]//2),
-                      min(image.shape)//2, 
-                      (255,255,255), 
-                      -1)
-    
+    import cv2 #TODO: opencv has a conflict which causes png to write a blank file
+
+    ## Load in the image, keeping its full bitdepth
+    image = _loadImage(img_path)
+
     ## Generate masked image
-    masked_img = cv2.bitwise_and(image, mask)
+    masked_img = applyMask(image.astype(np.uint16))
     
     ## Decide to either show the image in a plt window or save as PNG
     if save_path == None:
+        import matplotlib.pyplot as plt
         plt.imshow(masked_img,cmap="gray")
         plt.show()
     elif save_path.lower().endswith(".png"):
-        """
-        with open(save_path,'wb') as f:
-            writer = png.Writer(width=masked_img.shape[1],
-                                height=masked_img.shape[0],
-                                bitdepth=16,
-                                greyscale=True)
-            writer.write(f,masked_img)
-        """
         cv2.imwrite(save_path,masked_img)
     else:
         print("TypeError: Can only save as a png file!")
         return
 
+    return masked_img
+
 
 ##############################
 ## Call Astrometry.net
 ##############################
 
-def astrometrySoln(img_path, save_path, soln_order):
+## Service endpoint and account key, overridable so tests can point at a
+## local stand-in solver
+ASTROMETRY_URL = os.environ.get("ASTROMETRY_NET_URL", "http://nova.astrometry.net")
+ASTROMETRY_KEY = os.environ.get("ASTROMETRY_NET_API_KEY", "ibeszekxrtnatxdl") #key for Peter Quigley's account
+
+## Solutions are cached by image content and solve parameters
+WCS_CACHE_DIR  = os.environ.get("FLIR_WCS_CACHE",
+                                os.path.join(os.path.expanduser("~"),".cache","flir-blackfly","wcs"))
+
+
+def solveCacheKey(img_path, **params):
+    """
+    Key a solution by the image's content and the parameters of the solve,
+    so renamed or copied frames still hit the cache.
+
+        Parameters:
+            img_path (str): Path to the image
+            **params: Solve parameters (order, endpoint, ...)
+
+        Returns:
+            key (str): Hex digest
+    """
+
+    digest = hashlib.sha256()
+    with open(img_path,"rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            digest.update(block)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+
+    return digest.hexdigest()
+
+
+def astrometrySoln(img_path, save_path, soln_order, endpoint=None, api_key=None,
+                   cache_dir=WCS_CACHE_DIR, retries=3):
     """
     Attempt to solve a given image's astrometry using nova.astrometry.net
     Credit to Michael Mazur and Rachel Brown for the script template
     
         Parameters:
             img_path (str): Path to the image
-            save_path (str): Path for the output solution header
+            save_path (str): Path for the output solution header. None to
+                             not save one.
             soln_order (int): Order of the solution
+            endpoint (str): URL of the astrometry.net service. Defaults to
+                            ASTROMETRY_URL.
+            api_key (str): Key for the service. Defaults to ASTROMETRY_KEY.
+            cache_dir (str): Directory of cached solutions. None to always
+                             solve.
+            retries (int): Attempts at the service before giving up
         
         Returns:
-            wcs_header (?): The solution header returned from astrometry.net
+            wcs_header (Header): The solution header returned from
+                                 astrometry.net, or from the cache
     """
 
-    from astroquery.astrometry_net import AstrometryNet
-    
-    #astrometry.net API
-    ast = AstrometryNet()
-    
-    #key for astrometry.net account
-    ast.api_key = 'ibeszekxrtnatxdl'    #key for Peter Quigley's account
-    wcs_header = ast.solve_from_image(img_path, crpix_center = True, tweak_order = soln_order, force_image_upload=True)
+    from astropy.io import fits
+
+    endpoint = endpoint or ASTROMETRY_URL
+    api_key  = api_key or ASTROMETRY_KEY
+
+    ## Look for an earlier solve of the same image with the same parameters
+    cache_path = None
+    if cache_dir is not None:
+        key        = solveCacheKey(img_path, tweak_order=soln_order,
+                                   crpix_center=True, endpoint=endpoint)
+        cache_path = os.path.join(cache_dir, key + ".fits")
+    if cache_path is not None and os.path.exists(cache_path):
+        wcs_header = fits.Header.fromfile(cache_path)
+
+    else:
+        from astroquery.astrometry_net import AstrometryNet
+        
+        #astrometry.net API
+        ast = AstrometryNet()
+        ast.URL     = endpoint.rstrip("/")
+        ast.API_URL = ast.URL + "/api"
+        
+        #key for astrometry.net account
+        ast.api_key = api_key
+
+        #retry failures talking to the service, backing off between tries
+        with instrument.stage("astrometry.solve_from_image", frames=1):
+            for attempt in range(retries):
+                try:
+                    wcs_header = ast.solve_from_image(img_path, crpix_center = True, tweak_order = soln_order, force_image_upload=True)
+                    break
+                except Exception as err:
+                    if attempt == retries - 1:
+                        raise
+                    print(f"Solve of {img_path} failed ({err}), retrying")
+                    time.sleep(2**attempt)
+
+        #cache successful solutions, written whole so readers never see a partial file
+        if wcs_header and cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            wcs_header.tofile(tmp_path, overwrite=True)
+            os.replace(tmp_path, cache_path)
 
     #save solution to file
-    if not save_path.exists():
+    if save_path is not None and wcs_header and not Path(save_path).exists():
             wcs_header.tofile(save_path)
             
     return wcs_header
 
 
+def astrometrySolnBatch(img_paths, save_dir, soln_order, workers=4, **solve_args):
+    """
+    Solve many images concurrently through a bounded thread pool. Each solve
+    goes through astrometrySoln, so cached images are never resubmitted.
+    
+        Parameters:
+            img_paths (list): Paths to the images
+            save_dir (str): Directory for the solution headers, named after
+                            each image with a .wcs extension. None to not save.
+            soln_order (int): Order of the solutions
+            workers (int): Most solves in flight at once
+            **solve_args: Passed on to astrometrySoln (endpoint, api_key,
+                          cache_dir, retries)
+        
+        Returns:
+            solutions (dict): Header for each image path, or the exception
+                              if the image couldn't be solved
+    """
+
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+
+    def solve(img_path):
+        save_path = None
+        if save_dir is not None:
+            save_path = os.path.join(save_dir, Path(img_path).stem + ".wcs")
+        return astrometrySoln(img_path, save_path, soln_order, **solve_args)
+
+    solutions = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(solve, img_path): img_path for img_path in img_paths}
+        for future in as_completed(futures):
+            try:
+                solutions[futures[future]] = future.result()
+            except Exception as err:
+                solutions[futures[future]] = err
+
+    return solutions
+
+
+##############################
+## Local WCS Refinement
+##############################
+
+## The camera is on a fixed mount, so the sky turns under it about the
+## celestial pole. For a TAN projection that's a pure shift of CRVAL1 at the
+## sidereal rate, with the CD matrix unchanged.
+SIDEREAL_RATE = 360/86164.0905 #deg/s
+
+## One row per reference star
+CATALOG_DTYPE = np.dtype([("ra","f8"), ("dec","f8"), ("flux","f8")])
+
+
+def _asWCS(wcs_header):
+    """
+    Accept either a header or an astropy WCS, returning a WCS copy.
+    """
+
+    from astropy.wcs import WCS
+
+    if isinstance(wcs_header, WCS):
+        return wcs_header.deepcopy()
+    return WCS(wcs_header)
+
+
+def _loadImage(img):
+    """
+    Accept an image array, a .raw frame or a png, returning the array.
+    """
+
+    if not isinstance(img, (str, Path)):
+        return np.asarray(img)
+    img = str(img)
+    if img.lower().endswith(".raw"):
+        from analyzeframes import readRAW
+        return readRAW(img)
+
+    ## Single channel at the png's own bitdepth, as the raw frames are
+    import cv2
+    image = cv2.imread(img, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise FileNotFoundError(f"Could not read image {img}")
+    return image
+
+
+def buildReferenceCatalog(ref_img, ref_header, nsigma=5.0, max_sources=300):
+    """
+    Turn the stars of a solved image into a catalog of sky positions, to be
+    matched against later frames.
+
+        Parameters:
+            ref_img (arr/str): The solved image, or its path
+            ref_header (Header/WCS): Its solution, eg. from astrometrySoln
+            nsigma (float): Detection threshold of the stars
+            max_sources (int): Keep only the brightest stars
+
+        Returns:
+            catalog (arr): CATALOG_DTYPE array, brightest first
+    """
+
+    from sources import extractSources
+
+    wcs   = _asWCS(ref_header)
+    found = extractSources(applyMask(_loadImage(ref_img), inplace=False),
+                           nsigma, max_sources=max_sources)
+
+    catalog = np.empty(len(found), dtype=CATALOG_DTYPE)
+    catalog["ra"], catalog["dec"] = wcs.all_pix2world(found["x"], found["y"], 0)
+    catalog["flux"] = found["flux"]
+
+    return catalog
+
+
+def predictWCS(ref_header, elapsed):
+    """
+    Predict the solution of a frame taken some time after a solved one.
+
+        Parameters:
+            ref_header (Header/WCS): Solution of the reference frame
+            elapsed (float): Seconds since the reference frame
+
+        Returns:
+            wcs (WCS): Predicted solution
+    """
+
+    wcs = _asWCS(ref_header)
+    wcs.wcs.crval = [(wcs.wcs.crval[0] + SIDEREAL_RATE*elapsed) % 360, wcs.wcs.crval[1]]
+    wcs.wcs.set()
+
+    return wcs
+
+
+def _focalPlane(wcs, pix):
+    """
+    Pixel positions (0-based) relative to CRPIX with any SIP distortion
+    removed, ie. what the CD matrix acts on.
+    """
+
+    if wcs.sip is not None:
+        return wcs.sip_pix2foc(pix + 1, 1)
+    return pix + 1 - wcs.wcs.crpix
+
+
+def _updateWCS(wcs, cd, offset):
+    """
+    Apply a fitted linear model, imgcrd = cd @ foc + offset, to a WCS. The
+    offset moves the tangent point, so CRVAL becomes the sky position the
+    old solution gives that offset; CRPIX and the SIP terms stay put.
+    """
+
+    old_cd = wcs.pixel_scale_matrix
+    pix    = wcs.wcs.crpix + np.linalg.solve(old_cd, offset)
+    crval  = wcs.wcs.p2s(pix[None,:], 1)["world"][0]
+
+    new = wcs.deepcopy()
+    new.wcs.crval = crval
+    if new.wcs.has_cd():
+        new.wcs.cd = cd
+    else:
+        new.wcs.pc = cd/new.wcs.cdelt[:,None]
+    new.wcs.set()
+
+    return new
+
+
+@instrument.timed("astrometry.refineWCS")
+def refineWCS(img, ref_header, catalog, elapsed=0.0, match_radius=5.0,
+              nsigma=5.0, max_sources=500, iterations=3, clip=3.0, min_matches=6):
+    """
+    Solve a frame locally from an earlier solution instead of a blind solve.
+    The catalog is placed on the frame by the reference solution turned by
+    the elapsed sidereal time, matched to the frame's stars with a KD-tree,
+    and the CD matrix and tangent point refit by least squares. Runs offline.
+
+        Parameters:
+            img (arr/str): The frame, or its path
+            ref_header (Header/WCS): Solution of an earlier frame
+            catalog (arr): Reference stars from buildReferenceCatalog
+            elapsed (float): Seconds between the reference and this frame
+            match_radius (float): Largest catalog-star offset (pixels) matched
+            nsigma (float): Detection threshold of the frame's stars
+            max_sources (int): Brightest stars of the frame used for matching
+            iterations (int): Match and fit passes
+            clip (float): Drop matches with residuals beyond clip times the RMS
+            min_matches (int): Fewest matches needed for a fit
+
+        Returns:
+            wcs_header (Header): Refined solution, with NMATCH (stars fit)
+                                 and RMSPIX (residual RMS in pixels) added
+    """
+
+    from scipy.spatial import cKDTree
+    from sources import extractSources
+
+    wcs   = predictWCS(ref_header, elapsed)
+    found = extractSources(applyMask(_loadImage(img), inplace=False),
+                           nsigma, max_sources=max_sources)
+    if len(found) < min_matches:
+        raise ValueError(f"Only {len(found)} stars found, {min_matches} needed for a fit")
+
+    stars = np.column_stack((found["x"], found["y"]))
+    tree  = cKDTree(stars)
+    world = np.column_stack((catalog["ra"], catalog["dec"]))
+
+    for _ in range(iterations):
+
+        ## Match every catalog star to the nearest star at its predicted place
+        pred = wcs.all_world2pix(world, 0)
+        dist, nearest = tree.query(pred, distance_upper_bound=match_radius)
+        matched = np.flatnonzero(np.isfinite(dist))
+
+        # A frame star claimed by several catalog stars is ambiguous
+        claims  = np.bincount(nearest[matched], minlength=len(stars))
+        matched = matched[claims[nearest[matched]] == 1]
+
+        ## Fit imgcrd = cd @ foc + offset, clipping outliers once
+        foc    = _focalPlane(wcs, stars[nearest[matched]])
+        imgcrd = wcs.wcs.s2p(world[matched], 1)["imgcrd"]
+        design = np.column_stack((foc, np.ones(len(foc))))
+        for clip_pass in range(2):
+            if len(matched) < min_matches:
+                raise ValueError(f"Only {len(matched)} stars matched, {min_matches} needed for a fit")
+            coef  = np.linalg.lstsq(design, imgcrd, rcond=None)[0]
+            resid = np.linalg.solve(coef[:2].T, (design @ coef - imgcrd).T).T
+            rms   = np.sqrt(np.mean(np.sum(resid**2, axis=1)))
+            keep  = np.sum(resid**2, axis=1) <= (clip*max(rms,1e-3))**2
+            matched, foc, imgcrd, design = matched[keep], foc[keep], imgcrd[keep], design[keep]
+
+        wcs = _updateWCS(wcs, coef[:2].T, coef[2])
+
+    wcs_header = wcs.to_header(relax=True)
+    wcs_header["NMATCH"] = (len(matched), "Stars matched in the local refinement")
+    wcs_header["RMSPIX"] = (round(float(rms),4), "Residual RMS of the refinement (pixels)")
+
+    return wcs_header
+
+
+def refineFrames(frame_dir, ref_header, ref_time, catalog, **refine_args):
+    """
+    Locally solve every frame of a night, each from the last frame solved so
+    that slow drift of the mount is followed. Frames which can't be matched
+    are skipped.
+
+        Parameters:
+            frame_dir (str): Night directory of .raw frames
+            ref_header (Header/WCS): Solution of the reference frame
+            ref_time (float): Time of the reference frame (see buildFrameIndex)
+            catalog (arr): Reference stars from buildReferenceCatalog
+            **refine_args: Passed on to refineWCS
+
+        Yields:
+            frame_path (str): Path to the frame
+            wcs_header (Header): Its refined solution
+    """
+
+    from frameindex import buildFrameIndex
+
+    index = buildFrameIndex(frame_dir)
+    last_header, last_time = ref_header, ref_time
+    for frame_time, frame_path in zip(index["time"], index["path"]):
+        try:
+            wcs_header = refineWCS(frame_path, last_header, catalog,
+                                   frame_time - last_time, **refine_args)
+        except ValueError as err:
+            print(f"Could not refine {frame_path}: {err}")
+            continue
+
+        last_header, last_time = wcs_header, frame_time
+        yield frame_path, wcs_header
+
+
 ##############################
 ## Main
 ##############################
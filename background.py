@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   background.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 11:31:17 2026
+Updated:    Sat Oct 17 11:31:17 2026
+
+Usage: from background import RollingBackground, backgroundSubtracted
+Description: rolling-window background model for streaming frames, updated
+             incrementally as each frame arrives
+"""
+
+import numpy as np
+
+## Custom Script Imports
+from lazyjit import LazyKernel
+from frameindex import buildFrameIndex
+from analyzeframes import readRAW
+
+
+##############################
+## Sliding Median Kernels
+##############################
+
+## Each pixel keeps its last K values sorted in its own row of a (P, K)
+## window. A new frame replaces the oldest value by walking it to its place
+## in the row, so no row is ever re-sorted. Kernels are built from
+## factories taking the prange to loop with (see lazyjit).
+
+def _slideMedian(prange):
+    def kernel(window,old,new,median):
+        K = window.shape[1]
+        for p in prange(window.shape[0]):
+            o = old[p]
+            n = new[p]
+
+            # Binary search for the oldest value, then shift its neighbours
+            # over it until the new value fits
+            lo = 0
+            hi = K-1
+            while lo < hi:
+                mid = (lo+hi)//2
+                if window[p,mid] < o:
+                    lo = mid+1
+                else:
+                    hi = mid
+            i = lo
+            if n > o:
+                while i+1 < K and window[p,i+1] < n:
+                    window[p,i] = window[p,i+1]
+                    i += 1
+            else:
+                while i > 0 and window[p,i-1] > n:
+                    window[p,i] = window[p,i-1]
+                    i -= 1
+            window[p,i] = n
+
+            median[p] = (np.float32(window[p,(K-1)//2]) + np.float32(window[p,K//2]))/2
+    return kernel
+
+
+def _growMedian(prange):
+    def kernel(window,count,new,median):
+        for p in prange(window.shape[0]):
+            n = new[p]
+
+            # Insertion sort the new value into the filled part of the row
+            i = count
+            while i > 0 and window[p,i-1] > n:
+                window[p,i] = window[p,i-1]
+                i -= 1
+            window[p,i] = n
+
+            median[p] = (np.float32(window[p,count//2]) + np.float32(window[p,(count+1)//2]))/2
+    return kernel
+
+
+def _slideMedian_np(window,old,new,median):
+    rows = np.arange(window.shape[0])
+    window[rows,np.argmax(window == old[:,None], axis=1)] = new
+    window.sort(axis=1)
+    K = window.shape[1]
+    median[:] = (window[:,(K-1)//2].astype(np.float32) + window[:,K//2])/2
+
+
+def _growMedian_np(window,count,new,median):
+    window[:,count] = new
+    window[:,:count+1].sort(axis=1)
+    median[:] = (window[:,count//2].astype(np.float32) + window[:,(count+1)//2])/2
+
+
+##############################
+## Sigma-Clipped Mean Kernel
+##############################
+
+## The clipped mean keeps integer sums of the window and its squares, so
+## adding and dropping frames never accumulates rounding error.
+
+def _clipUpdate(prange):
+    def kernel(sums,sumsq,ring,new,n,full,nsigma,bg):
+        for p in prange(sums.shape[0]):
+            v = np.int64(new[p])
+
+            # Replace outliers against the current window by its mean
+            if n >= 3:
+                mean = sums[p]/n
+                var  = sumsq[p]/n - mean*mean
+                if var < 0:
+                    var = 0.0
+                if abs(v - mean) > nsigma*np.sqrt(var):
+                    v = np.int64(np.rint(mean))
+
+            if full:
+                old       = np.int64(ring[p])
+                sums[p]  -= old
+                sumsq[p] -= old*old
+            ring[p]   = v
+            sums[p]  += v
+            sumsq[p] += v*v
+            bg[p]     = sums[p]/(n if full else n+1)
+    return kernel
+
+
+def _clipUpdate_np(sums,sumsq,ring,new,n,full,nsigma,bg):
+    new = new.astype(np.int64)
+    if n >= 3:
+        mean = sums/n
+        std  = np.sqrt(np.maximum(sumsq/n - mean**2, 0))
+        new  = np.where(np.abs(new - mean) > nsigma*std, np.rint(mean), new).astype(np.int64)
+
+    if full:
+        old    = ring.astype(np.int64)
+        sums  -= old
+        sumsq -= old*old
+    ring[:] = new
+    sums   += new
+    sumsq  += new*new
+    np.divide(sums, n if full else n+1, out=bg, casting="unsafe")
+
+
+_SLIDE_MEDIAN = LazyKernel(_slideMedian, _slideMedian_np,
+                           "void(uint16[:,::1],uint16[::1],uint16[::1],float32[::1])")
+_GROW_MEDIAN  = LazyKernel(_growMedian, _growMedian_np,
+                           "void(uint16[:,::1],int64,uint16[::1],float32[::1])")
+_CLIP_UPDATE  = LazyKernel(_clipUpdate, _clipUpdate_np,
+                           "void(int64[::1],int64[::1],uint16[::1],uint16[::1],"
+                           "int64,boolean,float64,float32[::1])", fastmath=False)
+
+
+def compileKernels():
+    """
+    Compile the background kernels now (see LazyKernel.compile).
+    """
+
+    for kernel in (_SLIDE_MEDIAN, _GROW_MEDIAN, _CLIP_UPDATE):
+        kernel.compile()
+
+
+##############################
+## Rolling Background
+##############################
+
+class RollingBackground:
+    """
+    Background of the last K frames, updated incrementally per frame.
+
+        Parameters:
+            window (int): Number of frames K in the window
+            method (str): "median" for the window median, or "clipped" for
+                          a sigma-clipped window mean
+            nsigma (float): Clipping threshold of the "clipped" method
+            shape (tuple): Pixel shape of the frames
+
+        Methods:
+            "median"  : every pixel keeps its last K values in a sorted row.
+                        The oldest value is swapped for the new one by
+                        walking it into place, which is at most K compares
+                        and moves per pixel and never a sort.
+            "clipped" : running integer sums of the window, so each update
+                        is O(pixels). A new pixel more than nsigma from the
+                        current mean enters the window as the current mean
+                        instead, so stars and meteors don't leak in.
+    """
+
+    def __init__(self, window=25, method="median", nsigma=3.0, shape=(768,1024)):
+
+        ## Sanitize inputs
+        if method not in ("median","clipped"):
+            raise NotImplementedError("Only median and clipped backgrounds are supported")
+        if window < 1:
+            raise ValueError("The window needs at least one frame")
+
+        self.window = window
+        self.method = method
+        self.nsigma = nsigma
+        self.shape  = tuple(shape)
+        self.count  = 0
+
+        ## Ring buffer of the (clipped) frames in the window, to know what
+        ## leaves the window
+        pixels      = int(np.prod(self.shape))
+        self._ring  = np.zeros((window,pixels), dtype=np.uint16)
+        self._bg    = np.zeros(pixels, dtype=np.float32)
+        if method == "median":
+            self._sorted = np.zeros((pixels,window), dtype=np.uint16)
+        else:
+            self._sum   = np.zeros(pixels, dtype=np.int64)
+            self._sumsq = np.zeros(pixels, dtype=np.int64)
+
+
+    @property
+    def background(self):
+        """
+        Current background image (float32), or None before the first frame.
+        """
+
+        if self.count == 0:
+            return None
+        return self._bg.reshape(self.shape)
+
+
+    def update(self, frame):
+        """
+        Add a frame to the window, dropping the oldest frame once it's full.
+
+            Parameters:
+                frame (arr): uint16 frame
+        """
+
+        new  = np.ascontiguousarray(frame, dtype=np.uint16).reshape(-1)
+        slot = self.count % self.window
+        full = self.count >= self.window
+
+        if self.method == "median":
+            if full:
+                _SLIDE_MEDIAN(self._sorted, self._ring[slot], new, self._bg)
+            else:
+                _GROW_MEDIAN(self._sorted, self.count, new, self._bg)
+            self._ring[slot] = new
+
+        else:
+            _CLIP_UPDATE(self._sum, self._sumsq, self._ring[slot], new,
+                         min(self.count, self.window), full, self.nsigma, self._bg)
+
+        self.count += 1
+
+
+    def subtract(self, frames):
+        """
+        Background subtract a stream of frames. Each frame is compared to
+        the background of the frames before it, then added to the window.
+        The first frame has nothing before it and comes out as zeros.
+
+            Parameters:
+                frames (iterable): uint16 frames in time order
+
+            Yields:
+                residual (arr): float32 background-subtracted frame
+        """
+
+        for frame in frames:
+            if self.count == 0:
+                residual = np.zeros(self.shape, dtype=np.float32)
+            else:
+                residual = np.subtract(frame, self.background, dtype=np.float32)
+            self.update(frame)
+            yield residual
+
+
+def backgroundSubtracted(frame_dir, window=25, method="median", nsigma=3.0,
+                         bitdepth=16, layout="msb"):
+    """
+    Stream the frames of a night directory in time order with a rolling
+    background subtracted.
+
+        Parameters:
+            frame_dir (str/Path): Night directory of .raw frames
+            window (int): Number of frames in the background window
+            method (str): "median" or "clipped" (see RollingBackground)
+            nsigma (float): Clipping threshold of the "clipped" method
+            bitdepth (int): 16, or 12 for packed 12-bit frames
+            layout (str): Packing layout of 12-bit frames (see bitconverter)
+
+        Yields:
+            obs_time (float): Time of the frame (see buildFrameIndex)
+            residual (arr): float32 background-subtracted frame
+    """
+
+    index = buildFrameIndex(frame_dir)
+    model = RollingBackground(window, method, nsigma)
+    frames = (readRAW(fpath, bitdepth, layout) for fpath in index["path"])
+
+    for obs_time, residual in zip(index["time"], model.subtract(frames)):
+        yield obs_time, residual
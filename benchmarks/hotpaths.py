@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   hotpaths.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 18:31:44 2026
+Updated:    Sat Oct 17 18:31:44 2026
+
+Usage: python3 benchmarks/hotpaths.py [--frames N] [--repeat N] [--only NAME ...]
+                                      [--save OUT.json] [--baseline BASE.json]
+Description: generates synthetic 16-bit and packed 12-bit Blackfly nights and
+             times the hot paths (read, unpack, stacking, png, vid, masking)
+             on them, each in a fresh process, reporting frames/s, MB/s and
+             peak RSS as JSON
+"""
+
+import os,sys
+import io
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import numpy as np
+
+from startup import REPO_DIR, compareBaseline
+sys.path.insert(0, REPO_DIR)
+from instrument import peakRSS
+
+
+## Frames are generated to look like a night: 1024x768, 12-bit values
+X_DIM, Y_DIM = 1024, 768
+NIGHT        = "20221102"
+
+
+##############################
+## Synthetic Nights
+##############################
+
+def frameName(t):
+    """
+    hh_mm_ss_fff.raw name of a frame taken t seconds after midnight.
+    """
+
+    ms = int(round(t*1000)) % (24*3600*1000)
+    return f"{ms//3600000:02d}_{ms//60000%60:02d}_{ms//1000%60:02d}_{ms%1000:03d}.raw"
+
+
+def makeNight(save_dir, num_frames=100, bitdepth=16, layout="msb", fps=10.0,
+              start=22*3600.0, seed=0):
+    """
+    Write a synthetic night of .raw frames: a vignetted sky with stars, and
+    fresh noise in every frame.
+
+        Parameters:
+            save_dir (str): Night directory to create. Should start with
+                            YYYYMMDD.
+            num_frames (int): Number of frames
+            bitdepth (int): 16, or 12 for packed 12-bit frames
+            layout (str): Packing layout of 12-bit frames (see bitconverter)
+            fps (float): Frame rate, which sets the filename times
+            start (float): Time of the first frame in seconds after midnight
+            seed (int): Seed of the random sky and noise
+
+        Returns:
+            save_dir (str): The night directory
+    """
+
+    from bitconverter import pack12
+
+    os.makedirs(save_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    ## Sky: vignetted background inside the aperture, plus stars
+    yy, xx = np.mgrid[:Y_DIM,:X_DIM]
+    r2     = ((xx - X_DIM/2)**2 + (yy - Y_DIM/2)**2)/(Y_DIM/2)**2
+    sky    = np.where(r2 <= 1, 300 + 200*(1 - r2), 40)
+    for x, y, flux in zip(rng.uniform(0, X_DIM, 300), rng.uniform(0, Y_DIM, 300),
+                          rng.lognormal(6, 1, 300)):
+        sky += flux*np.exp(-((xx - x)**2 + (yy - y)**2)/4.5)
+    sky = np.clip(sky, 0, 4095 - 64).astype(np.uint16)
+
+    for i in range(num_frames):
+        frame = sky + rng.integers(0, 64, sky.shape, dtype=np.uint16)
+        data  = frame if bitdepth == 16 else pack12(frame, layout=layout)
+        data.tofile(os.path.join(save_dir, frameName(start + i/fps)))
+
+    return save_dir
+
+
+##############################
+## Hot Paths
+##############################
+
+## Each benchmark sets up from a night directory and a scratch directory,
+## and returns the callable to time with the frames and bytes it handles
+
+def _framePaths(night_dir):
+    from frameindex import buildFrameIndex
+    index = buildFrameIndex(night_dir, use_cache=False)
+    return index["path"], int(index["size"].sum())
+
+
+def benchRead(night_dir, work_dir, bitdepth=16, layout="msb"):
+    from analyzeframes import readRAW
+    paths, nbytes = _framePaths(night_dir)
+    return (lambda: [readRAW(path, bitdepth, layout) for path in paths]), len(paths), nbytes
+
+
+def benchUnpack(night_dir, work_dir, layout="msb"):
+    from bitconverter import unpack12
+    paths, nbytes = _framePaths(night_dir)
+    packed = np.concatenate([np.fromfile(path, dtype=np.uint8) for path in paths])
+    out    = np.empty((len(paths),Y_DIM,X_DIM), dtype=np.uint16)
+    return (lambda: unpack12(packed, out, layout=layout)), len(paths), nbytes
+
+
+def benchConv(night_dir, work_dir, layout="msb"):
+    # conv_12to16 only reads the msb layout, and its speed doesn't depend on
+    # the bytes, so the night's layout is left as is
+    from bitconverter import conv_12to16
+    paths, nbytes = _framePaths(night_dir)
+    frames = [np.fromfile(path, dtype=np.uint8) for path in paths]
+    return (lambda: [conv_12to16(frame) for frame in frames]), len(paths), nbytes
+
+
+def benchStack(night_dir, work_dir, stats=("median",), bitdepth=16, layout="msb"):
+    from analyzeframes import FrameStack, combineImages
+    paths, nbytes = _framePaths(night_dir)
+    return (lambda: combineImages(FrameStack(night_dir, bitdepth=bitdepth, layout=layout),
+                                  stats)),\
+           len(paths), nbytes
+
+
+def benchPNG(night_dir, work_dir):
+    from raw_img_reader import RAWtoPNG
+    paths, nbytes = _framePaths(night_dir)
+    save_paths = [os.path.join(work_dir, os.path.basename(path)[:-4] + ".png") for path in paths]
+    return (lambda: [RAWtoPNG(path, save_path) for path, save_path in zip(paths, save_paths)]),\
+           len(paths), nbytes
+
+
+def benchVID(night_dir, work_dir):
+    from raw_img_reader import RAWtoVID
+    paths, nbytes = _framePaths(night_dir)
+    save_path = os.path.join(work_dir, f"{NIGHT}.vid")
+    return (lambda: RAWtoVID(night_dir, save_path)), len(paths), nbytes
+
+
+def benchMask(night_dir, work_dir):
+    from analyzeframes import FrameStack
+    from astrometry import applyMask
+    frames = np.asarray(FrameStack(night_dir))
+    return (lambda: applyMask(frames)), len(frames), frames.nbytes
+
+
+## Name: (night, setup). Nights are "16" or "12" bit, and the setups of the
+## 12-bit night also take its packing layout.
+BENCHMARKS = {
+    "read16":          ("16", benchRead),
+    "read12":          ("12", lambda night, work, layout: benchRead(night, work, 12, layout)),
+    "unpack12":        ("12", benchUnpack),
+    "conv_12to16":     ("12", benchConv),
+    "stack_median":    ("16", benchStack),
+    "stack_median12":  ("12", lambda night, work, layout:
+                              benchStack(night, work, bitdepth=12, layout=layout)),
+    "stack_mean_max":  ("16", lambda night, work: benchStack(night, work, ("mean","max"))),
+    "png":             ("16", benchPNG),
+    "vid":             ("16", benchVID),
+    "mask":            ("16", benchMask),
+}
+
+
+##############################
+## Timing
+##############################
+
+def runBenchmark(name, night_dir, repeat=3, layout="msb"):
+    """
+    Time one benchmark in this process, after an untimed warm up run (which
+    loads the numba kernels and fills the page cache).
+
+        Parameters:
+            name (str): Key of BENCHMARKS
+            night_dir (str): Night directory of the benchmark's bitdepth
+            repeat (int): Number of timed runs
+            layout (str): Packing layout of the 12-bit night
+
+        Returns:
+            result (dict): Timings, throughput and peak RSS
+    """
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        night, setup = BENCHMARKS[name]
+        if night == "12":
+            run, frames, nbytes = setup(night_dir, work_dir, layout)
+        else:
+            run, frames, nbytes = setup(night_dir, work_dir)
+
+        times = []
+        for i in range(repeat + 1):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                run()
+            if i > 0:
+                times.append(time.perf_counter() - start)
+
+    times  = sorted(times)
+    median = times[len(times)//2]
+    return {"median_s": median, "min_s": times[0], "max_s": times[-1], "repeat": repeat,
+            "frames": frames, "frames_per_s": frames/median, "MB_per_s": nbytes/median/1e6,
+            "peak_rss_MB": peakRSS()/1e6}
+
+
+def timeBenchmark(name, night_dir, repeat=3, layout="msb"):
+    """
+    Run a benchmark in a fresh interpreter, so its peak RSS is its own.
+    """
+
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", name,
+                             "--night", night_dir, "--repeat", str(repeat),
+                             "--layout", layout],
+                            cwd=REPO_DIR, check=True, stdout=subprocess.PIPE, text=True).stdout
+
+    return json.loads(output)
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time the hot paths on synthetic nights")
+    parser.add_argument("--frames", type=int, default=100, help="frames in each synthetic night")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of each benchmark")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="benchmarks to run")
+    parser.add_argument("--layout", default="msb", help="packing layout of the 12-bit night")
+    parser.add_argument("--keep", help="generate the nights here and keep them")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed fractional slowdown against the baseline")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--night", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    ## Child process: run a single benchmark
+    if args.run:
+        print(json.dumps(runBenchmark(args.run, args.night, args.repeat, args.layout)))
+        sys.exit()
+
+    ## Generate the nights
+    top_dir = args.keep or tempfile.mkdtemp(prefix="flir-bench-")
+    nights  = {"16": os.path.join(top_dir, "16bit", NIGHT),
+               "12": os.path.join(top_dir, "12bit", NIGHT)}
+    for bits, night_dir in nights.items():
+        if not os.path.isdir(night_dir) or len(os.listdir(night_dir)) < args.frames:
+            makeNight(night_dir, args.frames, int(bits), args.layout)
+
+    try:
+        results = {}
+        for name in (args.only or BENCHMARKS):
+            results[name] = timeBenchmark(name, nights[BENCHMARKS[name][0]], args.repeat,
+                                          args.layout)
+            print(f"{name}: {results[name]['frames_per_s']:.1f} frames/s, "
+                  f"{results[name]['MB_per_s']:.1f} MB/s", file=sys.stderr)
+    finally:
+        if not args.keep:
+            shutil.rmtree(top_dir)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareBaseline(results, json.load(f).get("hotpaths", {}),
+                                          args.tolerance)
+
+    report = {"hotpaths": results, "frames": args.frames, "regressions": regressions}
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if regressions:
+        sys.exit(1)
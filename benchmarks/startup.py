@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   startup.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 10:21:08 2026
+Updated:    Sat Oct 17 10:21:08 2026
+
+Usage: python3 benchmarks/startup.py [--repeat N] [--save OUT.json] [--baseline BASE.json]
+Description: times the cold start of each CLI entry point (interpreter start
+             plus module import, and the first 12-bit unpack for the numba
+             kernels) in fresh processes, and reports it as JSON
+"""
+
+import os,sys
+import json
+import argparse
+import subprocess
+import time
+
+
+## Repository root, so the modules import no matter where this is run from
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## Snippets timed in a fresh interpreter for each entry point
+ENTRY_POINTS = {
+    "raw_img_reader": "import raw_img_reader",
+    "analyzeframes":  "import analyzeframes",
+    "astrometry":     "import astrometry",
+    "frameindex":     "import frameindex",
+    "bitconverter":   "import bitconverter",
+    "bitconverter.unpack12":
+        "import numpy as np, bitconverter;"
+        "bitconverter.unpack12(np.zeros(1024*768*3//2,dtype=np.uint8))",
+}
+
+
+##############################
+## Timing
+##############################
+
+def timeColdStart(snippet, repeat=5):
+    """
+    Time a snippet in fresh interpreters.
+
+        Parameters:
+            snippet (str): Python code to run with python3 -c
+            repeat (int): Number of fresh interpreters to time
+
+        Returns:
+            times (list): Wall time (s) of each run, including interpreter
+                          start up
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", snippet], cwd=REPO_DIR, check=True)
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def compareBaseline(results, baseline, tolerance=0.25):
+    """
+    Compare results to a stored baseline.
+
+        Parameters:
+            results (dict): Results of this run
+            baseline (dict): Results of an earlier run
+            tolerance (float): Allowed fractional slowdown of the median
+
+        Returns:
+            regressions (list): Names of entry points that got slower
+    """
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median_s"]/baseline[name]["median_s"]
+        result["vs_baseline"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+
+    return regressions
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time cold start of the CLI entry points")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per entry point")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed fractional slowdown against the baseline")
+    args = parser.parse_args()
+
+    ## Warm the numba cache first, so every timed run is a cached start
+    timeColdStart(ENTRY_POINTS["bitconverter.unpack12"], repeat=1)
+
+    results = {}
+    for name, snippet in ENTRY_POINTS.items():
+        times = sorted(timeColdStart(snippet, args.repeat))
+        results[name] = {"median_s": times[len(times)//2], "min_s": times[0],
+                         "max_s": times[-1], "repeat": args.repeat}
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareBaseline(results, json.load(f)["startup"], args.tolerance)
+
+    report = {"startup": results, "regressions": regressions}
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if regressions:
+        sys.exit(1)
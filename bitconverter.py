@@ -1,19 +1,22 @@
 """
-Filename:      
+Filename:   bitconverter.py
 Author(s):  Peter Quigley
 Contact:    pquigley@uwo.ca
 Created:    Thu Oct  6 20:29:46 2022
-Updated:    Thu Oct  6 20:29:46 2022
+Updated:    Sat Oct 17 10:02:31 2026
     
 Usage:
 $Description$
 """
 
-import numba as nb
 import numpy as np
 
+## Custom Script Imports
+import instrument
+from lazyjit import LazyKernel
+
+
 # Function to read 12-bit data with Numba to speed things up
-@nb.njit(nb.uint16[::1](nb.uint8[::1]),fastmath=True,parallel=True)
 def conv_12to16(data_chunk):
     """
     Function to read 12-bit data with Numba to speed things up
@@ -30,15 +33,206 @@ def conv_12to16(data_chunk):
     assert np.mod(data_chunk.shape[0],3)==0
 
     out=np.empty(data_chunk.shape[0]//3*2,dtype=np.uint16)
- #   image1 = np.empty((2048,2048),dtype=np.uint16)
- #   image2 = np.empty((2048,2048),dtype=np.uint16)
+    with instrument.stage("bitconverter.conv_12to16", read=data_chunk.nbytes, written=out.nbytes):
+        _KERNELS["unpack12_msb"](data_chunk,out)
+
+    return out
+
+
+
+##############################
+## Batched 12-bit Unpacking/Packing
+##############################
+
+## Bytes of a packed 12-bit frame hold 2 pixels in every 3 bytes
+##   "msb"     : (p0 >> 4), (p0 & 0xF) << 4 | (p1 >> 8), (p1 & 0xFF)
+##               ie. the layout read by conv_12to16
+##   "mono12p" : (p0 & 0xFF), (p1 & 0xF) << 4 | (p0 >> 8), (p1 >> 4)
+##               ie. LSB-first GenICam Mono12p used by Blackfly sensors
+LAYOUTS = ("msb","mono12p")
+
+## Kernels are built from factories taking the prange to loop with, and
+## compiled on first use (see lazyjit)
+
+def _unpack12_msb(prange):
+    def kernel(data_chunk,out):
+        for i in prange(data_chunk.shape[0]//3):
+            fst_uint8=np.uint16(data_chunk[i*3])
+            mid_uint8=np.uint16(data_chunk[i*3+1])
+            lst_uint8=np.uint16(data_chunk[i*3+2])
+
+            out[i*2]   = (fst_uint8 << 4) + (mid_uint8 >> 4)
+            out[i*2+1] = ((mid_uint8 % 16) << 8) + lst_uint8
+    return kernel
+
+
+def _unpack12_mono12p(prange):
+    def kernel(data_chunk,out):
+        for i in prange(data_chunk.shape[0]//3):
+            fst_uint8=np.uint16(data_chunk[i*3])
+            mid_uint8=np.uint16(data_chunk[i*3+1])
+            lst_uint8=np.uint16(data_chunk[i*3+2])
+
+            out[i*2]   = fst_uint8 + ((mid_uint8 % 16) << 8)
+            out[i*2+1] = (mid_uint8 >> 4) + (lst_uint8 << 4)
+    return kernel
+
+
+def _pack12_msb(prange):
+    def kernel(data_chunk,out):
+        for i in prange(data_chunk.shape[0]//2):
+            fst_uint16=data_chunk[i*2] & 0xFFF
+            lst_uint16=data_chunk[i*2+1] & 0xFFF
+
+            out[i*3]   = np.uint8(fst_uint16 >> 4)
+            out[i*3+1] = np.uint8(((fst_uint16 % 16) << 4) + (lst_uint16 >> 8))
+            out[i*3+2] = np.uint8(lst_uint16 & 0xFF)
+    return kernel
+
+
+def _pack12_mono12p(prange):
+    def kernel(data_chunk,out):
+        for i in prange(data_chunk.shape[0]//2):
+            fst_uint16=data_chunk[i*2] & 0xFFF
+            lst_uint16=data_chunk[i*2+1] & 0xFFF
+
+            out[i*3]   = np.uint8(fst_uint16 & 0xFF)
+            out[i*3+1] = np.uint8((fst_uint16 >> 8) + ((lst_uint16 % 16) << 4))
+            out[i*3+2] = np.uint8(lst_uint16 >> 4)
+    return kernel
+
+
+## Pure-NumPy versions of the kernels, for when numba isn't available
+def _unpack12_msb_np(data_chunk,out):
+    packed = data_chunk.reshape(-1,3).astype(np.uint16)
+    pairs  = out.reshape(-1,2)
+    pairs[:,0] = (packed[:,0] << 4) | (packed[:,1] >> 4)
+    pairs[:,1] = ((packed[:,1] & 0xF) << 8) | packed[:,2]
+
+
+def _unpack12_mono12p_np(data_chunk,out):
+    packed = data_chunk.reshape(-1,3).astype(np.uint16)
+    pairs  = out.reshape(-1,2)
+    pairs[:,0] = packed[:,0] | ((packed[:,1] & 0xF) << 8)
+    pairs[:,1] = (packed[:,1] >> 4) | (packed[:,2] << 4)
+
+
+def _pack12_msb_np(data_chunk,out):
+    pairs  = data_chunk.reshape(-1,2) & 0xFFF
+    packed = out.reshape(-1,3)
+    packed[:,0] = pairs[:,0] >> 4
+    packed[:,1] = ((pairs[:,0] & 0xF) << 4) | (pairs[:,1] >> 8)
+    packed[:,2] = pairs[:,1] & 0xFF
+
+
+def _pack12_mono12p_np(data_chunk,out):
+    pairs  = data_chunk.reshape(-1,2) & 0xFFF
+    packed = out.reshape(-1,3)
+    packed[:,0] = pairs[:,0] & 0xFF
+    packed[:,1] = (pairs[:,0] >> 8) | ((pairs[:,1] & 0xF) << 4)
+    packed[:,2] = pairs[:,1] >> 4
+
+
+_KERNELS = {
+    "unpack12_msb":     LazyKernel(_unpack12_msb, _unpack12_msb_np, "void(uint8[::1],uint16[::1])"),
+    "unpack12_mono12p": LazyKernel(_unpack12_mono12p, _unpack12_mono12p_np, "void(uint8[::1],uint16[::1])"),
+    "pack12_msb":       LazyKernel(_pack12_msb, _pack12_msb_np, "void(uint16[::1],uint8[::1])"),
+    "pack12_mono12p":   LazyKernel(_pack12_mono12p, _pack12_mono12p_np, "void(uint16[::1],uint8[::1])"),
+}
+
+
+def compileKernels(layout="msb"):
+    """
+    Compile the packing kernels of a layout now (see LazyKernel.compile).
+    """
+
+    for kind in ("unpack12","pack12"):
+        _KERNELS[f"{kind}_{layout}"].compile()
+
+
+def _flatView(arr,dtype,name):
+    """
+    Flat view of a C-contiguous buffer, so the kernels can write into it.
+    """
+
+    arr = np.asarray(arr)
+    if arr.dtype != dtype:
+        raise TypeError(f"{name} must be {np.dtype(dtype).name}, not {arr.dtype}")
+    if not arr.flags.c_contiguous:
+        raise ValueError(f"{name} must be C-contiguous")
+    return arr.reshape(-1)
+
+
+def unpack12(packed,out=None,shape=(768,1024),layout="msb"):
+    """
+    Unpack a batch of packed 12-bit frames into 16-bit frames.
+    
+        Parameters:
+            packed (arr): uint8 data of N packed frames, either flat or
+                          shaped (N, bytes per frame)
+            out (arr): Optional C-contiguous (N, *shape) uint16 buffer to
+                       unpack straight into
+            shape (tuple): Pixel shape of a single frame
+            layout (str): Packing layout, one of LAYOUTS
+   
+        Returns:
+            out (arr): (N, *shape) uint16 frames
+    """
+
+    ## Sanitize inputs
+    if layout not in LAYOUTS:
+        raise NotImplementedError(f"Only {LAYOUTS} 12-bit layouts are supported")
+    flat_in  = _flatView(packed,np.uint8,"packed")
+    pixels   = int(np.prod(shape))
+    if flat_in.shape[0] % (pixels*3//2) != 0:
+        raise ValueError(f"{flat_in.shape[0]} bytes is not a whole number of packed {shape} frames")
+    num_frames = flat_in.shape[0]//(pixels*3//2)
+
+    if out is None:
+        out = np.empty((num_frames,*shape),dtype=np.uint16)
+    flat_out = _flatView(out,np.uint16,"out")
+    if flat_out.shape[0] != num_frames*pixels:
+        raise ValueError(f"out holds {flat_out.shape[0]} pixels, not {num_frames*pixels}")
+
+    ## Unpack every frame in one parallel pass
+    with instrument.stage("bitconverter.unpack12", frames=num_frames,
+                          read=flat_in.nbytes, written=flat_out.nbytes):
+        _KERNELS[f"unpack12_{layout}"](flat_in,flat_out)
+
+    return out
+
+
+def pack12(frames,out=None,layout="msb"):
+    """
+    Pack 16-bit frames holding 12-bit data into the packed 12-bit format,
+    eg. for archiving. Only the low 12 bits of each pixel are kept.
+    
+        Parameters:
+            frames (arr): C-contiguous uint16 frames of any shape with an
+                          even number of pixels
+            out (arr): Optional flat uint8 buffer to pack into
+            layout (str): Packing layout, one of LAYOUTS
+   
+        Returns:
+            out (arr): Flat uint8 packed data
+    """
+
+    ## Sanitize inputs
+    if layout not in LAYOUTS:
+        raise NotImplementedError(f"Only {LAYOUTS} 12-bit layouts are supported")
+    flat_in = _flatView(frames,np.uint16,"frames")
+    if flat_in.shape[0] % 2 != 0:
+        raise ValueError("Can only pack an even number of pixels")
+
+    if out is None:
+        out = np.empty(flat_in.shape[0]//2*3,dtype=np.uint8)
+    flat_out = _flatView(out,np.uint8,"out")
+    if flat_out.shape[0] != flat_in.shape[0]//2*3:
+        raise ValueError(f"out holds {flat_out.shape[0]} bytes, not {flat_in.shape[0]//2*3}")
 
-    for i in nb.prange(data_chunk.shape[0]//3):
-        fst_uint8=np.uint16(data_chunk[i*3])
-        mid_uint8=np.uint16(data_chunk[i*3+1])
-        lst_uint8=np.uint16(data_chunk[i*3+2])
+    ## Pack every pixel pair in one parallel pass
+    with instrument.stage("bitconverter.pack12", read=flat_in.nbytes, written=flat_out.nbytes):
+        _KERNELS[f"pack12_{layout}"](flat_in,flat_out)
 
-        out[i*2] =   (fst_uint8 << 4) + (mid_uint8 >> 4)
-        out[i*2+1] = ((mid_uint8 % 16) << 8) + lst_uint8
+    return out
 
-    return out
\ No newline at end of file
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   calibration.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 16:58:20 2026
+Updated:    Sat Oct 17 16:58:20 2026
+
+Usage: python3 calibration.py CAL_DIR [OUTPUT_PNG]
+Description: builds master bias/dark frames from directories of calibration
+             frames, caches them on disk, and subtracts them from frames
+             without wrapping below zero
+"""
+
+# Module Imports
+import os,sys
+import json
+import hashlib
+import numpy as np
+
+## Custom Script Imports
+from frameindex import buildFrameIndex
+
+
+## Master frames are cached by the names, sizes and mtimes of their frames
+CAL_CACHE_DIR = os.environ.get("FLIR_CAL_CACHE",
+                               os.path.join(os.path.expanduser("~"),".cache","flir-blackfly","calibration"))
+
+
+##############################
+## Saturating Subtraction
+##############################
+
+def subtractBias(frames, bias):
+    """
+    Subtract a master frame in place, clipping at zero instead of wrapping
+    around. Works on a single frame or broadcasts over a stack.
+
+        Parameters:
+            frames (arr): uint16 frame(s), modified in place
+            bias (arr): uint16 master frame, or anything broadcastable
+
+        Returns:
+            frames (arr): The same array, calibrated
+    """
+
+    np.maximum(frames, bias, out=frames, casting="unsafe")
+    np.subtract(frames, bias, out=frames, casting="unsafe")
+
+    return frames
+
+
+##############################
+## Master Frames
+##############################
+
+def _fileHashes(paths):
+    """
+    sha256 of each file's content.
+    """
+
+    hashes = []
+    for path in paths:
+        digest = hashlib.sha256()
+        with open(path,"rb") as f:
+            for block in iter(lambda: f.read(1024*1024), b""):
+                digest.update(block)
+        hashes.append(digest.hexdigest())
+
+    return hashes
+
+
+def masterFrame(cal_dir, bitdepth=16, layout="msb", max_bytes=None,
+                cache_dir=CAL_CACHE_DIR, verify=False):
+    """
+    Median combine a directory of calibration frames into a master frame.
+    Masters are cached, keyed by the names, sizes and mtimes of the frames,
+    along with the content hash of every frame.
+
+        Parameters:
+            cal_dir (str): Directory of .raw calibration frames
+            bitdepth (int): 16, or 12 for packed 12-bit frames
+            layout (str): Packing layout of 12-bit frames (see bitconverter)
+            max_bytes (int/float): Memory budget for combining the frames
+                                   (see tiledPercentile)
+            cache_dir (str): Directory of cached masters. None to always
+                             rebuild.
+            verify (bool): Rehash the frames to check a cached master
+                           against their content too
+
+        Returns:
+            master (arr): (768,1024) uint16 master frame
+    """
+
+    from analyzeframes import FrameStack, tiledPercentile
+
+    index = buildFrameIndex(cal_dir)
+    if len(index) == 0:
+        raise ValueError(f"No .raw calibration frames in {cal_dir}")
+
+    ## Key the master by what its frames are on disk
+    stamps = [(os.path.basename(path), int(size), os.stat(path).st_mtime_ns)
+              for path, size in zip(index["path"], index["size"])]
+    key    = hashlib.sha256(json.dumps([os.path.abspath(cal_dir), bitdepth, layout, stamps]).encode())
+    cache_path = None if cache_dir is None else os.path.join(cache_dir, key.hexdigest() + ".npz")
+
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            master, hashes = cache["master"], cache["hashes"]
+        if not verify or list(hashes) == _fileHashes(index["path"]):
+            return master
+
+    ## Build the master from a median of the frames, a tile at a time
+    master = tiledPercentile(FrameStack(cal_dir, bitdepth=bitdepth, layout=layout),
+                             50, max_bytes)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, master=master, hashes=np.array(_fileHashes(index["path"])))
+        os.replace(tmp_path, cache_path)
+
+    return master
+
+
+def masterCalibration(cal_dir, **master_args):
+    """
+    The master frame to subtract for a night. A calibration directory holds
+    a dark/ or bias/ directory of frames, or is itself a directory of bias
+    frames. Darks taken at the science exposure already contain the bias,
+    so the master dark is used alone when there is one.
+
+        Parameters:
+            cal_dir (str): Calibration directory of the night
+            **master_args: Passed on to masterFrame
+
+        Returns:
+            master (arr): (768,1024) uint16 master frame
+    """
+
+    if not os.path.isdir(cal_dir):
+        raise NotADirectoryError(f"{cal_dir} is not a valid directory")
+
+    for kind in ("dark","bias"):
+        if os.path.isdir(os.path.join(cal_dir, kind)):
+            return masterFrame(os.path.join(cal_dir, kind), **master_args)
+
+    return masterFrame(cal_dir, **master_args)
+
+
+def asBias(bias, bitdepth=16, layout="msb"):
+    """
+    Accept a master frame array, a calibration directory, or None.
+    """
+
+    if bias is None or isinstance(bias, np.ndarray):
+        return bias
+    if isinstance(bias, (str, os.PathLike)):
+        return masterCalibration(str(bias), bitdepth=bitdepth, layout=layout)
+
+    return np.asarray(bias)
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 1:
+        print("Usage: python3 calibration.py CAL_DIR [OUTPUT_PNG]")
+        sys.exit()
+    elif not os.path.isdir(sys.argv[1]):
+        sys.exit(f"{sys.argv[1]} is not a directory")
+
+    master = masterCalibration(sys.argv[1])
+    print(f"Master of {sys.argv[1]}: median {np.median(master):.1f}, "
+          f"min {master.min()}, max {master.max()}")
+
+    if len(sys.argv) > 2:
+        from analyzeframes import writePNG16
+        writePNG16(master, sys.argv[2])
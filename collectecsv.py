@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   collectecsv.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 14:20:31 2026
+Updated:    Sat Oct 17 14:20:31 2026
+
+Usage: python3 collectecsv.py NIGHT_DIR hhmmss|EVENT_LOG [hhmmss|EVENT_LOG ...]
+Description: gathers the ECSV files of events into NIGHT_DIR/ECSV/hhmmss/,
+             from a cached index of the night's tree rather than a tree walk
+             per event. Event logs (eg. UniqueEvents*.log) give the times in
+             their first column.
+"""
+
+# Module Imports
+import os,sys
+import re
+import json
+import time
+import errno
+import shutil
+
+## Custom Script Imports
+from frameindex import RACY_NS
+
+
+## Cached indexes sit beside the night directory, like the frame index
+INDEX_SUFFIX = ".ecsvindex.json"
+
+## Collected files go here in the night directory, and are never indexed
+COLLECT_DIR = "ECSV"
+
+## ioctl request to clone a file's extents (Linux, on btrfs/xfs and friends)
+FICLONE = 0x40049409
+
+
+##############################
+## ECSV Index
+##############################
+
+class ECSVIndex:
+    """
+    Every .ecsv file in a night directory's tree, found by the time in the
+    path of the directory holding it (as in `find -wholename *hhmmss*/*.ecsv`).
+
+    The tree is walked once and cached beside the night directory with each
+    directory's mtime and when it was listed. Later loads only relist
+    directories whose mtime has changed, which is what adding or removing a
+    file changes, or which changed too close to their listing to tell (see
+    frameindex.RACY_NS).
+
+        Parameters:
+            night_dir (str): Night directory, eg. data/YYYYMMDD
+            use_cache (bool): Read and write the cached index
+
+        Attributes:
+            dirs (dict): .ecsv filenames in each directory, keyed by its path
+                         relative to night_dir
+            by_time (dict): Directories keyed by every 6-digit run in their
+                            relative path
+    """
+
+    def __init__(self, night_dir, use_cache=True):
+
+        ## Sanitize inputs
+        night_dir = os.path.normpath(str(night_dir))
+        if not os.path.isdir(night_dir):
+            raise NotADirectoryError(f"{night_dir} is not a valid directory")
+
+        self.night_dir  = night_dir
+        self.cache_path = os.path.join(os.path.dirname(night_dir),
+                                       os.path.basename(night_dir) + INDEX_SUFFIX)
+
+        cache = self._loadCache() if use_cache else {}
+        tree, changed = self._scan(cache)
+        if use_cache and changed:
+            self._saveCache(tree)
+
+        self.dirs    = {rel: files for rel, (_, _, files, _) in tree.items() if files}
+        self.by_time = {}
+        for rel in self.dirs:
+            for key in set(re.findall(r"(?=(\d{6}))", rel)):
+                self.by_time.setdefault(key, []).append(rel)
+
+
+    def _loadCache(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def _saveCache(self, tree):
+        # Written whole and renamed into place; no cache if we can't write
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(tree, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+
+
+    def _scan(self, cache):
+        """
+        Walk the tree, reusing the cached listing of unchanged directories.
+        Returns the tree as {rel_dir: [mtime_ns, subdirs, ecsv files,
+        scan_ns]} and whether anything had to be relisted.
+        """
+
+        tree, changed = {}, False
+        scan_ns = time.time_ns()
+        stack = [""]
+        while stack:
+            rel      = stack.pop()
+            path     = os.path.join(self.night_dir, rel)
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                changed = True
+                continue
+
+            cached = cache.get(rel)
+            if cached and len(cached) == 4 and cached[0] == mtime_ns and\
+                    mtime_ns < cached[3] - RACY_NS:
+                subdirs, files, listed_ns = cached[1], cached[2], cached[3]
+            else:
+                changed   = True
+                listed_ns = scan_ns
+                subdirs, files = [], []
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not (rel == "" and entry.name == COLLECT_DIR):
+                                subdirs.append(entry.name)
+                        elif entry.name.lower().endswith(".ecsv"):
+                            files.append(entry.name)
+
+            tree[rel] = [mtime_ns, subdirs, sorted(files), listed_ns]
+            stack.extend(os.path.join(rel, name) for name in subdirs)
+
+        return tree, changed or len(tree) != len(cache)
+
+
+    def find(self, event_time):
+        """
+        Paths of the .ecsv files in directories whose path contains the
+        event time.
+
+            Parameters:
+                event_time (str): Event time, usually hhmmss
+
+            Returns:
+                paths (list): Full paths of the matching files
+        """
+
+        event_time = str(event_time)
+        if re.fullmatch(r"\d{6}", event_time):
+            dirs = self.by_time.get(event_time, [])
+        else:
+            dirs = [rel for rel in self.dirs if event_time in rel]
+
+        return [os.path.join(self.night_dir, rel, name)
+                for rel in sorted(dirs) for name in self.dirs[rel]]
+
+
+##############################
+## Collection
+##############################
+
+def linkOrCopy(src, dst):
+    """
+    Put a file at dst sharing src's data where the filesystem allows it: a
+    hardlink, else a reflink (copy-on-write clone), else a plain copy.
+
+        Returns:
+            method (str): "link", "reflink" or "copy"
+    """
+
+    try:
+        os.link(src, dst)
+        return "link"
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+
+    try:
+        import fcntl
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return "reflink"
+    except (ImportError, OSError):
+        pass
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def _alreadyCollected(src, dst):
+    """
+    Whether dst is already src, either as a link or as an identical copy.
+    """
+
+    try:
+        st_src, st_dst = os.stat(src), os.stat(dst)
+    except FileNotFoundError:
+        return False
+
+    return (st_src.st_ino, st_src.st_dev) == (st_dst.st_ino, st_dst.st_dev) or\
+           (st_src.st_size, st_src.st_mtime_ns) == (st_dst.st_size, st_dst.st_mtime_ns)
+
+
+def collectECSV(night_dir, event_times, out_dir=None, use_cache=True):
+    """
+    Gather the ECSV files of many events into out_dir/hhmmss/ in one pass
+    over a cached index of the night.
+
+        Parameters:
+            night_dir (str): Night directory, eg. data/YYYYMMDD
+            event_times (list): Event times (hhmmss)
+            out_dir (str): Collection directory. Defaults to NIGHT_DIR/ECSV.
+            use_cache (bool): Use the cached index of the night
+
+        Returns:
+            collected (dict): Paths of the collected files for each event time
+    """
+
+    index   = ECSVIndex(night_dir, use_cache)
+    out_dir = out_dir or os.path.join(index.night_dir, COLLECT_DIR)
+
+    collected = {}
+    counts    = {"link": 0, "reflink": 0, "copy": 0, "skipped": 0}
+    for event_time in dict.fromkeys(map(str, event_times)):
+        event_dir = os.path.join(out_dir, event_time)
+        os.makedirs(event_dir, exist_ok=True)
+
+        collected[event_time] = []
+        for src in index.find(event_time):
+            dst = os.path.join(event_dir, os.path.basename(src))
+            if _alreadyCollected(src, dst):
+                counts["skipped"] += 1
+            else:
+                # Like cp, a different file of the same name is replaced
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                counts[linkOrCopy(src, dst)] += 1
+            collected[event_time].append(dst)
+
+        if not collected[event_time]:
+            print(f"No ECSV files found for {event_time}")
+
+    print(", ".join(f"{n} {method}" for method, n in counts.items()) +
+          f" for {len(collected)} events")
+
+    return collected
+
+
+def readEventTimes(log_path):
+    """
+    Event times from the first column of a comma or whitespace separated
+    event log, eg. UniqueEventsYYYYMMDD.log.
+    """
+
+    with open(log_path) as f:
+        return [line.replace(","," ").split()[0] for line in f
+                if line.strip() and not line.startswith("#")]
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        print("Usage: python3 collectecsv.py NIGHT_DIR hhmmss|EVENT_LOG [hhmmss|EVENT_LOG ...]")
+        sys.exit()
+    elif not os.path.isdir(sys.argv[1]):
+        sys.exit(f"{sys.argv[1]} is not a directory")
+
+    event_times = []
+    for arg in sys.argv[2:]:
+        event_times.extend(readEventTimes(arg) if os.path.isfile(arg) else [arg])
+
+    collectECSV(sys.argv[1], event_times)
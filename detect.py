@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   detect.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 12:14:40 2026
+Updated:    Sat Oct 17 12:14:40 2026
+
+Usage: python3 detect.py FRAME_DIR [OUTPUT_LOG] [WORKERS]
+Description: streams the .raw frames of a night in time order, finds moving
+             transients (meteors) against a rolling background and writes
+             them to an evmags log readable by allsky_events.py
+"""
+
+# Module Imports
+import os,sys
+import numpy as np
+from datetime import datetime, timedelta
+
+## Custom Script Imports
+from frameindex import buildFrameIndex
+from analyzeframes import readRAW
+from background import RollingBackground
+
+
+## One row per connected component found in a frame
+DETECTION_DTYPE = np.dtype([("frame","i8"), ("time","f8"), ("x","f8"), ("y","f8"),
+                            ("flux","f8"), ("peak","f4"), ("npix","i4")])
+
+
+##############################
+## Per-Frame Detection
+##############################
+
+def detectFrame(residual, nsigma=5.0, min_pixels=3):
+    """
+    Threshold a background-subtracted frame and measure its connected
+    components.
+
+        Parameters:
+            residual (arr): float32 background-subtracted frame
+            nsigma (float): Detection threshold in units of the frame's
+                            robust noise
+            min_pixels (int): Smallest component kept
+
+        Returns:
+            x, y (arr): Flux-weighted centroids of the components
+            flux (arr): Summed residual flux of each component
+            peak (arr): Brightest residual pixel of each component
+            npix (arr): Number of pixels in each component
+    """
+
+    import cv2
+
+    ## Robust noise from the MAD of a subsample of the frame
+    sample = residual[::4,::4]
+    med    = np.median(sample)
+    sigma  = 1.4826*np.median(np.abs(sample - med))
+    mask   = (residual > med + nsigma*max(sigma,1.0)).astype(np.uint8)
+
+    ## Label the pixels above the threshold
+    nlabels, labels = cv2.connectedComponents(mask, connectivity=8)
+    if nlabels <= 1:
+        empty = np.zeros(0)
+        return empty, empty, empty, empty.astype(np.float32), empty.astype(np.int32)
+
+    ## Measure every component at once with bincounts over its pixels
+    ys, xs = np.nonzero(labels)
+    lab    = labels[ys,xs]
+    weight = residual[ys,xs].astype(np.float64)
+
+    npix = np.bincount(lab, minlength=nlabels)[1:]
+    flux = np.bincount(lab, weights=weight, minlength=nlabels)[1:]
+    x    = np.bincount(lab, weights=weight*xs, minlength=nlabels)[1:]/flux
+    y    = np.bincount(lab, weights=weight*ys, minlength=nlabels)[1:]/flux
+    peak = np.full(nlabels, -np.inf, dtype=np.float32)
+    np.maximum.at(peak, lab, weight.astype(np.float32))
+    peak = peak[1:]
+
+    keep = npix >= min_pixels
+    return x[keep], y[keep], flux[keep], peak[keep], npix[keep].astype(np.int32)
+
+
+def _detectChunk(args):
+    """
+    Detect transients in one chunk of a night. The chunk starts `window`
+    frames early so the background is warmed up by its first frame, and only
+    detections from the chunk's own frames are returned.
+    """
+
+    paths, times, first, warmup, window, method, nsigma, min_pixels, bitdepth, layout = args
+
+    model      = RollingBackground(window, method, nsigma)
+    frames     = (readRAW(fpath, bitdepth, layout) for fpath in paths)
+    detections = []
+
+    for i, residual in enumerate(model.subtract(frames)):
+        if i < warmup:
+            continue
+
+        x, y, flux, peak, npix = detectFrame(residual, nsigma, min_pixels)
+        found = np.empty(len(x), dtype=DETECTION_DTYPE)
+        found["frame"] = first + i
+        found["time"]  = times[i]
+        found["x"], found["y"], found["flux"] = x, y, flux
+        found["peak"], found["npix"] = peak, npix
+        detections.append(found)
+
+    if not detections:
+        return np.zeros(0, dtype=DETECTION_DTYPE)
+    return np.concatenate(detections)
+
+
+##############################
+## Track Linking
+##############################
+
+def linkTracks(detections, max_dist=30.0, max_gap=2, min_frames=3):
+    """
+    Link per-frame detections into tracks. Each detection continues the
+    open track whose predicted position (last position plus last velocity)
+    is nearest, if within max_dist pixels; otherwise it starts a new track.
+
+        Parameters:
+            detections (arr): DETECTION_DTYPE array
+            max_dist (float): Largest jump (pixels) from the predicted position
+            max_gap (int): Most frames a track may go undetected
+            min_frames (int): Fewest detections in a kept track
+
+        Returns:
+            tracks (list): Arrays of the detections in each track, in order
+    """
+
+    detections = np.sort(detections, order=["frame","flux"])
+    frame_nums = detections["frame"]
+    bounds     = np.flatnonzero(np.diff(frame_nums)) + 1
+
+    open_tracks = []
+    done_tracks = []
+
+    for group in np.split(np.arange(len(detections)), bounds):
+        if len(group) == 0:
+            continue
+        frame = frame_nums[group[0]]
+
+        # Close tracks which have gone undetected too long
+        still_open = []
+        for track in open_tracks:
+            (done_tracks if frame - detections[track[-1]]["frame"] > max_gap
+             else still_open).append(track)
+        open_tracks = still_open
+
+        # Predict where every open track should be in this frame
+        if open_tracks:
+            pred = np.empty((len(open_tracks),2))
+            for t, track in enumerate(open_tracks):
+                last = detections[track[-1]]
+                pred[t] = last["x"], last["y"]
+                if len(track) > 1:
+                    prev = detections[track[-2]]
+                    step = (frame - last["frame"])/(last["frame"] - prev["frame"])
+                    pred[t,0] += (last["x"] - prev["x"])*step
+                    pred[t,1] += (last["y"] - prev["y"])*step
+
+            # Greedily match the closest detection/track pairs first
+            pos   = np.column_stack((detections["x"][group], detections["y"][group]))
+            dist  = np.hypot(*(pos[:,None,:] - pred[None,:,:]).transpose(2,0,1))
+            taken_d, taken_t = set(), set()
+            for d, t in zip(*np.unravel_index(np.argsort(dist, axis=None), dist.shape)):
+                if dist[d,t] > max_dist:
+                    break
+                if d in taken_d or t in taken_t:
+                    continue
+                open_tracks[t].append(group[d])
+                taken_d.add(d)
+                taken_t.add(t)
+            unmatched = [group[d] for d in range(len(group)) if d not in taken_d]
+        else:
+            unmatched = list(group)
+
+        open_tracks.extend([d] for d in unmatched)
+
+    done_tracks.extend(open_tracks)
+    return [detections[track] for track in done_tracks if len(track) >= min_frames]
+
+
+##############################
+## Night Pipeline
+##############################
+
+def detectNight(frame_dir, save_path=None, workers=None, chunk_size=500,
+                window=25, method="median", nsigma=5.0, min_pixels=3,
+                max_dist=30.0, max_gap=2, min_frames=3,
+                bitdepth=16, layout="msb"):
+    """
+    Find moving transients in a night of .raw frames and write them to an
+    evmags log. The night is split into chunks detected in parallel; each
+    chunk re-reads the `window` frames before it to warm up its background,
+    and tracks are linked across chunk boundaries afterwards.
+
+        Parameters:
+            frame_dir (str/Path): Night directory of .raw frames. Assumes the
+                                  first 8 characters are YYYYMMDD.
+            save_path (str): Output log. Defaults to evmagsYYYYMMDD.log next
+                             to frame_dir, as writing into frame_dir would
+                             invalidate its frame index. False to not
+                             write one.
+            workers (int): Number of processes. None uses every core.
+            chunk_size (int): Frames per chunk
+            window (int): Frames in the rolling background
+            method (str): "median" or "clipped" background
+            nsigma (float): Detection threshold (robust sigma), also used
+                            to clip the "clipped" background
+            min_pixels (int): Smallest component kept
+            max_dist, max_gap, min_frames: Track linking (see linkTracks)
+            bitdepth (int): 16, or 12 for packed 12-bit frames
+            layout (str): Packing layout of 12-bit frames
+
+        Returns:
+            tracks (list): Arrays of the detections in each track
+    """
+
+    from raw_img_reader import processPool
+
+    ## Sanitize inputs
+    frame_dir = str(frame_dir)
+    index     = buildFrameIndex(frame_dir)
+    night     = os.path.basename(os.path.normpath(frame_dir))[:8]
+    try:
+        night_start = datetime.strptime(night, "%Y%m%d")
+    except ValueError:
+        raise ValueError(f"{frame_dir} needs to have YYYYMMDD as the first 8 characters")
+    if save_path is None:
+        save_path = os.path.join(os.path.dirname(os.path.abspath(frame_dir)),
+                                 f"evmags{night}.log")
+
+    ## Split the night into chunks which overlap by the background window
+    jobs = []
+    for start in range(0, len(index), chunk_size):
+        first = max(0, start - window)
+        stop  = min(start + chunk_size, len(index))
+        jobs.append((index["path"][first:stop], index["time"][first:stop], first,
+                     start - first, window, method, nsigma, min_pixels, bitdepth, layout))
+
+    ## Detect every chunk, in a process pool if requested
+    if workers == 1 or len(jobs) <= 1:
+        found = list(map(_detectChunk, jobs))
+    else:
+        with processPool(workers) as pool:
+            found = list(pool.map(_detectChunk, jobs))
+    detections = np.concatenate(found) if found else np.zeros(0, dtype=DETECTION_DTYPE)
+
+    ## Link the detections into tracks, then write them out
+    tracks = linkTracks(detections, max_dist, max_gap, min_frames)
+    if save_path:
+        writeEventLog(tracks, night_start, save_path)
+        print(f"Wrote {len(tracks)} events from {len(detections)} detections to {save_path}")
+
+    return tracks
+
+
+def writeEventLog(tracks, night_start, save_path):
+    """
+    Write tracks as an evmags log. Columns are whitespace separated:
+
+        0  event ID "ev_YYYYMMDD_hhmmss_fff" (hhmmss is characters 12:18)
+        1  first frame     2  last frame     3  number of detections
+        4  start time (s)  5  end time (s)   (see buildFrameIndex)
+        6  x start  7  y start  8  x end  9  y end
+        10 instrumental magnitude of the summed flux
+        11 peak pixel
+
+        Parameters:
+            tracks (list): Arrays of detections from linkTracks
+            night_start (datetime): Midnight at the start of the night
+            save_path (str): Filepath of the log
+    """
+
+    with open(save_path, "w") as f:
+        f.write("# id frame_start frame_end ndet t_start t_end "
+                "x_start y_start x_end y_end mag peak\n")
+        for track in sorted(tracks, key=lambda track: track["time"][0]):
+            start = night_start + timedelta(seconds=float(track["time"][0]))
+            ev_id = f"ev_{start:%Y%m%d_%H%M%S}_{start.microsecond//1000:03d}"
+            mag   = -2.5*np.log10(max(track["flux"].sum(), 1e-3))
+            f.write(f"{ev_id} {track['frame'][0]} {track['frame'][-1]} {len(track)} "
+                    f"{track['time'][0]:.3f} {track['time'][-1]:.3f} "
+                    f"{track['x'][0]:.2f} {track['y'][0]:.2f} "
+                    f"{track['x'][-1]:.2f} {track['y'][-1]:.2f} "
+                    f"{mag:.3f} {track['peak'].max():.1f}\n")
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 1:
+        print("Usage: python3 detect.py FRAME_DIR [OUTPUT_LOG] [WORKERS]")
+        sys.exit()
+    elif not os.path.isdir(sys.argv[1]):
+        sys.exit(f"{sys.argv[1]} is not a directory")
+
+    save_path = sys.argv[2] if len(sys.argv) > 2 else None
+    workers   = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    detectNight(sys.argv[1], save_path, workers)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   eventstore.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 15:02:48 2026
+Updated:    Sat Oct 17 15:02:48 2026
+
+Usage: python3 eventstore.py STORE_DIR ECSV_DIR [ECSV_DIR ...]
+Description: parses event ECSV files into a columnar store of .npy files,
+             one partition per station, with time-sorted event indexes for
+             time and station queries without rereading any text
+"""
+
+# Module Imports
+import os,sys
+import re
+import json
+import numpy as np
+
+
+## One row per measured point of an event (one line of an ECSV table).
+## Times are unix seconds.
+POINT_DTYPE = np.dtype([("time","f8"), ("ra","f8"), ("dec","f8"), ("azimuth","f8"),
+                        ("altitude","f8"), ("x","f4"), ("y","f4"),
+                        ("flux","f8"), ("mag","f4")])
+
+## ECSV column names read into each point field
+POINT_COLUMNS = {"datetime": "time", "ra": "ra", "dec": "dec", "azimuth": "azimuth",
+                 "altitude": "altitude", "x_image": "x", "y_image": "y",
+                 "integrated_pixel_value": "flux", "mag_data": "mag"}
+
+## One row per event at a station, pointing at its slice of the points.
+## Events are kept sorted by start time.
+EVENT_DTYPE = np.dtype([("t_start","f8"), ("t_end","f8"), ("first","i8"),
+                        ("count","i8"), ("file","i8")])
+
+## Files in the store
+EVENTS_FILE   = "events.npy"
+POINTS_FILE   = "points.npy"
+MANIFEST_FILE = "manifest.json"
+
+
+##############################
+## ECSV Parsing
+##############################
+
+def readECSV(ecsv_path):
+    """
+    Parse an event ECSV file into points. The YAML header is only scanned
+    for the station; columns are found from the table's header row.
+
+        Parameters:
+            ecsv_path (str): Path to the ECSV file
+
+        Returns:
+            site (str): Station ID, from camera_id in the header, otherwise
+                        the last "_" field of the filename (eg. ev_hhmmss_01)
+            points (arr): POINT_DTYPE array sorted by time
+    """
+
+    header, rows = [], []
+    with open(ecsv_path) as f:
+        for line in f:
+            if line.startswith("#"):
+                header.append(line)
+            elif line.strip():
+                rows.append(line)
+
+    ## Station from the header, falling back on the filename
+    match = re.search(r"camera_id:\s*['\"]?([\w.-]+)", "".join(header))
+    site  = match.group(1) if match else\
+            os.path.splitext(os.path.basename(ecsv_path))[0].rsplit("_",1)[-1]
+
+    points = np.full(max(len(rows)-1,0), np.nan, dtype=POINT_DTYPE)
+    if len(rows) < 2:
+        return site, points
+
+    ## First uncommented row names the columns
+    delimiter = "," if "," in rows[0] else None
+    names     = [name.strip() for name in rows[0].split(delimiter)]
+    usecols   = [i for i, name in enumerate(names) if name in POINT_COLUMNS]
+    table     = np.loadtxt(rows[1:], dtype=str, delimiter=delimiter,
+                           usecols=usecols, ndmin=2)
+
+    for col, i in enumerate(usecols):
+        field = POINT_COLUMNS[names[i]]
+        if field == "time":
+            stamps = np.char.rstrip(np.char.strip(table[:,col]), "Z")
+            points["time"] = stamps.astype("datetime64[us]").astype(np.int64)/1e6
+        else:
+            points[field] = table[:,col].astype(np.float64)
+
+    return site, np.sort(points, order="time")
+
+
+def _readECSVWorker(ecsv_path):
+    """
+    Process pool entry point: parse one file, catching its errors.
+    """
+
+    try:
+        return ecsv_path, readECSV(ecsv_path)
+    except (OSError, ValueError) as err:
+        return ecsv_path, err
+
+
+##############################
+## Event Store
+##############################
+
+class EventStore:
+    """
+    Columnar store of events, with one partition per station:
+
+        STORE_DIR/SITE/points.npy : every point of the station's events
+        STORE_DIR/SITE/events.npy : EVENT_DTYPE index sorted by start time
+        STORE_DIR/manifest.json   : files ingested, with their mtime and size
+
+    Partitions are memory-mapped, so queries only read what they return.
+
+        Parameters:
+            store_dir (str): Directory of the store, created if needed
+    """
+
+    def __init__(self, store_dir):
+
+        self.store_dir = str(store_dir)
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        try:
+            with open(os.path.join(self.store_dir, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {"files": [], "stamps": [], "max_duration": 0.0}
+        self.files        = manifest["files"]
+        self.stamps       = manifest["stamps"]
+        self.max_duration = manifest["max_duration"]
+        self._partitions  = {}
+
+
+    @property
+    def sites(self):
+        """
+        Stations with a partition in the store.
+        """
+
+        return sorted(name for name in os.listdir(self.store_dir)
+                      if os.path.isfile(os.path.join(self.store_dir, name, EVENTS_FILE)))
+
+
+    def partition(self, site):
+        """
+        Memory-mapped (events, points) of a station.
+        """
+
+        if site not in self._partitions:
+            site_dir = os.path.join(self.store_dir, site)
+            self._partitions[site] = (np.load(os.path.join(site_dir, EVENTS_FILE), mmap_mode="r"),
+                                      np.load(os.path.join(site_dir, POINTS_FILE), mmap_mode="r"))
+        return self._partitions[site]
+
+
+    def _save(self, file, data):
+        # Written whole and renamed into place, so readers never see a partial file
+        path = os.path.join(self.store_dir, file)
+        if isinstance(data, np.ndarray):
+            tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, data)
+        else:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+    def ingest(self, ecsv_paths, workers=None):
+        """
+        Add ECSV files to the store. Files already ingested and unchanged
+        are skipped; the rest are parsed in parallel and merged into their
+        stations' partitions. Files that can't be read are logged and, like
+        empty ones, skipped until they change.
+
+            Parameters:
+                ecsv_paths (list): Paths to ECSV files
+                workers (int): Number of processes. None uses every core.
+
+            Returns:
+                added (int): Number of events added
+        """
+
+        from raw_img_reader import processPool
+
+        ## Only parse new or changed files
+        known = dict(zip(self.files, self.stamps))
+        todo  = []
+        for ecsv_path in map(os.path.abspath, ecsv_paths):
+            st    = os.stat(ecsv_path)
+            stamp = [st.st_mtime_ns, st.st_size]
+            if known.get(ecsv_path) != stamp:
+                todo.append((ecsv_path, stamp))
+        if not todo:
+            return 0
+
+        if workers == 1 or len(todo) == 1:
+            parsed = list(map(_readECSVWorker, (path for path, _ in todo)))
+        else:
+            with processPool(workers) as pool:
+                parsed = list(pool.map(_readECSVWorker, (path for path, _ in todo),
+                                       chunksize=64))
+
+        ## Group the new events by station. A changed file keeps its number,
+        ## so its old rows can be dropped. Files which fail to parse, or parse
+        ## to nothing, keep their new stamp with no rows, so they aren't
+        ## parsed again until they change.
+        file_nums  = {path: num for num, path in enumerate(self.files)}
+        replaced   = [file_nums[path] for path, _ in todo if path in file_nums]
+        new_events = {}
+        failed     = []
+        for (ecsv_path, stamp), (_, result) in zip(todo, parsed):
+            if ecsv_path not in file_nums:
+                file_nums[ecsv_path] = len(self.files)
+                self.files.append(ecsv_path)
+                self.stamps.append(stamp)
+            self.stamps[file_nums[ecsv_path]] = stamp
+
+            if isinstance(result, Exception):
+                failed.append((ecsv_path, result))
+                continue
+            site, points = result
+            if len(points) == 0:
+                continue
+            new_events.setdefault(site, []).append((file_nums[ecsv_path], points))
+
+        if failed:
+            print(f"Could not read {len(failed)} files, skipped until they change:")
+            for ecsv_path, err in failed:
+                print(f"  {ecsv_path}: {err}")
+
+        ## Merge into each station's partition, rewriting it in time order.
+        ## Changed files may have moved station, so every station is checked.
+        added   = 0
+        current = self.sites
+        for site in current:
+            if site not in new_events and np.isin(self.partition(site)[0]["file"], replaced).any():
+                new_events[site] = []
+
+        for site, items in new_events.items():
+            counts = np.array([len(points) for _, points in items], dtype=np.int64)
+            events = np.empty(len(items), dtype=EVENT_DTYPE)
+            events["t_start"] = [points["time"][0] for _, points in items]
+            events["t_end"]   = [points["time"][-1] for _, points in items]
+            events["first"]   = np.cumsum(counts) - counts
+            events["count"]   = counts
+            events["file"]    = [file_num for file_num, _ in items]
+            points = np.concatenate([points for _, points in items] +
+                                    [np.zeros(0, dtype=POINT_DTYPE)])
+
+            # Old events point into the old points, placed before the new ones
+            if site in current:
+                old_events, old_points = self.partition(site)
+                old_events = old_events[~np.isin(old_events["file"], replaced)]
+                events["first"] += len(old_points)
+                events = np.concatenate((old_events, events))
+                points = np.concatenate((old_points, points))
+            self._partitions.pop(site, None)
+
+            # Gather the points of every event in start time order
+            events = events[np.argsort(events["t_start"], kind="stable")]
+            starts = np.cumsum(events["count"]) - events["count"]
+            gather = np.repeat(events["first"] - starts, events["count"]) +\
+                     np.arange(events["count"].sum())
+            points = points[gather]
+            events["first"] = starts
+
+            os.makedirs(os.path.join(self.store_dir, site), exist_ok=True)
+            self._save(os.path.join(site, POINTS_FILE), points)
+            self._save(os.path.join(site, EVENTS_FILE), events)
+            if len(events):
+                self.max_duration = max(self.max_duration,
+                                        float(np.max(events["t_end"] - events["t_start"])))
+            added += len(items)
+
+        self._save(MANIFEST_FILE, {"files": self.files, "stamps": self.stamps,
+                                   "max_duration": self.max_duration})
+
+        return added
+
+
+    def query(self, t_start, t_end, sites=None):
+        """
+        Events overlapping a time range, found by binary search on each
+        station's start times.
+
+            Parameters:
+                t_start, t_end (float): Time range in unix seconds
+                sites (list): Stations to search. None for all.
+
+            Returns:
+                found (dict): EVENT_DTYPE rows of each station's events
+        """
+
+        found = {}
+        for site in (self.sites if sites is None else sites):
+            if not os.path.isdir(os.path.join(self.store_dir, site)):
+                found[site] = np.zeros(0, dtype=EVENT_DTYPE)
+                continue
+
+            # No event lasts longer than max_duration, so any overlapping one
+            # starts no earlier than t_start - max_duration
+            events = self.partition(site)[0]
+            lo = np.searchsorted(events["t_start"], t_start - self.max_duration, side="left")
+            hi = np.searchsorted(events["t_start"], t_end, side="right")
+            window = np.array(events[lo:hi])
+            found[site] = window[window["t_end"] >= t_start]
+
+        return found
+
+
+    def points(self, site, event):
+        """
+        Points of one event from a station's partition.
+        """
+
+        return self.partition(site)[1][event["first"]:event["first"]+event["count"]]
+
+
+    def path(self, event):
+        """
+        ECSV file an event came from.
+        """
+
+        return self.files[int(event["file"])]
+
+
+def findECSV(top_dir):
+    """
+    Every .ecsv file under a directory, leaving out the copies gathered
+    into collection directories by collectecsv.py.
+    """
+
+    from collectecsv import COLLECT_DIR
+
+    found = []
+    for root, dirs, files in os.walk(top_dir):
+        dirs[:] = [name for name in dirs if name != COLLECT_DIR]
+        found.extend(os.path.join(root, name) for name in files if name.lower().endswith(".ecsv"))
+
+    return sorted(found)
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        print("Usage: python3 eventstore.py STORE_DIR ECSV_DIR [ECSV_DIR ...]")
+        sys.exit()
+
+    store = EventStore(sys.argv[1])
+    for top_dir in sys.argv[2:]:
+        if not os.path.isdir(top_dir):
+            sys.exit(f"{top_dir} is not a directory")
+        added = store.ingest(findECSV(top_dir))
+        print(f"{top_dir}: added {added} events")
+
+    for site in store.sites:
+        events = store.partition(site)[0]
+        print(f"{site}: {len(events)} events")
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   frameindex.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 09:12:44 2026
+Updated:    Sat Oct 17 09:12:44 2026
+
+Usage: python3 frameindex.py FRAME_DIR [FRAME_DIR ...]
+Description: builds and caches a time-sorted index of the frames in a night
+             directory, so the directory only has to be scanned once
+"""
+
+# Module Imports
+import os,sys
+import time
+import numpy as np
+
+## Custom Script Imports
+import instrument
+
+
+## Night directories hold frames named "hh_mm_ss_fff.raw". Frames before 16h
+## were taken after midnight, so they are counted on from 24h (eg. 01:00 is
+## 25h, or 90000 s). Index times, and FrameStack.between, use this
+## convention, while analyzeframes.convNameToTime gives seconds since
+## midnight; convert those with nightTime.
+NIGHT_ROLLOVER = 16*60*60
+
+## Returned index of a directory is one (time, path, size) row per frame,
+## sorted by time. The path field is as wide as the longest path.
+def indexDtype(path_len):
+    return np.dtype([("time","f8"), ("path",f"U{max(path_len,1)}"), ("size","i8")])
+
+## Cached index files sit beside the night directory, not inside it, so that
+## writing the cache doesn't change the directory's own mtime
+INDEX_SUFFIX = ".frameindex.npz"
+
+## A directory modified this close to when it was scanned may have changed
+## again within the same mtime tick (filesystem timestamps can be as coarse
+## as 2 s), so such a cache is always rescanned
+RACY_NS = 2*10**9
+
+
+##############################
+## Filename Parsing
+##############################
+
+def nightTime(seconds):
+    """
+    Convert seconds since midnight into seconds since the start of the
+    observing night (see NIGHT_ROLLOVER).
+
+        Parameters:
+            seconds (float/arr): Seconds since midnight, eg. from
+                                 analyzeframes.convNameToTime
+
+        Returns:
+            seconds (float/arr): Seconds since the start of the night
+    """
+
+    return np.where(np.asarray(seconds) < NIGHT_ROLLOVER, seconds + 24*60*60, seconds)[()]
+
+
+def parseFrameTimes(fnames):
+    """
+    Vectorized conversion of "hh_mm_ss_fff.ext" filenames into seconds since
+    the start of the observing night (frames before 16h count on from 24h).
+
+        Parameters:
+            fnames (arr): 1D array or list of filenames
+
+        Returns:
+            times (arr): Time of each frame in seconds. NaN where the name
+                         is not of the expected format.
+    """
+
+    fnames = np.asarray(fnames, dtype=str)
+    times  = np.full(len(fnames), np.nan)
+    if len(fnames) == 0:
+        return times
+
+    ## Names of the standard fixed width are parsed as a block of digits
+    fixed = np.char.str_len(fnames) == 16
+    if np.any(fixed):
+        stems  = fnames[fixed].astype("U12").astype("S12")
+        chars  = np.frombuffer(stems.tobytes(), dtype=np.uint8).reshape(-1,12)
+        digits = chars.astype(np.int64) - ord("0")
+
+        # Check the separators and that every other character is a digit
+        sep_cols   = [2,5,8]
+        digit_cols = [0,1,3,4,6,7,9,10,11]
+        valid = np.all(chars[:,sep_cols] == ord("_"), axis=1) &\
+                np.all((digits[:,digit_cols] >= 0) & (digits[:,digit_cols] <= 9), axis=1)
+
+        parsed = (digits[:,0]*10 + digits[:,1])*60*60 +\
+                 (digits[:,3]*10 + digits[:,4])*60 +\
+                 (digits[:,6]*10 + digits[:,7]) +\
+                 (digits[:,9]*100 + digits[:,10]*10 + digits[:,11])/1000
+        times[np.flatnonzero(fixed)[valid]] = parsed[valid]
+
+    ## Anything else (eg. unpadded fields) is parsed one name at a time
+    for i in np.flatnonzero(~fixed):
+        try:
+            hh,mm,ss,fff = os.path.splitext(fnames[i])[0].split("_")
+            times[i] = float(hh)*60*60 + float(mm)*60 + float(ss) + float(fff)/1000
+        except ValueError:
+            pass
+
+    ## Move frames from after midnight onto the same night
+    return nightTime(times)
+
+
+##############################
+## Directory Index
+##############################
+
+def indexPath(frame_dir):
+    """
+    Path of the cached index for a night directory.
+    """
+
+    frame_dir = os.path.normpath(frame_dir)
+    return os.path.join(os.path.dirname(frame_dir),
+                        os.path.basename(frame_dir) + INDEX_SUFFIX)
+
+
+def _loadIndexCache(cache_path):
+    """
+    Load a cached index. Returns None if there isn't a usable one.
+    """
+
+    try:
+        with np.load(cache_path) as cache:
+            return {key: cache[key] for key in ("mtime_ns","scan_ns","name","time","size")}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _saveIndexCache(cache_path, mtime_ns, scan_ns, names, times, sizes):
+    """
+    Save an index cache, written to a temporary file and renamed into place.
+    A directory we can't write to just goes without a cache.
+    """
+
+    tmp_path = cache_path + ".tmp.npz"
+    try:
+        np.savez(tmp_path, mtime_ns=np.int64(mtime_ns), scan_ns=np.int64(scan_ns),
+                 name=names, time=times, size=sizes)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+def _shortFrames(sizes):
+    """
+    Positions of the files smaller than the night's usual frame size, which
+    may still be being written.
+    """
+
+    if len(sizes) == 0:
+        return np.empty(0, dtype=np.int64)
+    values, counts = np.unique(sizes, return_counts=True)
+    return np.flatnonzero(sizes < values[np.argmax(counts)])
+
+
+@instrument.timed("frameindex.buildFrameIndex")
+def buildFrameIndex(frame_dir, suffix=".raw", use_cache=True):
+    """
+    Index the frames in a night directory with a single os.scandir pass.
+    The index is cached beside the directory and only refreshed when the
+    directory's mtime changes (or changed too close to the last scan to
+    tell); even then only new files are stat'd and parsed. Files short of
+    the usual frame size are stat'd again every time, since frames being
+    written grow without changing the directory.
+
+        Parameters:
+            frame_dir (str/Path): Night directory of frames
+            suffix (str): Extension of the frames to index (case-insensitive)
+            use_cache (bool): Read and write the cached index
+
+        Returns:
+            index (arr): Structured array of (time, path, size) sorted by
+                         time. Times are seconds since the start of the night,
+                         past 24h after midnight (see NIGHT_ROLLOVER).
+    """
+
+    ## Sanitize inputs
+    frame_dir = str(frame_dir)
+    if not os.path.isdir(frame_dir):
+        raise NotADirectoryError(f"{frame_dir} is not a valid directory")
+    suffix = suffix.lower()
+
+    ## Use the cache if the directory hasn't changed since well before it was
+    ## scanned
+    mtime_ns   = os.stat(frame_dir).st_mtime_ns
+    scan_ns    = time.time_ns()
+    cache_path = indexPath(frame_dir) if suffix == ".raw" else None
+    cache      = _loadIndexCache(cache_path) if (use_cache and cache_path) else None
+
+    if cache is not None and int(cache["mtime_ns"]) == mtime_ns and\
+            mtime_ns < int(cache["scan_ns"]) - RACY_NS:
+        names, times, sizes = cache["name"], cache["time"], cache["size"]
+
+        # Frames still being written are rewritten in place, which doesn't
+        # touch the directory, so re-stat any that were short of full size
+        sizes   = sizes.copy()
+        changed = False
+        for i in _shortFrames(sizes):
+            try:
+                size = os.stat(os.path.join(frame_dir, names[i])).st_size
+            except OSError:
+                continue
+            changed |= size != sizes[i]
+            sizes[i] = size
+        if changed and use_cache:
+            _saveIndexCache(cache_path, mtime_ns, cache["scan_ns"], names, times, sizes)
+
+    ## Otherwise rescan, reusing what is known about complete files already
+    ## indexed
+    else:
+        known = {}
+        if cache is not None:
+            full  = np.ones(len(cache["size"]), dtype=bool)
+            full[_shortFrames(cache["size"])] = False
+            known = dict(zip(cache["name"][full].tolist(),
+                             zip(cache["time"][full].tolist(), cache["size"][full].tolist())))
+
+        names, sizes, times, new = [], [], [], []
+        with os.scandir(frame_dir) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(suffix):
+                    continue
+                if entry.name in known:
+                    t, size = known[entry.name]
+                else:
+                    t, size = np.nan, entry.stat().st_size
+                    new.append(len(names))
+                names.append(entry.name)
+                times.append(t)
+                sizes.append(size)
+
+        names = np.array(names, dtype=str)
+        times = np.array(times, dtype=np.float64)
+        sizes = np.array(sizes, dtype=np.int64)
+        times[new] = parseFrameTimes(names[new])
+
+        # Drop files whose names aren't times and sort the rest
+        keep  = np.isfinite(times)
+        order = np.argsort(times[keep], kind="stable")
+        names, times, sizes = names[keep][order], times[keep][order], sizes[keep][order]
+
+        if use_cache and cache_path:
+            _saveIndexCache(cache_path, mtime_ns, scan_ns, names, times, sizes)
+
+    ## Assemble the index with full paths
+    paths = np.char.add(os.path.join(frame_dir, ""), names.astype(str))
+    index = np.empty(len(names), dtype=indexDtype(paths.dtype.itemsize//4))
+    index["time"] = times
+    index["path"] = paths
+    index["size"] = sizes
+
+    return index
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 1:
+        print("Usage: python3 frameindex.py FRAME_DIR [FRAME_DIR ...]")
+        sys.exit()
+
+    for frame_dir in sys.argv[1:]:
+        index = buildFrameIndex(frame_dir)
+        if len(index) == 0:
+            print(f"{frame_dir}: no frames")
+            continue
+
+        dt = np.diff(index["time"])
+        print(f"{frame_dir}: {len(index)} frames, "
+              f"{index['size'].sum()/1e9:.2f} GB, "
+              f"median dt {np.median(dt) if len(dt) else 0:.3f} s, "
+              f"max gap {dt.max() if len(dt) else 0:.3f} s")
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   instrument.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 19:12:05 2026
+Updated:    Sat Oct 17 19:12:05 2026
+
+Usage: FLIR_INSTRUMENT=1 python3 raw_img_reader.py ...          (log lines)
+       FLIR_INSTRUMENT=night.json python3 raw_img_reader.py ...  (JSON summary)
+Description: opt-in per-stage timing for the pipeline. Stages record their
+             wall time, frames, bytes read and written, and the peak memory
+             of the process, and a summary is reported when the run exits.
+             When it's off, a stage costs one function call.
+"""
+
+import os,sys
+import json
+import time
+import atexit
+import threading
+import functools
+import multiprocessing as mp
+
+
+##############################
+## Stage Records
+##############################
+
+class _NullStage:
+    """
+    Stand-in for a stage when instrumentation is off.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, frames=0, read=0, written=0):
+        pass
+
+
+class _Stage:
+    """
+    One timed run of a stage. Counts can be added while it runs.
+    """
+
+    def __init__(self, name, frames, read, written):
+        self.name    = name
+        self.frames  = frames
+        self.read    = read
+        self.written = written
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self, time.perf_counter() - self._start)
+        return False
+
+    def add(self, frames=0, read=0, written=0):
+        self.frames  += frames
+        self.read    += read
+        self.written += written
+
+
+_NULL    = _NullStage()
+_ENABLED = False
+_OUTPUT  = None
+_STATS   = {}
+_LOCK    = threading.Lock()
+
+
+def peakRSS():
+    """
+    Peak resident memory of this process in bytes, or 0 if unknown.
+    """
+
+    # Linux carries ru_maxrss over through fork and exec, so prefer the high
+    # water mark of this process's own address space
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss*1024
+    except ImportError:
+        return 0
+
+
+def _record(run, wall_s):
+    peak = peakRSS()
+    with _LOCK:
+        stats = _STATS.setdefault(run.name, {"calls": 0, "wall_s": 0.0, "frames": 0,
+                                             "bytes_read": 0, "bytes_written": 0,
+                                             "peak_rss": 0})
+        stats["calls"]         += 1
+        stats["wall_s"]        += wall_s
+        stats["frames"]        += run.frames
+        stats["bytes_read"]    += run.read
+        stats["bytes_written"] += run.written
+        stats["peak_rss"]       = max(stats["peak_rss"], peak)
+
+
+##############################
+## Instrumenting Code
+##############################
+
+def stage(name, frames=0, read=0, written=0):
+    """
+    Context manager timing a stage. Stages with the same name are summed,
+    and nested stages are each timed in full.
+
+        with instrument.stage("readRAW", frames=1) as st:
+            img = np.fromfile(path, dtype=np.uint16)
+            st.add(read=img.nbytes)
+
+        Parameters:
+            name (str): Stage name, eg. "module.function"
+            frames (int): Frames handled
+            read (int): Bytes read
+            written (int): Bytes written
+
+        Returns:
+            stage: Context manager with an add(frames, read, written) method
+    """
+
+    if not _ENABLED:
+        return _NULL
+    return _Stage(name, frames, read, written)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as a stage.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return func(*args, **kwargs)
+            with _Stage(name, 0, 0, 0):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def enabled():
+    return _ENABLED
+
+
+##############################
+## Reporting
+##############################
+
+def summary():
+    """
+    Totals of every stage so far, with throughput and peak memory in MB.
+    """
+
+    with _LOCK:
+        stats = {name: dict(stats) for name, stats in _STATS.items()}
+
+    for totals in stats.values():
+        wall_s = totals["wall_s"]
+        totals["frames_per_s"]  = totals["frames"]/wall_s if wall_s and totals["frames"] else None
+        totals["MB_read_per_s"] = totals["bytes_read"]/wall_s/1e6 if wall_s and totals["bytes_read"] else None
+        totals["peak_rss_MB"]   = totals.pop("peak_rss")/1e6
+
+    return dict(sorted(stats.items(), key=lambda item: -item[1]["wall_s"]))
+
+
+def report(output=None):
+    """
+    Report the summary, either as one JSON log line per stage on stderr or
+    as a JSON file.
+
+        Parameters:
+            output (str): Path of a .json summary. None (or "1", "log") logs
+                          to stderr.
+    """
+
+    stats = summary()
+    if not stats:
+        return
+
+    run = {"argv": sys.argv, "pid": os.getpid(), "peak_rss_MB": peakRSS()/1e6}
+    if output and output.lower().endswith(".json"):
+        tmp_path = f"{output}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"run": run, "stages": stats}, f, indent=2)
+        os.replace(tmp_path, output)
+    else:
+        for name, stage_stats in stats.items():
+            print(json.dumps({"stage": name, **stage_stats}), file=sys.stderr)
+        print(json.dumps({"stage": "total", **run}), file=sys.stderr)
+
+
+def enable(output=None):
+    """
+    Turn instrumentation on and report when the process exits. Worker
+    processes record their own stages but never report them.
+
+        Parameters:
+            output (str): See report
+    """
+
+    global _ENABLED, _OUTPUT
+
+    if not _ENABLED and mp.parent_process() is None:
+        atexit.register(lambda: report(_OUTPUT))
+    _ENABLED = True
+    _OUTPUT  = output
+
+
+def reset():
+    with _LOCK:
+        _STATS.clear()
+
+
+## Turned on for a whole run from the environment
+if os.environ.get("FLIR_INSTRUMENT", "") not in ("", "0"):
+    enable(os.environ["FLIR_INSTRUMENT"])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   lazyjit.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 11:05:52 2026
+Updated:    Sat Oct 17 11:05:52 2026
+
+Usage: from lazyjit import LazyKernel
+Description: numba kernels which are only compiled (or loaded from numba's
+             on-disk cache) the first time they're called, with a pure-NumPy
+             fallback when numba isn't available
+"""
+
+import os
+
+
+class LazyKernel:
+    """
+    A numba kernel compiled on its first call. Compiled kernels are cached
+    on disk in __pycache__, so later processes just load them. Without numba
+    (or with FLIR_NO_NUMBA=1 set) the NumPy version is called instead.
+
+    Kernels are built by a factory taking the prange to loop with, so
+    numba.prange is only imported when a kernel is compiled. Compiled
+    kernels release the GIL, so threads calling them run in parallel.
+
+        Parameters:
+            factory (func): Called with numba.prange, returns the kernel
+            np_func (func): Vectorized NumPy version with the same arguments
+            signature (str): numba signature, eg. "void(uint8[::1],uint16[::1])"
+            fastmath (bool): Let numba relax IEEE rules. Turn off for kernels
+                             which must match their NumPy version exactly.
+    """
+
+    def __init__(self, factory, np_func, signature, fastmath=True):
+        self.factory   = factory
+        self.np_func   = np_func
+        self.signature = signature
+        self.fastmath  = fastmath
+        self._compiled = None
+
+
+    def _compile(self):
+        try:
+            if os.environ.get("FLIR_NO_NUMBA"):
+                raise ImportError("numba disabled by FLIR_NO_NUMBA")
+            import numba as nb
+        except ImportError:
+            return self.np_func
+
+        return nb.njit(self.signature, fastmath=self.fastmath, parallel=True,
+                       nogil=True, cache=True)(self.factory(nb.prange))
+
+
+    def compile(self):
+        """
+        Compile (or load) the kernel now instead of on its first call, and
+        start numba's thread pool on this thread. Call it on the main thread
+        before calling the kernel from other threads: some of numba's
+        threading layers hang at exit if their pool was started on a thread
+        which has since finished.
+        """
+
+        if self._compiled is None:
+            self._compiled = self._compile()
+        if self._compiled is not self.np_func:
+            import numba as nb
+            nb.get_num_threads()
+
+
+    def __call__(self, *args):
+        if self._compiled is None:
+            self._compiled = self._compile()
+        return self._compiled(*args)
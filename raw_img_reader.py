@@ -12,20 +12,26 @@ Description: reads in an image in .raw format
 ## Module Imports
 import os
 import sys
-import matplotlib.pyplot as plt
 import numpy as np
 import png
-from datetime import datetime
+import shutil
+import struct
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 
 ## Custom Script Imports
-from bitconverter import conv_12to16
+import instrument
+from analyzeframes import readRAW, orientImage
+from frameindex import buildFrameIndex
 
 
 ##############################
 ## 8-bit/16-bit RAW to PNG Converter
 ##############################
 
-def RAWtoPNG(img_path,save_path=None,bitdepth=16):
+def RAWtoPNG(img_path,save_path=None,bitdepth=16,compression=None,orientation=None):
     """
     Convert .raw file into a .png. Saves the file if a savepath is specified.
     Otherwise, just displays it.
@@ -36,18 +42,24 @@ def RAWtoPNG(img_path,save_path=None,bitdepth=16):
                          displays the image.
         bitdepth (int): Bitdepth of output image. 8-bit and 16-bit are
                         currently supported
+        compression (int): zlib compression level (0-9) of the png. None
+                           uses the png module's default.
+        orientation (str): Reorient the image before it's encoded, eg.
+                           "rot180" (see analyzeframes.orientImage)
                             
     Returns:
         None
     """
     
     ## Identify and use the correct image bitdepth to load in the image
-    if bitdepth == 16:
-        img_data = np.fromfile(img_path,dtype=np.uint16)
-    elif bitdepth == 8:
-        img_data = np.fromfile(img_path,dtype=np.uint8)
-    else:
-        raise ValueError("Only 8-bit and 16-bit images are currently supported")
+    with instrument.stage("raw_img_reader.RAWtoPNG.fromfile", frames=1) as st:
+        if bitdepth == 16:
+            img_data = np.fromfile(img_path,dtype=np.uint16)
+        elif bitdepth == 8:
+            img_data = np.fromfile(img_path,dtype=np.uint8)
+        else:
+            raise ValueError("Only 8-bit and 16-bit images are currently supported")
+        st.add(read=img_data.nbytes)
     
     ## Load in the image
     X_DIM    = 1024
@@ -58,28 +70,120 @@ def RAWtoPNG(img_path,save_path=None,bitdepth=16):
         img_data = img_data.reshape((Y_DIM,X_DIM))
     except:
         raise ValueError(f"Invalid image shape {img_data.shape}")
+
+    ## Undo the camera's mounting with a view, so the frame is only copied
+    ## by the encoder
+    img_data = orientImage(img_data, orientation)
     
     
     ## Either show image using matplotlib or save using png
     if save_path == None:
+        import matplotlib.pyplot as plt
         plt.imshow(img_data,cmap="gray")
         plt.show()
         
     elif save_path.lower().endswith(".png"):
-        with open(save_path,"wb") as f:
-            writer = png.Writer(width=X_DIM, height=Y_DIM, bitdepth=bitdepth, greyscale=True)
+        with instrument.stage("raw_img_reader.RAWtoPNG.png", frames=1) as st,\
+             open(save_path,"wb") as f:
+            writer = png.Writer(width=img_data.shape[1], height=img_data.shape[0],
+                                bitdepth=bitdepth, greyscale=True, compression=compression)
             writer.write(f,img_data)
+            st.add(written=f.tell())
     
 
-def RAW_PNG_DirIter(target_dir,output_dir):
+def processPool(workers=None):
+    """
+    Create a process pool for batch conversions. Workers are started from a
+    clean server process rather than forked from this one, as forking after
+    numba's threads have started can hang the pool.
+
+    Parameters:
+        workers (int): Number of processes. None uses every core.
+
+    Returns:
+        pool (ProcessPoolExecutor): The process pool
+    """
+
+    if "forkserver" in mp.get_all_start_methods():
+        context = mp.get_context("forkserver")
+    else:
+        context = mp.get_context("spawn")
+
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+## Orientation of the pngs in an output directory, recorded before the first
+## png is written so an interrupted run can be resumed. Unoriented output is
+## recorded as "none".
+ORIENTATION_FILE = ".orientation"
+
+
+def _readOrientation(output_dir):
+    """
+    Orientation recorded for the pngs in output_dir, or None if there is no
+    record (in which case the orientation of any pngs there is unknown).
+    """
+
+    try:
+        with open(os.path.join(output_dir, ORIENTATION_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _writeOrientation(output_dir, orientation):
+    tmp_path = os.path.join(output_dir, ORIENTATION_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(orientation or "none")
+    os.replace(tmp_path, os.path.join(output_dir, ORIENTATION_FILE))
+
+
+def _RAWtoPNG_UpToDate(raw_path,png_path):
+    """
+    Check if a png output exists and is newer than the .raw it came from.
+    """
+
+    try:
+        return os.stat(png_path).st_mtime >= os.stat(raw_path).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def _RAWtoPNG_Worker(args):
+    """
+    Convert a single .raw file for RAW_PNG_DirIter. The png is written to a
+    hidden temporary file first and renamed into place, so an interrupted
+    run never leaves a partial png that looks up to date.
+    """
+
+    raw_path, png_path, compression, orientation = args
+    tmp_path = os.path.join(os.path.dirname(png_path),
+                            "." + os.path.basename(png_path))
+    RAWtoPNG(raw_path, tmp_path, compression=compression, orientation=orientation)
+    os.replace(tmp_path, png_path)
+
+    return png_path
+
+
+def RAW_PNG_DirIter(target_dir,output_dir,workers=1,compression=None,resume=True,
+                    orientation=None):
     """
     Iterates through a target directory and converts all .raw files present
     into .png files in the given output directory. Uses RAWtoPNG function.
     
     Parameters:
         target_dir (str): Filepath to target directory
-        output_dir (str): Filepath to save directory. Must either not exist
-                          or must be an empty directory.
+        output_dir (str): Filepath to save directory. Must either not exist,
+                          be an empty directory, or hold the output of an
+                          earlier run if resuming.
+        workers (int): Number of processes to convert with. None uses every
+                       core.
+        compression (int): zlib compression level (0-9) of the pngs
+        resume (bool): Skip .raw files whose png is already up to date. If
+                       the pngs were written with another (or an unknown)
+                       orientation, they are deleted and every file is
+                       converted again.
+        orientation (str): Reorient every frame (see RAWtoPNG)
                               
     Returns:
         None
@@ -89,21 +193,67 @@ def RAW_PNG_DirIter(target_dir,output_dir):
     if not os.path.isdir(target_dir):
         raise FileNotFoundError(f"{target_dir} is not an existing directory")
     elif os.path.exists(output_dir):
-        if os.path.isdir(output_dir):
+        if not os.path.isdir(output_dir):
+            raise NotADirectoryError(f"{output_dir} is an existing file")
+        elif not resume:
             os.rmdir(output_dir)
-        else:
-            raise NotADirectoryError(f"{target_dir} is an existing file")
-    os.mkdir(output_dir)
+            os.mkdir(output_dir)
+    else:
+        os.mkdir(output_dir)
     
-    ## Convert RAW files in target_dir into PNG files in output_dir
-    for fname in os.listdir(target_dir):
-        if fname.lower().endswith((".raw")):
-            # Replace .raw with .png
-            png_name = fname[:-4] + ".png"
-            
-            # Call RAWtoPNG() on current raw file
-            RAWtoPNG(target_dir+fname, output_dir+png_name)
-            
+    ## Pair up RAW files in target_dir with PNG files in output_dir
+    raw_paths = buildFrameIndex(target_dir)["path"]
+    png_paths = [os.path.join(output_dir, os.path.basename(raw_path)[:-4] + ".png")
+                 for raw_path in raw_paths]
+
+    ## Earlier output in another orientation is never up to date. It's
+    ## removed before the new orientation is recorded, so an interrupted
+    ## run can't leave the two mixed.
+    if _readOrientation(output_dir) != (orientation or "none"):
+        stale = [png_path for png_path in png_paths if os.path.exists(png_path)]
+        if stale:
+            print(f"Converting every file again, as {output_dir} holds another orientation")
+            for png_path in stale:
+                os.remove(png_path)
+        _writeOrientation(output_dir, orientation)
+
+    jobs    = []
+    skipped = 0
+    for raw_path, png_path in zip(raw_paths, png_paths):
+        # Skip outputs left over from an interrupted run
+        if resume and _RAWtoPNG_UpToDate(raw_path, png_path):
+            skipped += 1
+            continue
+
+        jobs.append((raw_path, png_path, compression, orientation))
+
+    if skipped:
+        print(f"Skipping {skipped} up to date files")
+
+    ## Convert the files, in a process pool if requested
+    if workers == 1:
+        results = map(_RAWtoPNG_Worker, jobs)
+        pool    = None
+    else:
+        pool    = processPool(workers)
+        results = pool.map(_RAWtoPNG_Worker, jobs, chunksize=8)
+
+    ## Stages inside pool workers aren't reported, so time the whole pass
+    start = time.perf_counter()
+    last  = start
+    try:
+        with instrument.stage("raw_img_reader.RAW_PNG_DirIter", frames=len(jobs)):
+            for done, _ in enumerate(results, start=1):
+                # Report progress about once a second
+                now = time.perf_counter()
+                if now - last >= 1 or done == len(jobs):
+                    print(f"Converted {done}/{len(jobs)} frames "
+                          f"({done/max(now-start,1e-9):.1f} frames/s)")
+                    last = now
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
     print("All files converted successfully")
 
 
@@ -111,26 +261,290 @@ def RAW_PNG_DirIter(target_dir,output_dir):
 ## 16-bit RAW to VID Converter
 ##############################
 
-def RAWtoVID(target_dir,save_path):
+## Frame header of the .vid format (little endian, 112 bytes):
+## magic, seqlen, headerlen, flags, seq, unixtime (uint32)
+## num, width, height, depth, hx, ht, cam, reserved0 (uint16)
+## exposure, reserved2 (uint32), text (64 chars, null padded)
+VID_HEADER = struct.Struct("<6I8H2I64s")
+
+## Header values which are the same for every frame. Not well-understood
+## flags are marked with ?
+VID_MAGIC     = 809789782 # ?
+VID_FLAGS     = 999       # ?
+VID_CAM       = 15        # ?
+VID_EXPOSURE  = 33
+VID_TEXT      = b"FLIR-BF"
+
+
+class VidWriter:
+    """
+    Writes 16-bit 1024x768 frames to a .vid file through a single, large
+    buffered file handle. Frame payloads are copied straight from the .raw
+    files with os.sendfile where the platform allows it.
+
+    Credit to Mike Mazur, who's code formed the foundation for this format
+
+    Args:
+        save_path (str): Savepath for the output .vid file
+        append (bool): Append to an existing .vid instead of replacing it
+        buffer_size (int): Size of the write buffer in bytes
+        shape (tuple): (height, width) of the frames, eg. (1024,768) for
+                       frames turned by a quarter
+    """
+
+    X_DIM = 1024
+    Y_DIM = 768
+    DEPTH = 16
+
+    def __init__(self,save_path,append=False,buffer_size=16*1024*1024,shape=None):
+
+        self.save_path   = save_path
+        if shape is not None:
+            self.Y_DIM, self.X_DIM = shape
+        self.frame_bytes = self.X_DIM*self.Y_DIM*self.DEPTH//8
+        # Appends seek to the end rather than opening with O_APPEND, which
+        # sendfile won't write to
+        if append and os.path.exists(save_path):
+            self.f = open(save_path, "r+b", buffering=buffer_size)
+            # Drop a frame left half written by an interrupted run
+            record = VID_HEADER.size + self.frame_bytes
+            self.f.seek(self.f.seek(0, os.SEEK_END)//record*record)
+            self.f.truncate()
+        else:
+            self.f = open(save_path, "wb", buffering=buffer_size)
+        self.seq = self.f.tell()//(VID_HEADER.size + self.frame_bytes)
+
+
+    def header(self,unixtime):
+        """
+        Pack the header of the next frame.
+        """
+
+        return VID_HEADER.pack(VID_MAGIC, self.X_DIM*self.Y_DIM, VID_HEADER.size,
+                               VID_FLAGS, self.seq, int(unixtime),
+                               1, self.X_DIM, self.Y_DIM, self.DEPTH,
+                               0, 0, VID_CAM, 0,
+                               VID_EXPOSURE, 0, VID_TEXT)
+
+
+    def writeRAW(self,raw_path,unixtime):
+        """
+        Append a .raw file as the next frame.
+
+        Args:
+            raw_path (str): Filepath to the .raw frame
+            unixtime (float): Observation time of the frame
+        """
+
+        with instrument.stage("raw_img_reader.VidWriter.write", frames=1,
+                              read=self.frame_bytes,
+                              written=VID_HEADER.size + self.frame_bytes),\
+             open(raw_path, "rb") as raw:
+            size = os.fstat(raw.fileno()).st_size
+            if size != self.frame_bytes:
+                raise ValueError(f"{raw_path} is {size} bytes, not {self.frame_bytes}")
+
+            self.f.write(self.header(unixtime))
+
+            # Copy the payload file-to-file in the kernel if possible
+            if hasattr(os, "sendfile"):
+                self.f.flush()
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(self.f.fileno(), raw.fileno(), offset, size-offset)
+                    if sent == 0:
+                        raise OSError(f"Unexpected end of {raw_path}")
+                    offset += sent
+                self.f.seek(0, os.SEEK_END)
+            else:
+                shutil.copyfileobj(raw, self.f, size)
+
+        self.seq += 1
+
+
+    def writeFrame(self,img_data,unixtime):
+        """
+        Append an in-memory frame as the next frame.
+
+        Args:
+            img_data (arr): (Y_DIM,X_DIM) uint16 frame
+            unixtime (float): Observation time of the frame
+        """
+
+        img_data = np.ascontiguousarray(img_data, dtype="<u2")
+        if img_data.nbytes != self.frame_bytes:
+            raise ValueError(f"Invalid image shape {img_data.shape}")
+
+        with instrument.stage("raw_img_reader.VidWriter.write", frames=1,
+                              written=VID_HEADER.size + self.frame_bytes):
+            self.f.write(self.header(unixtime))
+            self.f.write(img_data.data)
+        self.seq += 1
+
+
+    def close(self):
+        self.f.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+## Same header as a NumPy record, for reading many headers at once
+VID_DTYPE = np.dtype([("magic","<u4"), ("seqlen","<u4"), ("headerlen","<u4"),
+                      ("flags","<u4"), ("seq","<u4"), ("unixtime","<u4"),
+                      ("num","<u2"), ("width","<u2"), ("height","<u2"),
+                      ("depth","<u2"), ("hx","<u2"), ("ht","<u2"),
+                      ("cam","<u2"), ("reserved0","<u2"),
+                      ("exposure","<u4"), ("reserved2","<u4"),
+                      ("text","S64")])
+
+
+class VidReader:
+    """
+    Random-access reader for .vid files written by RAWtoVID. The file is
+    memory-mapped and viewed as an array of (header, frame) records, so
+    frames are zero-copy uint16 views and only the frames touched are read
+    from disk. The headers are gathered into a structured index in one
+    vectorized pass.
+
+    Args:
+        vid_path (str): Filepath to the .vid file
+
+    Attributes:
+        index (arr): Structured array of every frame header (VID_DTYPE)
+        times (arr): Unix time of every frame
+    """
+
+    def __init__(self,vid_path):
+
+        ## Sanitize inputs
+        if not os.path.isfile(vid_path):
+            raise FileNotFoundError(f"{vid_path} does not exist")
+        self.vid_path = vid_path
+
+        ## Frame size comes from the first header; every frame is the same
+        first = np.fromfile(vid_path, dtype=VID_DTYPE, count=1)
+        if len(first) == 0:
+            raise ValueError(f"{vid_path} is empty")
+        first = first[0]
+        if first["headerlen"] != VID_DTYPE.itemsize or first["magic"] != VID_MAGIC:
+            raise ValueError(f"{vid_path} does not start with a {VID_DTYPE.itemsize}-byte vid header")
+
+        self.shape = (int(first["height"]),int(first["width"]))
+        depth      = np.dtype("<u2") if first["depth"] == 16 else np.dtype("u1")
+        record     = np.dtype([("header",VID_DTYPE), ("data",depth,self.shape)])
+
+        size = os.path.getsize(vid_path)
+        if size % record.itemsize != 0:
+            raise ValueError(f"{vid_path} is not a whole number of {record.itemsize}-byte frames")
+
+        ## Map the whole file and pull out every header at once
+        self._records = np.memmap(vid_path, dtype=record, mode="r")
+        self.index    = np.array(self._records["header"])
+        if np.any(self.index["magic"] != VID_MAGIC):
+            bad = np.flatnonzero(self.index["magic"] != VID_MAGIC)[0]
+            raise ValueError(f"Frame {bad} of {vid_path} has a bad header")
+
+        self.times = self.index["unixtime"].astype(np.float64)
+
+        ## Frames are written in time order, but keep a sort for other files
+        if np.all(self.times[1:] >= self.times[:-1]):
+            self._order = None
+        else:
+            self._order = np.argsort(self.times, kind="stable")
+
+
+    def __len__(self):
+        return len(self._records)
+
+
+    def frame(self,i):
+        """
+        Zero-copy view of the i-th frame in the file.
+        """
+
+        return self._records["data"][i]
+
+
+    def __getitem__(self,i):
+        return self.frame(i)
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+
+    def between(self,t_start,t_end):
+        """
+        Find the frames observed between two unix times with a binary search.
+
+        Args:
+            t_start (float): Start of the window
+            t_end (float): End of the window, inclusive
+
+        Returns:
+            frame_nums (arr): Positions of the frames in the file, in time order
+        """
+
+        if self._order is None:
+            start = np.searchsorted(self.times, t_start, side="left")
+            end   = np.searchsorted(self.times, t_end, side="right")
+            return np.arange(start, end)
+
+        sorted_t = self.times[self._order]
+        start    = np.searchsorted(sorted_t, t_start, side="left")
+        end      = np.searchsorted(sorted_t, t_end, side="right")
+        return self._order[start:end]
+
+
+    def close(self):
+        # Frames already handed out keep the mapping alive until released
+        self._records = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+def RAWtoVID(target_dir,save_path,orientation=None):
     """
     Converts all .raw files in target directory into a single .vid file at
-    save_path. Assumes 16-bit data and 1024x768 pixelshape and that the .raw
-    filename is of the format "hh_mm_ss_fff.raw".
+    save_path, in order of observation time. Assumes 16-bit data and
+    1024x768 pixelshape and that the .raw filename is of the format
+    "hh_mm_ss_fff.raw". An archived night (see archive.py) is decoded
+    instead.
     
     Credit to Mike Mazur, who's code formed the foundation for this function
 
     Args:
-        target_dir (str): Filepath to target directory. Assumes first 8
-                          characters are YYYYMMDD of observation.
+        target_dir (str): Filepath to target directory, or its .rawz
+                          archive. Assumes first 8 characters are YYYYMMDD
+                          of observation.
         save_path (str): Savepath for the output .vid file
+        orientation (str): Reorient every frame (see
+                           analyzeframes.orientImage). Frames are then read
+                           and written rather than copied file-to-file.
 
     Returns:
         None
 
     """
 
+    from archive import findArchive, ArchiveReader
+
     ## Sanitize inputs
-    if not os.path.isdir(target_dir):
+    archive_path = None if os.path.isdir(target_dir) else findArchive(target_dir)
+    if not os.path.isdir(target_dir) and archive_path is None:
         raise FileNotFoundError(f"{target_dir} is not an existing directory")
     elif not save_path.lower().endswith(".vid"):
         sys.exit(f"{save_path} is not a .vid file")
@@ -141,81 +555,35 @@ def RAWtoVID(target_dir,save_path):
     ## Get date from target_dir
     target_basename = os.path.basename(os.path.normpath(target_dir))
     try:
-        YYYY = int(target_basename[:4])
-        MM   = int(target_basename[4:6])
-        DD   = int(target_basename[6:8])
+        night = datetime.strptime(target_basename[:8],"%Y%m%d").replace(tzinfo=timezone.utc)
     except ValueError:
-        raise ValueError(f"{target_basename} needs to have YYYYMMDD as the first 4 characters")
-    
+        raise ValueError(f"{target_basename} needs to have YYYYMMDD as the first 8 characters")
     
-    ## Iterate through .raw files in target_dir and write them to a vid file
-    ## taking the time from the filename (assuming)
-    n = 0 #frame number
-    for fname in os.listdir(target_dir):
-        if fname.lower().endswith(".raw"):
-            print(fname)
-            # Define image dimensions
-            X_DIM = 1024
-            Y_DIM = 768
-            
-            # Define image header for this frame (number of bytes == inline
-            # comment). Not well-understood flags have ? in the inline comment
-            magic = 809789782 # 4?
-            seqlen = X_DIM*Y_DIM # 4
-            headerlen = 112 # 4
-            flags = 999 # 4?
-            seq = n # 4
-            num = 1 # 2
-            width = X_DIM # 2
-            height = Y_DIM # 2
-            depth = 16 # 2
-            hx = 0 # 2?
-            ht = 0 # 2?
-            cam = 15 # 2?
-            reserved0 = 000 # 2?
-            exposure = 33 # 4
-            reserved2 = 000 # 4?
-            text = "FLIR-BF" # 64
-            
-            # Get time from filename and generate timestamp
-            obs_time  = fname.strip(".raw")
-            if int(obs_time[:2]) < 16: # set day to next if over 24h
-                DD += 1
-            timestamp = datetime.strptime(f"{target_basename[:8]} {obs_time} UTC",
-                                          "%Y%m%d %H_%M_%S_%f %Z")
-            unixtime = datetime.timestamp(timestamp)
-            unixtime = int(unixtime)
-            
-            
-            # Write to file in big endian order
-            with open(save_path, "ab") as f:
-                # Write header information
-                f.write((magic).to_bytes(4, byteorder='little'))
-                f.write((seqlen).to_bytes(4, byteorder='little'))
-                f.write((headerlen).to_bytes(4, byteorder='little'))
-                f.write((flags).to_bytes(4, byteorder='little'))
-                f.write((seq).to_bytes(4, byteorder='little'))
-                f.write((unixtime).to_bytes(4, byteorder='little'))
-                f.write((num).to_bytes(2, byteorder='little'))
-                f.write((width).to_bytes(2, byteorder='little'))
-                f.write((height).to_bytes(2, byteorder='little'))
-                f.write((depth).to_bytes(2, byteorder='little'))
-                f.write((hx).to_bytes(2, byteorder='little'))
-                f.write((ht).to_bytes(2, byteorder='little'))
-                f.write((cam).to_bytes(2, byteorder='little'))
-                f.write((reserved0).to_bytes(2, byteorder='little'))
-                f.write((exposure).to_bytes(4, byteorder='little'))
-                f.write((reserved2).to_bytes(4, byteorder='little'))
-                f.write(text.encode())
-                for i in range(52):
-                    f.write((0).to_bytes(1,byteorder='little'))
-                    
-                # Read in the data and write to file
-                fpath = os.path.join(target_dir, fname)
-                img_data = np.fromfile(fpath, dtype=np.uint16)
-                img_data.tofile(f)
-                
-            n += 1 # add 1 to the frame number
+    ## Stream the frames into the vid file through one handle
+    shape = (VidWriter.Y_DIM, VidWriter.X_DIM)
+    if orientation in ("rot90","rot270"):
+        shape = shape[::-1]
+
+    ## Archived frames are decoded a few chunks ahead on a thread pool
+    if archive_path is not None:
+        with ArchiveReader(archive_path) as frames, VidWriter(save_path, shape=shape) as vid:
+            for obs_t, frame in zip(frames.times, frames):
+                vid.writeFrame(orientImage(frame, orientation), night.timestamp() + obs_t)
+        print(f"Wrote {len(frames)} frames to {save_path}")
+        return
+
+    ## The frame index orders the .raw files in target_dir by their time
+    ## since the start of the night (from the filename)
+    frames = buildFrameIndex(target_dir)
+
+    with VidWriter(save_path, shape=shape) as vid:
+        for obs_t, fpath in zip(frames["time"], frames["path"]):
+            if orientation is None:
+                vid.writeRAW(fpath, night.timestamp() + obs_t)
+            else:
+                vid.writeFrame(readRAW(fpath, orientation=orientation), night.timestamp() + obs_t)
+
+    print(f"Wrote {len(frames)} frames to {save_path}")
     
 
 ##############################
@@ -1,31 +1,92 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Filename:      
+Filename:   rotatepng.py
 Author(s):  Peter Quigley
 Contact:    pquigley@uwo.ca
 Created:    Wed Nov 16 10:25:26 2022
-Updated:    Wed Nov 16 10:25:26 2022
+Updated:    Sat Oct 17 16:31:12 2026
     
-Usage:
-$Description$
+Usage: python3 rotatepng.py PNG_DIR [ORIENTATION] [WORKERS]
+Description: reorients a directory of existing pngs (rot180 by default) into
+             PNG_DIR-rot, keeping their bitdepth. New conversions should pass
+             an orientation to RAWtoPNG/RAW_PNG_DirIter instead.
 """
 
 import os,sys
-from PIL import Image
+import png
+import numpy as np
 from pathlib import Path
 
+## Custom Script Imports
+from analyzeframes import orientImage, ORIENTATIONS
 
-imgpath = Path(sys.argv[1])
-outpath = imgpath.parent/(imgpath.stem+'-rot')
 
-if not outpath.is_dir():
-    outpath.mkdir()
+def rotatePNG(args):
+    """
+    Reorient a single png, decoding and encoding it once with pypng so
+    16-bit images stay 16-bit. Colour images are turned as a whole.
+    """
 
-for file in imgpath.glob('*.png'):
-    print(file,type(file))
-    with Image.open(file) as unrotated:
-        rotated = unrotated.rotate(180)
-        rotated.save(outpath/file.name)
-    
-    
\ No newline at end of file
+    png_path, save_path, orientation = args
+
+    width, height, rows, info = png.Reader(filename=str(png_path)).asDirect()
+    planes   = info["planes"]
+    dtype    = np.uint16 if info["bitdepth"] > 8 else np.uint8
+    img_data = np.vstack([np.asarray(row, dtype=dtype) for row in rows])
+    img_data = img_data.reshape(height, width, planes)
+
+    ## Turn the pixels, not the colour planes
+    img_data = np.moveaxis(orientImage(np.moveaxis(img_data, -1, 0), orientation), 0, -1)
+
+    writer = png.Writer(width=img_data.shape[1], height=img_data.shape[0],
+                        bitdepth=info["bitdepth"], greyscale=info["greyscale"],
+                        alpha=info["alpha"])
+    with open(save_path, "wb") as f:
+        writer.write(f, img_data.reshape(img_data.shape[0], -1))
+
+    return save_path
+
+
+def rotatePNGDir(img_dir, output_dir=None, orientation="rot180", workers=None):
+    """
+    Reorient every png in a directory, in a process pool.
+
+        Parameters:
+            img_dir (str): Directory of pngs
+            output_dir (str): Directory for the output. Defaults to a -rot
+                              directory beside img_dir.
+            orientation (str): See analyzeframes.orientImage
+            workers (int): Number of processes. None uses every core.
+    """
+
+    from raw_img_reader import processPool
+
+    if orientation not in ORIENTATIONS:
+        raise ValueError(f"Orientation must be one of {ORIENTATIONS}")
+
+    img_dir    = Path(img_dir)
+    output_dir = Path(output_dir) if output_dir else img_dir.parent/(img_dir.stem+'-rot')
+    output_dir.mkdir(exist_ok=True)
+
+    jobs = [(file, output_dir/file.name, orientation) for file in sorted(img_dir.glob('*.png'))]
+    if workers == 1 or len(jobs) <= 1:
+        list(map(rotatePNG, jobs))
+    else:
+        with processPool(workers) as pool:
+            list(pool.map(rotatePNG, jobs, chunksize=8))
+
+    print(f"Reoriented {len(jobs)} pngs into {output_dir}")
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 1:
+        print("Usage: python3 rotatepng.py PNG_DIR [ORIENTATION] [WORKERS]")
+        sys.exit()
+    elif not os.path.isdir(sys.argv[1]):
+        sys.exit(f"{sys.argv[1]} is not a directory")
+
+    orientation = sys.argv[2] if len(sys.argv) > 2 else "rot180"
+    workers     = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    rotatePNGDir(sys.argv[1], orientation=orientation, workers=workers)
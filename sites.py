@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   sites.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 15:48:06 2026
+Updated:    Sat Oct 17 15:48:06 2026
+
+Usage: python3 sites.py [NETWORK]
+Description: registry of the camera network stations in sites.conf, with
+             vectorized geodesy to triangulate events seen by more than one
+             station
+"""
+
+# Module Imports
+import os,sys
+import numpy as np
+from functools import lru_cache
+
+
+## sites.conf lives beside this script
+SITES_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sites.conf")
+
+## Compiled registry sits beside the conf file
+REGISTRY_SUFFIX = ".registry.npz"
+
+## One row per station. Stations are numbered by row; IDs aren't unique
+## (@cmor reuses 03, 04 and 05), so "dup" counts earlier rows with the same
+## network and ID. FOV comes from the network's profile line.
+SITE_DTYPE = np.dtype([("network","U16"), ("id","U4"), ("dup","i2"), ("name","U32"),
+                       ("lat","f8"), ("lon","f8"), ("elev","f8"), ("fov","f8"),
+                       ("x","f8"), ("y","f8"), ("z","f8")])
+
+## WGS84 ellipsoid
+WGS84_A  = 6378137.0
+WGS84_F  = 1/298.257223563
+WGS84_E2 = WGS84_F*(2 - WGS84_F)
+
+
+##############################
+## Registry
+##############################
+
+def parseSitesConf(conf_path=SITES_CONF):
+    """
+    Parse sites.conf. Profile lines "@name LAT LON FOV" start a network and
+    every following "ID LAT LON ELEV NAME..." line is one of its stations.
+
+        Parameters:
+            conf_path (str): Path to sites.conf
+
+        Returns:
+            sites (arr): SITE_DTYPE array in file order
+    """
+
+    rows, network, fov, seen = [], None, np.nan, {}
+    with open(conf_path) as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.split("#",1)[0].strip()
+            if not line:
+                continue
+
+            fields = line.split()
+            if fields[0].startswith("@"):
+                network, fov = fields[0][1:], float(fields[3])
+                continue
+            if network is None or len(fields) < 5:
+                raise ValueError(f"{conf_path}:{line_num}: expected a station after a profile line")
+
+            site_id = fields[0]
+            dup     = seen.get((network, site_id), 0)
+            seen[(network, site_id)] = dup + 1
+            rows.append((network, site_id, dup, " ".join(fields[4:]),
+                         float(fields[1]), float(fields[2]), float(fields[3]), fov,
+                         0, 0, 0))
+
+    sites = np.array(rows, dtype=SITE_DTYPE)
+    sites["x"], sites["y"], sites["z"] = geodeticToECEF(sites["lat"], sites["lon"], sites["elev"])
+
+    return sites
+
+
+@lru_cache(maxsize=4)
+def _loadSites(conf_path, mtime_ns, size):
+    cache_path = conf_path + REGISTRY_SUFFIX
+    try:
+        with np.load(cache_path) as cache:
+            if (int(cache["mtime_ns"]), int(cache["size"])) == (mtime_ns, size):
+                sites = cache["sites"]
+                sites.flags.writeable = False
+                return sites
+    except (OSError, ValueError, KeyError):
+        pass
+
+    sites = parseSitesConf(conf_path)
+    try:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, sites=sites, mtime_ns=np.int64(mtime_ns), size=np.int64(size))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+    sites.flags.writeable = False
+    return sites
+
+
+def loadSites(network=None, conf_path=SITES_CONF):
+    """
+    Station registry, compiled from sites.conf once and cached beside it
+    (and in memory) until the file changes.
+
+        Parameters:
+            network (str): Only this network's stations. None for all.
+            conf_path (str): Path to sites.conf
+
+        Returns:
+            sites (arr): Read-only SITE_DTYPE array
+    """
+
+    conf_path = os.path.abspath(conf_path)
+    st        = os.stat(conf_path)
+    sites     = _loadSites(conf_path, st.st_mtime_ns, st.st_size)
+
+    if network is None:
+        return sites
+    if network not in sites["network"]:
+        raise ValueError(f"{network} is not a network in {conf_path}")
+    return sites[sites["network"] == network]
+
+
+def siteIndex(sites, site_ids, dups=None):
+    """
+    Rows of stations by ID. An ID shared by more than one station (@cmor
+    reuses 03, 04 and 05) needs its "dup" to say which station is meant;
+    without it the lookup raises rather than pick one.
+
+        Parameters:
+            sites (arr): SITE_DTYPE array of one network
+            site_ids (list): Station IDs
+            dups (list): "dup" of each ID. None if every ID is unique.
+
+        Returns:
+            rows (arr): Row of each ID in sites
+    """
+
+    site_ids = np.asarray(site_ids, dtype=sites["id"].dtype)
+    if dups is None:
+        keys, wanted = sites["id"], site_ids
+    else:
+        key_dtype = np.dtype([("id",sites["id"].dtype), ("dup","i2")])
+        keys      = np.empty(len(sites), dtype=key_dtype)
+        wanted    = np.empty(len(site_ids), dtype=key_dtype)
+        keys["id"], keys["dup"]     = sites["id"], sites["dup"]
+        wanted["id"], wanted["dup"] = site_ids, dups
+
+    ## Look up each key among the distinct ones, keeping its first row
+    unique, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    where = np.minimum(np.searchsorted(unique, wanted), len(unique)-1)
+
+    missing = unique[where] != wanted
+    if np.any(missing):
+        raise ValueError(f"Unknown station IDs: {sorted(set(wanted[missing].tolist()))}")
+    shared = counts[where] > 1
+    if np.any(shared):
+        raise ValueError(f"Station IDs shared by more than one station, "
+                         f"which need their dup: {sorted(set(wanted[shared].tolist()))}")
+
+    return first[where]
+
+
+##############################
+## Geodesy
+##############################
+
+def geodeticToECEF(lat, lon, elev):
+    """
+    WGS84 latitude/longitude (degrees) and height (m) to Earth-centred
+    Earth-fixed coordinates (m).
+    """
+
+    lat, lon = np.radians(lat), np.radians(lon)
+    N = WGS84_A/np.sqrt(1 - WGS84_E2*np.sin(lat)**2)
+
+    x = (N + elev)*np.cos(lat)*np.cos(lon)
+    y = (N + elev)*np.cos(lat)*np.sin(lon)
+    z = (N*(1 - WGS84_E2) + elev)*np.sin(lat)
+
+    return x, y, z
+
+
+def ecefToGeodetic(x, y, z, iterations=4):
+    """
+    Earth-centred Earth-fixed coordinates (m) to WGS84 latitude/longitude
+    (degrees) and height (m), by fixed-point iteration on the latitude.
+    """
+
+    lon = np.arctan2(y, x)
+    p   = np.hypot(x, y)
+    lat = np.arctan2(z, p*(1 - WGS84_E2))
+    for _ in range(iterations):
+        N   = WGS84_A/np.sqrt(1 - WGS84_E2*np.sin(lat)**2)
+        h   = p/np.cos(lat) - N
+        lat = np.arctan2(z, p*(1 - WGS84_E2*N/(N + h)))
+    N = WGS84_A/np.sqrt(1 - WGS84_E2*np.sin(lat)**2)
+    h = p/np.cos(lat) - N
+
+    return np.degrees(lat), np.degrees(lon), h
+
+
+def siteECEF(sites):
+    """
+    (N, 3) ECEF positions of stations.
+    """
+
+    return np.column_stack((sites["x"], sites["y"], sites["z"]))
+
+
+def baselines(sites):
+    """
+    Straight-line distance (m) between every pair of stations.
+
+        Parameters:
+            sites (arr): SITE_DTYPE array
+
+        Returns:
+            dist (arr): (N, N) distance matrix
+    """
+
+    pos = siteECEF(sites)
+    return np.linalg.norm(pos[:,None,:] - pos[None,:,:], axis=-1)
+
+
+def sightlineECEF(lat, lon, azimuth, altitude):
+    """
+    Unit ECEF direction of sightlines from stations, given azimuth (east of
+    north) and altitude in degrees. Any matching shapes broadcast.
+
+        Returns:
+            direction (arr): (..., 3) unit vectors
+    """
+
+    lat, lon = np.radians(lat), np.radians(lon)
+    az, alt  = np.radians(azimuth), np.radians(altitude)
+
+    ## Local east, north and up in ECEF
+    east  = np.stack((-np.sin(lon), np.cos(lon), np.zeros_like(lon)), axis=-1)
+    north = np.stack((-np.sin(lat)*np.cos(lon), -np.sin(lat)*np.sin(lon), np.cos(lat)), axis=-1)
+    up    = np.stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)), axis=-1)
+
+    e = (np.cos(alt)*np.sin(az))[...,None]
+    n = (np.cos(alt)*np.cos(az))[...,None]
+    u = np.sin(alt)[...,None]
+
+    return e*east + n*north + u*up
+
+
+def triangulate(p1, d1, p2, d2):
+    """
+    Closest approach of pairs of sightlines, all at once. Each sightline is
+    a station position and unit direction; the triangulated point is the
+    midpoint of the shortest segment between the two lines.
+
+        Parameters:
+            p1, p2 (arr): (..., 3) ECEF station positions (m)
+            d1, d2 (arr): (..., 3) unit ECEF directions
+
+        Returns:
+            point (arr): (..., 3) triangulated ECEF positions (m)
+            miss (arr): Distance (m) between the sightlines at closest approach
+            range1, range2 (arr): Distance (m) along each sightline. Negative
+                                  or NaN (parallel lines) means the lines
+                                  don't meet in front of both stations.
+    """
+
+    w0 = p1 - p2
+    b  = np.sum(d1*d2, axis=-1)
+    d  = np.sum(d1*w0, axis=-1)
+    e  = np.sum(d2*w0, axis=-1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denom  = 1 - b*b
+        denom  = np.where(denom > 1e-12, denom, np.nan)
+        range1 = (b*e - d)/denom
+        range2 = (e - b*d)/denom
+
+    q1 = p1 + range1[...,None]*d1
+    q2 = p2 + range2[...,None]*d2
+
+    return (q1 + q2)/2, np.linalg.norm(q1 - q2, axis=-1), range1, range2
+
+
+##############################
+## Multi-Station Pairing
+##############################
+
+## One sighting of an event from a station: the row of the station in the
+## registry, and a time with the sightline at that time
+SIGHTING_DTYPE = np.dtype([("site","i8"), ("time","f8"), ("azimuth","f8"), ("altitude","f8")])
+
+## One row per coincident pair of sightings, indices into the sightings
+PAIR_DTYPE = np.dtype([("first","i8"), ("second","i8"), ("dt","f8"), ("baseline","f8"),
+                       ("miss","f8"), ("lat","f8"), ("lon","f8"), ("height","f8")])
+
+
+def pairEvents(sightings, sites, max_dt=2.0, max_miss=5000.0, heights=(20e3,200e3)):
+    """
+    Find sightings from different stations close enough in time to be the
+    same event, and triangulate every candidate pair at once.
+
+    Sightings are sorted by time and each one's partners are the ones after
+    it within max_dt, found with a single searchsorted; the candidate pairs
+    are then expanded, triangulated and filtered as whole arrays.
+
+        Parameters:
+            sightings (arr): SIGHTING_DTYPE array
+            sites (arr): SITE_DTYPE registry the sightings' rows refer to
+            max_dt (float): Largest time difference (s) of a pair
+            max_miss (float): Largest miss distance (m) of the sightlines
+            heights (tuple): Range of triangulated heights (m) kept
+
+        Returns:
+            pairs (arr): PAIR_DTYPE array, sorted by the first sighting's time
+    """
+
+    order = np.argsort(sightings["time"], kind="stable")
+    times = sightings["time"][order]
+
+    ## Every sighting pairs with those after it, up to max_dt later
+    stop   = np.searchsorted(times, times + max_dt, side="right")
+    counts = stop - np.arange(len(times)) - 1
+    first  = np.repeat(np.arange(len(times)), counts)
+    second = first + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    first, second = order[first], order[second]
+
+    ## Pairs need two different stations
+    site1, site2  = sightings["site"][first], sightings["site"][second]
+    keep          = site1 != site2
+    first, second = first[keep], second[keep]
+    site1, site2  = site1[keep], site2[keep]
+
+    ## Triangulate all the candidates together
+    pos = siteECEF(sites)
+    d1  = sightlineECEF(sites["lat"][site1], sites["lon"][site1],
+                        sightings["azimuth"][first], sightings["altitude"][first])
+    d2  = sightlineECEF(sites["lat"][site2], sites["lon"][site2],
+                        sightings["azimuth"][second], sightings["altitude"][second])
+    point, miss, range1, range2 = triangulate(pos[site1], d1, pos[site2], d2)
+    lat, lon, height = ecefToGeodetic(*point.T)
+
+    with np.errstate(invalid="ignore"):
+        keep = (range1 > 0) & (range2 > 0) & (miss <= max_miss) &\
+               (height >= heights[0]) & (height <= heights[1])
+
+    pairs = np.empty(np.count_nonzero(keep), dtype=PAIR_DTYPE)
+    pairs["first"]    = first[keep]
+    pairs["second"]   = second[keep]
+    pairs["dt"]       = sightings["time"][second[keep]] - sightings["time"][first[keep]]
+    pairs["baseline"] = np.linalg.norm(pos[site1[keep]] - pos[site2[keep]], axis=-1)
+    pairs["miss"]     = miss[keep]
+    pairs["lat"], pairs["lon"], pairs["height"] = lat[keep], lon[keep], height[keep]
+
+    return pairs
+
+
+def storeSightings(store, t_start, t_end, network="somn"):
+    """
+    Sightings of the events in an EventStore over a time range, one per
+    event at its middle point. The store only knows station IDs, so a
+    network that shares an ID between stations raises (see siteIndex).
+
+        Parameters:
+            store (EventStore): Event store of the network's stations
+            t_start, t_end (float): Time range in unix seconds
+            network (str): Network the store's station IDs belong to
+
+        Returns:
+            sightings (arr): SIGHTING_DTYPE array
+            sites (arr): The network's registry the sightings refer to
+    """
+
+    sites = loadSites(network)
+    found = store.query(t_start, t_end, [site for site in store.sites if site in sites["id"]])
+
+    sightings = []
+    for site_id, events in found.items():
+        row = siteIndex(sites, [site_id])[0]
+        for event in events:
+            mid = store.points(site_id, event)[event["count"]//2]
+            sightings.append((row, mid["time"], mid["azimuth"], mid["altitude"]))
+
+    return np.array(sightings, dtype=SIGHTING_DTYPE), sites
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    network = sys.argv[1] if len(sys.argv) > 1 else None
+    sites   = loadSites(network)
+
+    for site in sites:
+        dup = f" (duplicate {site['dup']})" if site["dup"] else ""
+        print(f"{site['network']:>8} {site['id']:>3} {site['name']:<16} "
+              f"{site['lat']:9.5f} {site['lon']:10.5f} {site['elev']:7.1f} m{dup}")
+
+    if network is not None and len(sites) > 1:
+        dist = baselines(sites)[np.triu_indices(len(sites), 1)]
+        print(f"{len(sites)} stations, baselines {dist.min()/1e3:.1f} to {dist.max()/1e3:.1f} km")
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   sources.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 13:02:09 2026
+Updated:    Sat Oct 17 13:41:52 2026
+
+Usage: from sources import extractSources, extractSourcesStack
+Description: star/source extraction by local-maximum detection with
+             sub-pixel centroids, for astrometry and photometry
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+## One row per source found in a frame, and per source in a stack of frames
+SOURCE_DTYPE       = np.dtype([("x","f8"), ("y","f8"), ("flux","f8"), ("fwhm","f4")])
+STACK_SOURCE_DTYPE = np.dtype([("frame","i8")] + SOURCE_DTYPE.descr)
+
+## FWHM of a Gaussian in units of its sigma
+GAUSS_FWHM = 2*np.sqrt(2*np.log(2))
+
+## FWHMs are measured within a circular aperture grown to 3x the FWHM, so
+## the wings of the profile aren't cut off, inside a stamp of this width
+FWHM_STAMP = 21
+
+
+##############################
+## Vectorized Extraction
+##############################
+
+## Every step works on the last two axes, so a whole (N, height, width)
+## chunk of frames is processed with the same array operations as one frame
+
+def backgroundRMS(img, step=4):
+    """
+    Robust background level and RMS of an image, or of each image in a
+    stack, from the median and MAD of a subsample of its pixels.
+
+        Parameters:
+            img (arr): 2D image or (N, height, width) stack
+            step (int): Subsampling step in each direction
+
+        Returns:
+            bkg (float/arr): Background level of each image
+            rms (float/arr): Background RMS of each image
+    """
+
+    sample = np.asarray(img[...,::step,::step], dtype=np.float32)
+    sample = sample.reshape(sample.shape[:-2] + (-1,))
+    bkg    = np.median(sample, axis=-1)
+    rms    = 1.4826*np.median(np.abs(sample - bkg[...,None]), axis=-1)
+    rms    = np.maximum(rms, 1e-6)
+
+    if np.ndim(bkg) == 0:
+        return float(bkg), float(rms)
+    return bkg, rms
+
+
+def localMaxima(resid, threshold):
+    """
+    Pixels above a threshold which are the maximum of their 3x3
+    neighbourhood. Flat-topped peaks (eg. saturated stars) only give one
+    pixel, as ties are broken towards the first pixel of the plateau.
+
+        Parameters:
+            resid (arr): 2D background-subtracted image or (N, height,
+                         width) stack
+            threshold (float/arr): Minimum peak value, or one per image
+
+        Returns:
+            peaks (tuple): Index arrays of the peaks, as from np.nonzero
+    """
+
+    H, W  = resid.shape[-2:]
+    core  = resid[...,1:-1,1:-1]
+    peaks = core > np.reshape(threshold, np.shape(threshold) + (1,1))
+    for dy in (-1,0,1):
+        for dx in (-1,0,1):
+            if dy == 0 and dx == 0:
+                continue
+            neighbour = resid[...,1+dy:H-1+dy,1+dx:W-1+dx]
+            # Strictly brighter than neighbours before it, at least as bright
+            # as the ones after it
+            if (dy, dx) < (0, 0):
+                peaks &= core > neighbour
+            else:
+                peaks &= core >= neighbour
+
+    *frames, ys, xs = np.nonzero(peaks)
+    return (*frames, ys + 1, xs + 1)
+
+
+def centroid(resid, peaks, box=5):
+    """
+    Sub-pixel centroid and flux of sources from the first moments of a box
+    around each peak, and their FWHM (see measureFWHM).
+
+        Parameters:
+            resid (arr): 2D background-subtracted image or (N, height,
+                         width) stack
+            peaks (tuple): Peak indices from localMaxima, at least box//2
+                           from the edge
+            box (int): Odd width of the centroiding box
+
+        Returns:
+            peaks (tuple): The peaks kept (those with positive flux)
+            sources (arr): SOURCE_DTYPE array
+    """
+
+    half   = box//2
+    dy, dx = np.mgrid[-half:half+1,-half:half+1]
+    *frames, ys, xs = peaks
+    frames = tuple(f[:,None,None] for f in frames)
+    cut    = resid[frames + (ys[:,None,None] + dy, xs[:,None,None] + dx)]
+    cut    = np.clip(cut, 0, None).astype(np.float64)
+
+    flux  = cut.sum(axis=(1,2))
+    good  = flux > 0
+    peaks = tuple(index[good] for index in peaks)
+    cut, flux, ys, xs = cut[good], flux[good], ys[good], xs[good]
+
+    mx  = (cut*dx).sum(axis=(1,2))/flux
+    my  = (cut*dy).sum(axis=(1,2))/flux
+    var = (cut*((dx - mx[:,None,None])**2 + (dy - my[:,None,None])**2)).sum(axis=(1,2))/(2*flux)
+
+    sources = np.empty(len(flux), dtype=SOURCE_DTYPE)
+    sources["x"]    = xs + mx
+    sources["y"]    = ys + my
+    sources["flux"] = flux
+    sources["fwhm"] = measureFWHM(resid, peaks, sources["x"], sources["y"],
+                                  GAUSS_FWHM*np.sqrt(var))
+
+    return peaks, sources
+
+
+def measureFWHM(resid, peaks, x, y, fwhm, iterations=5, stamp=FWHM_STAMP):
+    """
+    FWHM of sources from the second moment within a circular aperture of
+    radius 1.5x the FWHM, iterated from a first guess. A small box truncates
+    the wings of the profile and underestimates the FWHM; growing the
+    aperture with the measured size converges on the Gaussian FWHM.
+
+        Parameters:
+            resid (arr): 2D background-subtracted image or (N, height,
+                         width) stack
+            peaks (tuple): Peak indices from localMaxima
+            x, y (arr): Sub-pixel centroids of the sources
+            fwhm (arr): First guess of the FWHMs, eg. from a small box
+            iterations (int): Times to regrow the aperture
+            stamp (int): Odd width of the stamp the aperture is cut from,
+                         which limits the largest aperture
+
+        Returns:
+            fwhm (arr): FWHM of each source in pixels
+    """
+
+    half   = stamp//2
+    dy, dx = np.mgrid[-half:half+1,-half:half+1]
+    *frames, ys, xs = peaks
+    frames = tuple(f[:,None,None] for f in frames)
+
+    ## Pixels of the stamp off the edge of the image are left out
+    yy     = ys[:,None,None] + dy
+    xx     = xs[:,None,None] + dx
+    inside = (yy >= 0) & (yy < resid.shape[-2]) & (xx >= 0) & (xx < resid.shape[-1])
+    cut    = resid[frames + (np.clip(yy, 0, resid.shape[-2]-1), np.clip(xx, 0, resid.shape[-1]-1))]
+    cut    = np.where(inside, np.clip(cut, 0, None), 0).astype(np.float32)
+    r2     = ((xx - x[:,None,None])**2 + (yy - y[:,None,None])**2).astype(np.float32)
+
+    fwhm = np.asarray(fwhm, dtype=np.float32)
+    for i in range(iterations):
+        radius   = np.minimum(1.5*fwhm, half)
+        aperture = cut*(r2 <= (radius**2)[:,None,None])
+        weight   = np.maximum(aperture.sum(axis=(1,2)), np.finfo(np.float32).tiny)
+        fwhm     = GAUSS_FWHM*np.sqrt((aperture*r2).sum(axis=(1,2))/(2*weight))
+
+    return fwhm
+
+
+def _extract(images, nsigma, box):
+    """
+    Background subtract, find and centroid the sources of an image or stack.
+    Returns the peak indices and the sources, unsorted.
+    """
+
+    bkg, rms = backgroundRMS(images)
+    resid    = np.asarray(images, dtype=np.float32) - np.reshape(bkg, np.shape(bkg) + (1,1))
+
+    ## Peaks too close to the edge for a full centroiding box are dropped
+    peaks  = localMaxima(resid, nsigma*np.asarray(rms))
+    ys, xs = peaks[-2:]
+    half   = box//2
+    inside = (ys >= half) & (ys < resid.shape[-2]-half) & (xs >= half) & (xs < resid.shape[-1]-half)
+
+    return centroid(resid, tuple(index[inside] for index in peaks), box)
+
+
+def extractSources(img, nsigma=5.0, box=5, max_sources=None):
+    """
+    Find the stars in an image: local maxima more than nsigma above the
+    background, centroided to sub-pixel accuracy.
+
+        Parameters:
+            img (arr): 2D image
+            nsigma (float): Detection threshold in background RMS
+            box (int): Odd width of the centroiding box
+            max_sources (int): Keep only the brightest sources. None for all.
+
+        Returns:
+            sources (arr): SOURCE_DTYPE array, brightest first
+    """
+
+    _, sources = _extract(img, nsigma, box)
+    sources    = sources[np.argsort(-sources["flux"], kind="stable")]
+
+    return sources if max_sources is None else sources[:max_sources]
+
+
+##############################
+## Frame Stacks
+##############################
+
+def _extractChunk(frames, first, nsigma, box):
+    """
+    Sources of one chunk of a stack, with frame numbers counted from first.
+    """
+
+    chunk = np.asarray(frames)
+    (frame, *_), found = _extract(chunk, nsigma, box)
+
+    sources = np.empty(len(found), dtype=STACK_SOURCE_DTYPE)
+    sources["frame"] = first + frame
+    for name in SOURCE_DTYPE.names:
+        sources[name] = found[name]
+
+    return sources
+
+
+def extractSourcesStack(frames, nsigma=5.0, box=5, max_sources=None,
+                        workers=None, chunk_size=16):
+    """
+    Find the stars in every frame of a stack at once. Frames are processed
+    in chunks with vectorized array operations, and chunks run in parallel
+    threads (numpy releases the GIL for the heavy lifting, and memmapped
+    stacks are read inside the threads).
+
+        Parameters:
+            frames (arr/FrameStack/str): (N, height, width) stack, eg. from
+                                         importFramesRAW, or a directory of
+                                         .raw frames
+            nsigma (float): Detection threshold in background RMS
+            box (int): Odd width of the centroiding box
+            max_sources (int): Keep only the brightest sources of each
+                               frame. None for all.
+            workers (int): Number of threads. None uses every core.
+            chunk_size (int): Frames per chunk
+
+        Returns:
+            sources (arr): STACK_SOURCE_DTYPE array, by frame and brightest
+                           first within each frame
+    """
+
+    if isinstance(frames, (str, os.PathLike)):
+        from analyzeframes import FrameStack
+        frames = FrameStack(frames)
+
+    ## Extract every chunk, in a thread pool if requested
+    def extract(start):
+        return _extractChunk(frames[start:start+chunk_size], start, nsigma, box)
+
+    starts = range(0, len(frames), chunk_size)
+    if workers == 1 or len(starts) <= 1:
+        found = list(map(extract, starts))
+    else:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            found = list(pool.map(extract, starts))
+    if not found:
+        return np.zeros(0, dtype=STACK_SOURCE_DTYPE)
+    sources = np.concatenate(found)
+
+    ## Order by frame then flux, keeping the brightest of each frame
+    sources = sources[np.lexsort((-sources["flux"], sources["frame"]))]
+    if max_sources is not None:
+        firsts  = np.searchsorted(sources["frame"], sources["frame"], side="left")
+        sources = sources[np.arange(len(sources)) - firsts < max_sources]
+
+    return sources
@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename:   watcher.py
+Author(s):  Peter Quigley
+Contact:    pquigley@uwo.ca
+Created:    Sat Oct 17 17:40:02 2026
+Updated:    Sat Oct 17 17:40:02 2026
+
+Usage: python3 watcher.py NIGHT_DIR [OUTPUT_DIR] [IDLE_TIMEOUT]
+Description: watches a night directory while the camera writes it and pushes
+             each new .raw frame through live processing stages (quick-look
+             pngs, .vid append, running stack, meteor detection)
+"""
+
+# Module Imports
+import os,sys
+import time
+import queue
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import threading
+import numpy as np
+from datetime import datetime, timezone
+
+## Custom Script Imports
+from frameindex import buildFrameIndex, parseFrameTimes
+from analyzeframes import readRAW
+
+
+##############################
+## Directory Watching
+##############################
+
+## inotify(7) flags. Frames are picked up once the camera closes them, or
+## when they're moved into place complete.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+## struct inotify_event: wd, mask, cookie, len, then a padded name
+INOTIFY_EVENT  = struct.Struct("iIII")
+
+
+class DirectoryWatcher:
+    """
+    Yields new files in a directory as they are completed. Uses inotify
+    where it's available; otherwise the directory is polled and a file
+    counts as complete once its size has stopped changing between polls.
+
+        Parameters:
+            watch_dir (str): Directory to watch
+            suffix (str): Extension of the files to yield (case-insensitive)
+            poll_interval (float): Seconds between polls, and the longest
+                                   wait for an inotify event before checking
+                                   whether to stop
+            use_inotify (bool): Try inotify before falling back to polling
+            frame_bytes (int): Size of a complete file. Files of any other
+                               size are left until they are rewritten.
+    """
+
+    def __init__(self, watch_dir, suffix=".raw", poll_interval=1.0, use_inotify=True,
+                 frame_bytes=None):
+
+        self.watch_dir     = str(watch_dir)
+        self.suffix        = suffix.lower()
+        self.poll_interval = poll_interval
+        self.frame_bytes   = frame_bytes
+        self.seen          = set()
+        self._fd           = None
+        self._pending      = {}
+
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                self._fd = self._inotify()
+            except (OSError, AttributeError) as err:
+                print(f"inotify unavailable ({err}), polling {self.watch_dir}")
+
+
+    def _inotify(self):
+        """
+        Open an inotify instance watching the directory.
+        """
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        fd   = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        wd = libc.inotify_add_watch(fd, os.fsencode(self.watch_dir),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, f"inotify_add_watch failed on {self.watch_dir}")
+
+        return fd
+
+
+    def _wanted(self, name):
+        return name.lower().endswith(self.suffix) and not name.startswith(".")
+
+
+    def _complete(self, size):
+        return size > 0 if self.frame_bytes is None else size == self.frame_bytes
+
+
+    def existing(self):
+        """
+        Files already in the directory, in time order, which haven't been
+        yielded yet. Only files that look finished are returned.
+        """
+
+        index = buildFrameIndex(self.watch_dir, suffix=self.suffix, use_cache=False)
+        new   = []
+        for path, size in zip(index["path"], index["size"]):
+            name = os.path.basename(path)
+            if name not in self.seen and self._complete(size):
+                self.seen.add(name)
+                new.append(path)
+
+        return new
+
+
+    def _poll(self):
+        """
+        Files whose size hasn't changed since the last poll.
+        """
+
+        ready = []
+        with os.scandir(self.watch_dir) as entries:
+            for entry in entries:
+                if entry.name in self.seen or not self._wanted(entry.name):
+                    continue
+                size = entry.stat().st_size
+                if self._complete(size) and self._pending.get(entry.name) == size:
+                    del self._pending[entry.name]
+                    self.seen.add(entry.name)
+                    ready.append(entry.path)
+                else:
+                    self._pending[entry.name] = size
+
+        return sorted(ready)
+
+
+    def _read(self):
+        """
+        Files completed since the last read of the inotify queue.
+        """
+
+        ready, _, _ = select.select([self._fd], [], [], self.poll_interval)
+        if not ready:
+            return []
+
+        buf   = os.read(self._fd, 64*1024)
+        names = []
+        pos   = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, pos)
+            pos += INOTIFY_EVENT.size
+            name = buf[pos:pos+length].rstrip(b"\0").decode(errors="replace")
+            pos += length
+
+            # The kernel queue overflowed, so events were lost: rescan
+            if mask & IN_Q_OVERFLOW:
+                return names + self.existing()
+            if name and name not in self.seen and self._wanted(name):
+                path = os.path.join(self.watch_dir, name)
+                try:
+                    size = os.stat(path).st_size
+                except FileNotFoundError:
+                    continue
+                # Short files are picked up again when they're rewritten
+                if self._complete(size):
+                    self.seen.add(name)
+                    names.append(path)
+
+        return names
+
+
+    def __iter__(self):
+        """
+        Yield each new file's path, starting with those already there.
+        Polls (or waits on inotify) forever; the consumer decides when to
+        stop. Files which appear in a batch are yielded in name order.
+        """
+
+        # The watch is already set up, so nothing can slip in between the
+        # scan of existing files and the first event
+        yield from self.existing()
+        while True:
+            batch = self._read() if self._fd is not None else self._poll()
+            if not batch and self._fd is None:
+                time.sleep(self.poll_interval)
+            yield from batch
+            if not batch:
+                yield None
+
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+##############################
+## Processing Stages
+##############################
+
+## Every stage gets each frame as (path, unixtime, frame) in time order, on
+## its own thread. Frames are shared between stages and must not be
+## modified. When the watcher is restarted on a night, it starts again from
+## the night's first frame; stages which write their output as they go have
+## a done(path, unixtime) method saying which frames their output already
+## holds, and are only given the rest. Stages which keep their state in
+## memory see every frame again and rewrite their outputs whole.
+
+class PNGStage:
+    """
+    Quick-look pngs of every Nth frame.
+    """
+
+    def __init__(self, output_dir, every=1, orientation=None):
+        self.output_dir  = output_dir
+        self.every       = every
+        self.orientation = orientation
+        self.count       = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+
+    def done(self, path, unixtime):
+        # Only called from the watcher's thread, in frame order
+        self.count += 1
+        png_name = os.path.splitext(os.path.basename(path))[0] + ".png"
+        return (self.count - 1) % self.every != 0 or\
+               os.path.exists(os.path.join(self.output_dir, png_name))
+
+
+    def process(self, path, unixtime, frame):
+        from analyzeframes import orientImage, writePNG16
+
+        # Written under a hidden name first, so viewers never load half a png
+        png_name = os.path.splitext(os.path.basename(path))[0] + ".png"
+        tmp_path = os.path.join(self.output_dir, "." + png_name)
+        writePNG16(orientImage(frame, self.orientation), tmp_path)
+        os.replace(tmp_path, os.path.join(self.output_dir, png_name))
+
+
+    def close(self):
+        pass
+
+
+class VidStage:
+    """
+    Append every frame to a .vid file. Frames already in the file, from
+    before a restart, are skipped.
+    """
+
+    def __init__(self, save_path, orientation=None):
+        from raw_img_reader import VidWriter, VidReader
+
+        self.orientation = orientation
+        shape = (VidWriter.Y_DIM, VidWriter.X_DIM)
+        if orientation in ("rot90","rot270"):
+            shape = shape[::-1]
+        self.vid = VidWriter(save_path, append=True, shape=shape)
+
+        # Headers only keep whole seconds, so count how many frames of the
+        # last second are already written
+        self.last_time = -np.inf
+        self.last_left = 0
+        if self.vid.seq > 0:
+            self.vid.f.flush()
+            times = VidReader(save_path).index["unixtime"]
+            self.last_time = int(times[-1])
+            self.last_left = int(np.count_nonzero(times == times[-1]))
+
+
+    def done(self, path, unixtime):
+        if int(unixtime) < self.last_time:
+            return True
+        if int(unixtime) == self.last_time and self.last_left > 0:
+            self.last_left -= 1
+            return True
+        return False
+
+
+    def process(self, path, unixtime, frame):
+        from analyzeframes import orientImage
+
+        # Unrotated 16-bit frames go straight from the .raw file
+        if self.orientation is None and os.path.getsize(path) == self.vid.frame_bytes:
+            self.vid.writeRAW(path, unixtime)
+        else:
+            self.vid.writeFrame(orientImage(frame, self.orientation), unixtime)
+
+
+    def close(self):
+        self.vid.close()
+
+
+class StackStage:
+    """
+    Running statistics of the night, saved when the night ends.
+    """
+
+    def __init__(self, save_path, stats=("mean","max")):
+        from analyzeframes import RunningStack
+
+        self.save_path = save_path
+        self.running   = RunningStack(stats)
+
+
+    def process(self, path, unixtime, frame):
+        self.running.update(frame)
+
+
+    def close(self):
+        from analyzeframes import writePNG16
+
+        if self.running.count == 0:
+            return
+        for stat, img in self.running.result().items():
+            if img.dtype == np.uint16:
+                writePNG16(img, self.save_path.format(stat=stat))
+
+
+class DetectStage:
+    """
+    Meteor detection against a rolling background. Tracks are linked and
+    the evmags log written when the night ends.
+    """
+
+    def __init__(self, save_path, night_start, window=25, method="median",
+                 nsigma=5.0, min_pixels=3):
+        from background import RollingBackground, compileKernels
+
+        self.save_path   = save_path
+        self.night_start = night_start
+        self.t0          = night_start.replace(tzinfo=timezone.utc).timestamp()
+        self.nsigma      = nsigma
+        self.min_pixels  = min_pixels
+        self.model       = RollingBackground(window, method, nsigma)
+        self.detections  = []
+        self.count       = 0
+
+        # The kernels are called from the stage's thread
+        compileKernels()
+
+
+    def process(self, path, unixtime, frame):
+        from detect import detectFrame, DETECTION_DTYPE
+
+        residual = next(self.model.subtract([frame]))
+        if self.model.count > 1:
+            x, y, flux, peak, npix = detectFrame(residual, self.nsigma, self.min_pixels)
+            found = np.empty(len(x), dtype=DETECTION_DTYPE)
+            found["frame"] = self.count
+            found["time"]  = unixtime - self.t0
+            found["x"], found["y"], found["flux"] = x, y, flux
+            found["peak"], found["npix"] = peak, npix
+            self.detections.append(found)
+        self.count += 1
+
+
+    def close(self):
+        from detect import linkTracks, writeEventLog, DETECTION_DTYPE
+
+        detections = np.concatenate(self.detections) if self.detections else\
+                     np.zeros(0, dtype=DETECTION_DTYPE)
+        tracks = linkTracks(detections)
+        writeEventLog(tracks, self.night_start, self.save_path)
+        print(f"Wrote {len(tracks)} events to {self.save_path}")
+
+
+##############################
+## Live Pipeline
+##############################
+
+def _runStage(stage, inbox, errors):
+    """
+    Stage thread: process frames until the end-of-night marker.
+    """
+
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        try:
+            stage.process(*item)
+        except Exception as err:
+            errors.append((type(stage).__name__, item[0], err))
+    stage.close()
+
+
+def watchNight(night_dir, stages, idle_timeout=None, queue_size=64,
+               bitdepth=16, layout="msb", stop=None, **watch_args):
+    """
+    Process a night's frames live as the camera writes them. Each frame is
+    read once and handed to every stage through its own bounded queue;
+    when a stage falls behind its queue fills and the watcher blocks, so
+    memory stays bounded and unprocessed frames just wait on disk.
+
+        Parameters:
+            night_dir (str): Night directory the camera writes into. Assumes
+                             the first 8 characters are YYYYMMDD.
+            stages (list): Stage objects (PNGStage, VidStage, StackStage,
+                           DetectStage or anything with process and close,
+                           and optionally done)
+            idle_timeout (float): End the night after this many seconds
+                                  without a new frame. None to run until
+                                  stopped.
+            queue_size (int): Frames each stage may fall behind by
+            bitdepth (int): 16, or 12 for packed 12-bit frames
+            layout (str): Packing layout of 12-bit frames
+            stop (Event): Set to end the night early
+            **watch_args: Passed on to DirectoryWatcher
+
+        Returns:
+            processed (int): Number of frames processed
+    """
+
+    ## Sanitize inputs
+    night_dir = str(night_dir)
+    basename  = os.path.basename(os.path.normpath(night_dir))
+    try:
+        night = datetime.strptime(basename[:8],"%Y%m%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise ValueError(f"{basename} needs to have YYYYMMDD as the first 8 characters")
+    stop = stop or threading.Event()
+    watch_args.setdefault("frame_bytes", 768*1024*bitdepth//8)
+
+    ## Wait for the camera to start the night
+    while not os.path.isdir(night_dir) and not stop.is_set():
+        time.sleep(1)
+
+    ## One thread and bounded queue per stage
+    errors  = []
+    inboxes = [queue.Queue(maxsize=queue_size) for _ in stages]
+    threads = [threading.Thread(target=_runStage, args=(stage, inbox, errors), daemon=True)
+               for stage, inbox in zip(stages, inboxes)]
+    for thread in threads:
+        thread.start()
+
+    watcher   = DirectoryWatcher(night_dir, **watch_args)
+    processed = 0
+    last_new  = time.monotonic()
+    try:
+        for path in watcher:
+            if stop.is_set():
+                break
+            if path is None:
+                if idle_timeout is not None and time.monotonic() - last_new > idle_timeout:
+                    break
+                continue
+            last_new = time.monotonic()
+
+            unixtime = night.timestamp() + parseFrameTimes([os.path.basename(path)])[0]
+            if not np.isfinite(unixtime):
+                continue
+
+            # After a restart, frames already in every stage's output aren't
+            # even read
+            todo = [inbox for stage, inbox in zip(stages, inboxes)
+                    if not (hasattr(stage, "done") and stage.done(path, unixtime))]
+            if not todo:
+                continue
+
+            # Skip anything which isn't a whole frame (yet)
+            try:
+                frame = readRAW(path, bitdepth, layout)
+            except (OSError, ValueError) as err:
+                print(f"Skipping {path}: {err}")
+                continue
+
+            # Blocks while a stage's queue is full
+            for inbox in todo:
+                inbox.put((path, unixtime, frame))
+            processed += 1
+            if processed % 1000 == 0:
+                backlog = max(inbox.qsize() for inbox in inboxes)
+                print(f"{processed} frames processed, largest backlog {backlog}")
+
+    finally:
+        watcher.close()
+        for inbox in inboxes:
+            inbox.put(None)
+        for thread in threads:
+            thread.join()
+
+    for stage_name, path, err in errors:
+        print(f"{stage_name} failed on {path}: {err}")
+    print(f"Processed {processed} frames from {night_dir}")
+
+    return processed
+
+
+def defaultStages(night_dir, output_dir=None, png_every=50):
+    """
+    Quick-look pngs, .vid, mean/max stack and detection for a night.
+    """
+
+    night_dir  = os.path.normpath(str(night_dir))
+    date_str   = os.path.basename(night_dir)[:8]
+    output_dir = output_dir or night_dir
+    night      = datetime.strptime(date_str,"%Y%m%d")
+    os.makedirs(output_dir, exist_ok=True)
+
+    return [PNGStage(os.path.join(output_dir, "quicklook"), every=png_every),
+            VidStage(os.path.join(output_dir, f"{date_str}.vid")),
+            StackStage(os.path.join(output_dir, "{stat}" + f"{date_str}.png")),
+            DetectStage(os.path.join(output_dir, f"evmags{date_str}.log"), night)]
+
+
+##############################
+## Main
+##############################
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 1:
+        print("Usage: python3 watcher.py NIGHT_DIR [OUTPUT_DIR] [IDLE_TIMEOUT]")
+        sys.exit()
+
+    output_dir   = sys.argv[2] if len(sys.argv) > 2 else None
+    idle_timeout = float(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    ## Finish the night's outputs cleanly on Ctrl-C or a service stop
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    watchNight(sys.argv[1], defaultStages(sys.argv[1], output_dir),
+               idle_timeout=idle_timeout, stop=stop)